@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Times bokchoi commands end to end against the in-process AWS stand-in and counts the API calls each one makes.
+
+    python benchmarks/bench_commands.py --files 2000 --latency 0.05
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Keep package cache, upload state and keys of benchmark runs out of the real home directory
+os.environ['HOME'] = tempfile.mkdtemp(prefix='bokchoi-bench-home-')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from click.testing import CliRunner  # noqa: E402
+
+from bokchoi import utils  # noqa: E402
+from bokchoi.cli import cli  # noqa: E402
+from bokchoi.aws import common  # noqa: E402
+from bokchoi.aws.fake import FakeAWS  # noqa: E402
+
+SETTINGS = {
+    'EC2': {
+        'SpotPrice': '0.10',
+        'LaunchSpecification': {
+            'ImageId': 'ami-fake',
+            'InstanceType': 'c5.xlarge',
+            'SubnetId': 'subnet-fake'
+        }
+    },
+    'EMR': {
+        'InstanceCount': 2,
+        'Version': 'emr-5.8.0',
+        'SpotPrice': '0.10',
+        'LaunchSpecification': {
+            'InstanceType': 'm1.medium',
+            'SubnetId': 'subnet-fake'
+        }
+    }
+}
+
+COMMANDS = {
+    'EC2': [['deploy'], ['deploy'], ['run'], ['status'], ['status', '--all'], ['logs'], ['stop'], ['undeploy']],
+    'EMR': [['deploy'], ['deploy'], ['run'], ['undeploy']]
+}
+
+
+def create_project(path, platform, files, file_size, name='bench'):
+    """Writes settings and a synthetic project of files random files"""
+    settings = {name: {'Platform': platform,
+                       'EntryPoint': 'main.py',
+                       'Region': 'us-east-1',
+                       'Requirements': ['numpy'],
+                       platform: SETTINGS[platform]}}
+
+    with open(os.path.join(path, 'bokchoi_settings.json'), 'w') as settings_file:
+        json.dump(settings, settings_file)
+
+    for i in range(files):
+        directory = os.path.join(path, 'pkg{}'.format(i // 100))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'module{}.py'.format(i)), 'wb') as _file:
+            _file.write(os.urandom(file_size // 2).hex().encode())
+
+
+def finish_logs(fake, project_id):
+    """Writes the messages an instance would write, so 'bokchoi logs' has something to read and terminates"""
+    logs = fake.session().client('logs')
+    stream = logs.describe_log_streams(logGroupName=project_id, orderBy='LogStreamName',
+                                       descending=True, limit=1)['logStreams'][0]['logStreamName']
+    events = [{'timestamp': int(1000 * time.time()), 'message': '[app]: line {}'.format(i)} for i in range(1000)]
+    events.append({'timestamp': int(1000 * time.time()), 'message': '[bokchoi]: log-termination'})
+    logs.put_log_events(logGroupName=project_id, logStreamName=stream, logEvents=events)
+    fake.reset_calls()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--platform', default='EC2', choices=sorted(COMMANDS))
+    parser.add_argument('--files', type=int, default=500, help='Number of files in synthetic project')
+    parser.add_argument('--file-size', type=int, default=16 * 1024, help='Size of each file in bytes')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every API call')
+    parser.add_argument('--throttle', action='append', default=[], metavar='OPERATION=RATE',
+                        help='Fraction of calls to an operation that are throttled, e.g. PutLogEvents=0.1')
+    parser.add_argument('--instance-types', help='Comma separated instance types; launches EC2 runs with a fleet')
+    parser.add_argument('--projects', type=int, default=0
+                        , help='Number of other projects deployed and run beforehand, which status --all lists')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Print command output and call breakdown')
+    args = parser.parse_args()
+
+    throttle = {operation: float(rate) for operation, rate in (item.split('=') for item in args.throttle)}
+    fake = FakeAWS(latency=args.latency, throttle=throttle, seed=0)
+    common.use_session(fake.session())
+
+    # Deploy looks up the caller's public IP to open SSH access, which isn't available offline
+    utils.get_my_ip = lambda: '203.0.113.1'
+
+    if args.instance_types:
+        SETTINGS['EC2']['InstanceTypes'] = args.instance_types.split(',')
+        SETTINGS['EC2']['Subnets'] = ['subnet-fake-a', 'subnet-fake-b', 'subnet-fake-c']
+
+    project_dir = tempfile.mkdtemp(prefix='bokchoi-bench-project-')
+    create_project(project_dir, args.platform, args.files, args.file_size)
+
+    runner = CliRunner()
+
+    for i in range(args.projects):
+        other_dir = tempfile.mkdtemp(prefix='bokchoi-bench-project-')
+        create_project(other_dir, args.platform, 10, args.file_size, name='other{}'.format(i))
+        for command in (['deploy'], ['run']):
+            runner.invoke(cli, command + ['--directory', other_dir])
+    fake.reset_calls()
+
+    print('{:<12} {:>10} {:>10}'.format('command', 'seconds', 'api calls'))
+
+    for command in COMMANDS[args.platform]:
+        if command == ['logs']:
+            finish_logs(fake, utils.create_project_id('bench', common.get_aws_account_id()))
+
+        start = time.perf_counter()
+        result = runner.invoke(cli, command + ['--directory', project_dir])
+        elapsed = time.perf_counter() - start
+
+        calls = fake.reset_calls()
+        status = '' if result.exception is None else '  failed: {!r}'.format(result.exception)
+
+        print('{:<12} {:>10.3f} {:>10}{}'.format(' '.join(command), elapsed, sum(calls.values()), status))
+
+        if args.verbose:
+            for operation, count in calls.most_common():
+                print('{:>20} {}'.format(count, operation))
+            print(result.output)
+
+    # Undeploy has to find every instance of the project, including those launched by EMR clusters
+    project_id = utils.create_project_id('bench', common.get_aws_account_id())
+    leftover = [instance.instance_id for instance in common.get_instances(project_id)]
+    if leftover:
+        sys.exit('Instances left running after undeploy: ' + ', '.join(leftover))
+
+
+if __name__ == '__main__':
+    main()
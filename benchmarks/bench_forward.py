@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Measures throughput of the port forwarder used by 'bokchoi connect' against a local stand-in for an SSH server.
+Downloads read a stream the remote side generates, uploads send a stream the remote side discards. A plain channel
+read without the forwarder is included as baseline. Then measures how long opening a channel takes through the
+control daemon compared to a new SSH connection, and how long the daemon takes to reconnect once its connection
+drops. Also checks that a connection closed by the remote side while the local side still writes, and a channel
+request to a port nothing listens on, leave the other connections alone.
+
+    python benchmarks/bench_forward.py --size 64 --connections 4
+"""
+
+import argparse
+from contextlib import redirect_stdout
+import io
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bokchoi import control  # noqa: E402
+from bokchoi.ssh import ControlDaemon, Forwarder  # noqa: E402
+
+SOURCE_PORT = 9001
+SINK_PORT = 9002
+# Replies and closes right away
+CLOSING_PORT = 9003
+# Refuses channels, as if nothing listens on it
+REFUSED_PORT = 9004
+
+BLOCK = os.urandom(1024 * 1024)
+
+
+class StandInServer(paramiko.ServerInterface):
+    """Accepts any key and any direct-tcpip channel, remembering the port each channel was opened to"""
+
+    def __init__(self):
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if destination[1] == REFUSED_PORT:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        self.destinations[chanid] = destination[1]
+        return paramiko.OPEN_SUCCEEDED
+
+
+def serve_channel(channel, port, size):
+    """Plays the remote service: sends size bytes on the source port, reads until EOF on the sink port"""
+    if port == SOURCE_PORT:
+        for _ in range(size // len(BLOCK)):
+            channel.sendall(BLOCK)
+    elif port == CLOSING_PORT:
+        channel.sendall(b'bye')
+    else:
+        while channel.recv(1024 * 1024):
+            pass
+        channel.sendall(b'ok')
+    channel.close()
+
+
+def start_server(size):
+    """Starts stand-in SSH server on a free port
+    :return:                        Port
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen(8)
+
+    def serve(sock):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        server = StandInServer()
+        transport.start_server(server=server)
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                threading.Thread(target=serve_channel, args=(channel, server.destinations[channel.get_id()], size)
+                                 , daemon=True).start()
+
+    def run():
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=run, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def download(port):
+    with socket.create_connection(('localhost', port)) as sock:
+        received = 0
+        while True:
+            data = sock.recv(1024 * 1024)
+            if not data:
+                return received
+            received += len(data)
+
+
+def upload(port, size):
+    with socket.create_connection(('localhost', port)) as sock:
+        for _ in range(size // len(BLOCK)):
+            sock.sendall(BLOCK)
+        sock.shutdown(socket.SHUT_WR)
+        assert sock.recv(2) == b'ok'
+    return size
+
+
+def write_after_close(port):
+    """Keeps writing to a connection the remote side has closed, until the forwarder closes it as well"""
+    with socket.create_connection(('localhost', port), timeout=10) as sock:
+        assert sock.recv(3) == b'bye'
+        try:
+            for _ in range(64):
+                sock.sendall(BLOCK)
+        except OSError:
+            pass
+
+
+def bench_control(port, size):
+    """Prints milliseconds taken to open a channel through the daemon, over a new connection and to reconnect"""
+    key = paramiko.RSAKey.generate(2048)
+
+    def new_transport():
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect('localhost', port=port, username='bench', pkey=key, look_for_keys=False, allow_agent=False)
+        return client.get_transport()
+
+    path = os.path.join(tempfile.mkdtemp(), 'control.sock')
+    daemon = ControlDaemon(new_transport(), new_transport, path, 'localhost')
+    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+
+    def attach():
+        # Sends nothing and waits for the sink's reply, which takes a channel open and a round trip
+        with control.attach(path, {'op': 'channel', 'port': SINK_PORT}) as sock:
+            sock.shutdown(socket.SHUT_WR)
+            assert sock.recv(2) == b'ok'
+
+    def reconnect():
+        daemon.transport.close()
+        attach()
+
+    def connect_new():
+        transport = new_transport()
+        channel = transport.open_channel('direct-tcpip', ('localhost', SINK_PORT), ('localhost', 0))
+        channel.shutdown_write()
+        assert channel.recv(2) == b'ok'
+        transport.close()
+
+    print()
+    print('{:<20} {:>10}'.format('channel open', 'ms'))
+    for name, func in (('control daemon', attach), ('new connection', connect_new), ('after reconnect', reconnect)):
+        # Keeps the daemon's reconnect messages out of the table
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for _ in range(5):
+                func()
+            elapsed = time.perf_counter() - start
+        print('{:<20} {:>10.1f}'.format(name, elapsed / 5 * 1000))
+
+    print('{:<20} {:>10}'.format('reconnects', control.request(path, {'op': 'stats'})['reconnects']))
+
+    # A refused channel is answered with an error, without dropping the connection other channels are using
+    reconnects = control.request(path, {'op': 'stats'})['reconnects']
+    with control.attach(path, {'op': 'channel', 'port': SOURCE_PORT}) as stream:
+        try:
+            control.attach(path, {'op': 'channel', 'port': REFUSED_PORT}).close()
+            raise AssertionError('Channel to refused port was opened')
+        except ConnectionError:
+            pass
+        received = 0
+        while True:
+            data = stream.recv(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+    assert received == size, 'Stream was cut off at {} bytes'.format(received)
+    assert control.request(path, {'op': 'stats'})['reconnects'] == reconnects, 'Refused channel caused reconnect'
+    print('{:<20} {:>10}'.format('refused channel', 'ok'))
+
+    control.request(path, {'op': 'stop'})
+
+
+def timed(name, func, connections, size):
+    """Runs func on connections threads at once and prints throughput"""
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(func())) for _ in range(connections)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = sum(results)
+    if total != size * connections:
+        print('{:<20} transferred {} of {} bytes'.format(name, total, size * connections))
+    print('{:<20} {:>10.3f} {:>10.1f}'.format(name, elapsed, total / elapsed / 1024 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=64, help='MB transferred per connection')
+    parser.add_argument('--connections', type=int, default=4, help='Concurrent connections per direction')
+    args = parser.parse_args()
+
+    # The stand-in server logs every connection the client closes
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    size = args.size * len(BLOCK)
+    port = start_server(size)
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('localhost', port=port, username='bench', pkey=paramiko.RSAKey.generate(2048)
+                   , look_for_keys=False, allow_agent=False)
+    transport = client.get_transport()
+
+    forwarder = Forwarder(transport, [(0, SOURCE_PORT), (0, SINK_PORT), (0, CLOSING_PORT)])
+    source_port, sink_port, closing_port = forwarder.ports
+    threading.Thread(target=forwarder.serve_forever, daemon=True).start()
+
+    def direct():
+        channel = transport.open_channel('direct-tcpip', ('localhost', SOURCE_PORT), ('localhost', 0))
+        received = 0
+        while True:
+            data = channel.recv(1024 * 1024)
+            if not data:
+                channel.close()
+                return received
+            received += len(data)
+
+    print('{:<20} {:>10} {:>10}'.format('transfer', 'seconds', 'MB/s'))
+
+    timed('channel (baseline)', direct, 1, size)
+    timed('download', lambda: download(source_port), 1, size)
+    timed('upload', lambda: upload(sink_port, size), 1, size)
+    timed('download x{}'.format(args.connections), lambda: download(source_port), args.connections, size)
+    timed('upload x{}'.format(args.connections), lambda: upload(sink_port, size), args.connections, size)
+
+    # The forwarder has to keep serving other connections after writing to a closed channel failed
+    write_after_close(closing_port)
+    socket.setdefaulttimeout(10)
+    assert download(source_port) == size, 'Forwarder stopped after the remote side closed a connection'
+    socket.setdefaulttimeout(None)
+    print('{:<20} {:>10}'.format('remote closes early', 'ok'))
+
+    forwarder.shutdown()
+    client.close()
+
+    bench_control(port, size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Measures cold start of the bokchoi CLI in fresh interpreters and checks that no cloud SDK is imported before a
+backend is selected. Exits with status 1 when the budget is exceeded or an SDK is imported.
+
+    python benchmarks/bench_import.py --runs 10 --budget 0.3
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Modules that should only be imported once the platform they belong to is used
+SDK_MODULES = ['boto3', 'botocore', 'paramiko', 'googleapiclient', 'google.auth', 'google.cloud']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from bokchoi.cli import cli
+try:
+    cli(['--help'], standalone_mode=False)
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'imported': [name for name in {sdk_modules!r} if name in sys.modules]}}))
+"""
+
+
+def measure():
+    """Runs bokchoi --help in a fresh interpreter and returns seconds taken and SDK modules imported"""
+    output = subprocess.check_output([sys.executable, '-c', PROBE.format(sdk_modules=SDK_MODULES)]
+                                     , cwd=ROOT, universal_newlines=True)
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Number of interpreters to start')
+    parser.add_argument('--budget', type=float, default=0.3, help='Maximum median seconds for bokchoi --help')
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    median = statistics.median(result['seconds'] for result in results)
+    imported = sorted({name for result in results for name in result['imported']})
+
+    print('bokchoi --help   median {:.3f}s over {} runs (budget {:.3f}s)'.format(median, args.runs, args.budget))
+
+    if imported:
+        print('SDK modules imported at startup: ' + ', '.join(imported))
+
+    if median > args.budget or imported:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
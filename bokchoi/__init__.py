@@ -1,3 +1,11 @@
 
 from bokchoi.bokchoi import Bokchoi
-from bokchoi.config import Config
\ No newline at end of file
+from bokchoi.config import Config
+from bokchoi.backends import BUILTIN_BACKENDS, get_backend
+
+
+def __getattr__(name):
+    """Backends such as bokchoi.EC2 are only imported when they're accessed"""
+    if name in BUILTIN_BACKENDS:
+        return get_backend(name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -1,24 +1,79 @@
 #!/usr/bin/env python3
 
+from collections import deque
+import json
 import os
 import sys
+import tempfile
+import threading
 import time
 
 import boto3
+from botocore.exceptions import ClientError
+
+# Limits of a single PutLogEvents call
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD = 26
+
+FLUSH_INTERVAL = 1
+MAX_BUFFER_BYTES = 8 * MAX_BATCH_BYTES
 
 
 class CloudwatchLogger:
 
-    """Reads messages from stdin and logs them to Cloudwatch Logs"""
+    """Reads messages from stdin and logs them to Cloudwatch Logs.
+
+    Messages are buffered and sent in batches from a background thread, either when a full batch is available or
+    every FLUSH_INTERVAL seconds. Reading stdin never waits for Cloudwatch: when the buffer is full, for instance
+    because requests are being throttled, messages are spooled to a file on disk and sent once Cloudwatch catches
+    up."""
 
     def __init__(self):
 
         self.logs_client = boto3.client('logs', region_name=os.environ['REGION'])
 
         self.log_group_name = os.environ['BOKCHOI_PROJECT_ID']
-        self.log_stream_name, self.sequence_token = self.get_most_recent_log_stream(self.log_group_name)
+        # Runs log to their own stream, so runs overlapping in time don't end up in each other's streams
+        if os.environ.get('BOKCHOI_RUN_ID'):
+            self.log_stream_name, self.sequence_token = self.get_log_stream(self.log_group_name
+                                                                            , os.environ['BOKCHOI_RUN_ID'])
+        else:
+            self.log_stream_name, self.sequence_token = self.get_most_recent_log_stream(self.log_group_name)
 
         self.stage = sys.argv[1]
+        if os.environ.get('BOKCHOI_INSTANCE_LABEL'):
+            self.stage += '#' + os.environ['BOKCHOI_INSTANCE_LABEL']
+
+        self.lock = threading.Condition()
+        self.buffer = deque()
+        self.buffer_bytes = 0
+        self.closed = False
+
+        self.spool = None
+        self.spool_offset = 0
+
+        self.sender = threading.Thread(target=self.send_batches)
+
+    def get_log_stream(self, log_group_name, log_stream_name):
+        """Returns log stream of the run and its sequence token. It's created when 'bokchoi run' is executed, but is
+        created here as well if it's missing"""
+        response = self.logs_client.describe_log_streams(
+            logGroupName=log_group_name,
+            logStreamNamePrefix=log_stream_name
+        )
+
+        for log_stream in response['logStreams']:
+            if log_stream['logStreamName'] == log_stream_name:
+                return log_stream_name, log_stream.get('uploadSequenceToken')
+
+        try:
+            self.logs_client.create_log_stream(logGroupName=log_group_name, logStreamName=log_stream_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceAlreadyExistsException':
+                raise e
+
+        return log_stream_name, None
 
     def get_most_recent_log_stream(self, log_group_name):
         """Returns most recent log stream. Should always exist since it's
@@ -35,29 +90,125 @@ class CloudwatchLogger:
 
         return log_stream['logStreamName'], next_token
 
-    def log_message(self, message):
-        """Log message to Cloudwatch log group"""
-        log_info = {'logGroupName': self.log_group_name,
-                    'logStreamName': self.log_stream_name,
-                    'logEvents': [
-                        {
-                            'timestamp': int(1000 * time.time()),
-                            'message': '[{}]: {}'.format(self.stage, message)
-                        },
-                    ]}
-
-        if self.sequence_token:
-            log_info['sequenceToken'] = self.sequence_token
-
-        response = self.logs_client.put_log_events(**log_info)
-
-        self.sequence_token = response['nextSequenceToken']
+    def add_message(self, message):
+        """Buffer message, or spool it to disk if the buffer is full or older messages are already spooled"""
+        event = {'timestamp': int(1000 * time.time()),
+                 'message': '[{}]: {}'.format(self.stage, message)}
+
+        with self.lock:
+            if self.spool or self.buffer_bytes >= MAX_BUFFER_BYTES:
+                if not self.spool:
+                    self.spool = tempfile.TemporaryFile('w+')
+                self.spool.seek(0, os.SEEK_END)
+                self.spool.write(json.dumps(event) + '\n')
+                return
+
+            self.buffer.append(event)
+            self.buffer_bytes += event_size(event)
+
+            if len(self.buffer) >= MAX_BATCH_EVENTS or self.buffer_bytes >= MAX_BATCH_BYTES:
+                self.lock.notify()
+
+    def next_batch(self):
+        """Takes the oldest events that fit in a single request, from the buffer first and then from the spool.
+        Returns the batch and whether it's full, i.e. more events are waiting to be sent."""
+        batch = []
+        batch_bytes = 0
+
+        while self.buffer and len(batch) < MAX_BATCH_EVENTS:
+            size = event_size(self.buffer[0])
+            if batch_bytes + size > MAX_BATCH_BYTES:
+                return batch, True
+            batch.append(self.buffer.popleft())
+            batch_bytes += size
+            self.buffer_bytes -= size
+
+        if not self.spool:
+            return batch, len(batch) == MAX_BATCH_EVENTS
+
+        self.spool.seek(self.spool_offset)
+        while len(batch) < MAX_BATCH_EVENTS:
+            line = self.spool.readline()
+            if not line:
+                self.spool.close()
+                self.spool = None
+                self.spool_offset = 0
+                break
+            event = json.loads(line)
+            size = event_size(event)
+            if batch_bytes + size > MAX_BATCH_BYTES:
+                break
+            batch.append(event)
+            batch_bytes += size
+            self.spool_offset = self.spool.tell()
+
+        return batch, self.spool is not None
+
+    def send_batches(self):
+        """Sends batches until stdin is closed and all messages have been sent"""
+        while True:
+            with self.lock:
+                if not self.closed:
+                    self.lock.wait(FLUSH_INTERVAL)
+                batch, full = self.next_batch()
+                done = self.closed and not batch
+
+            if done:
+                return
+
+            # Keep sending while full batches are waiting, otherwise wait for more messages to come in
+            while batch:
+                self.log_events(batch)
+                with self.lock:
+                    batch, full = self.next_batch() if full else ([], False)
+
+    def log_events(self, events):
+        """Log events to Cloudwatch log group, retrying with backoff while throttled"""
+        delay = 0.2
+
+        while True:
+            log_info = {'logGroupName': self.log_group_name,
+                        'logStreamName': self.log_stream_name,
+                        'logEvents': events}
+
+            if self.sequence_token:
+                log_info['sequenceToken'] = self.sequence_token
+
+            try:
+                response = self.logs_client.put_log_events(**log_info)
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ThrottlingException':
+                    time.sleep(delay)
+                    delay = min(delay * 2, 5)
+                elif code in ('InvalidSequenceTokenException', 'DataAlreadyAcceptedException'):
+                    self.sequence_token = e.response.get('expectedSequenceToken')
+                    if code == 'DataAlreadyAcceptedException':
+                        return
+                else:
+                    raise e
+            else:
+                self.sequence_token = response.get('nextSequenceToken')
+                return
 
     def run(self):
         """Process incoming messages"""
 
+        self.sender.start()
+
         for message in sys.stdin:
-            self.log_message(message)
+            self.add_message(message)
+
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+
+        self.sender.join()
+
+
+def event_size(event):
+    """Size of event as counted towards the batch limit"""
+    return len(event['message'].encode('utf-8')) + EVENT_OVERHEAD
 
 
 if __name__ == '__main__':
@@ -1,30 +1,95 @@
 
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import threading
+import time
+
 import boto3
 from botocore.exceptions import ClientError
 
-session = boto3.Session()
+from bokchoi import utils
+from bokchoi.aws.multipart import MultipartWriter
+from bokchoi.cache import TTLCache
+
+ACCOUNT_ID_TTL = 7 * 24 * 3600
+SPOT_PRICE_TTL = 15 * 60
+
+# Maximum number of values of a single EC2 filter
+FILTER_VALUES = 200
+
+# Key of the project state mirror in the project bucket
+STATE_KEY = 'bokchoi-state.json'
+
+session = None
+clients = {}
+resources = {}
+
+# Sessions aren't thread safe, so clients are created under a lock
+session_lock = threading.Lock()
+
+
+def get_session():
+    """Returns boto3 session, which is only created once it's needed"""
+    global session
+    if session is None:
+        session = boto3.Session()
+    return session
+
+
+def client(service_name):
+    """ Returns client of service, creating it on first use
+    :param service_name:            AWS service name, e.g. 'ec2'
+    :return:                        boto3 client
+    """
+    with session_lock:
+        if service_name not in clients:
+            clients[service_name] = get_session().client(service_name)
+        return clients[service_name]
+
 
-ec2_client = session.client('ec2')
-ec2_resource = session.resource('ec2')
+def resource(service_name):
+    """ Returns resource of service, creating it on first use
+    :param service_name:            AWS service name, e.g. 'ec2'
+    :return:                        boto3 service resource
+    """
+    with session_lock:
+        if service_name not in resources:
+            resources[service_name] = get_session().resource(service_name)
+        return resources[service_name]
 
-iam_client = session.client('iam')
-iam_resource = session.resource('iam')
 
-s3_client = session.client('s3')
-s3_resource = session.resource('s3')
+def use_session(new_session):
+    """ Makes all AWS calls go through clients of the given session, e.g. one created by fake.FakeAWS
+    :param new_session:             boto3.Session
+    """
+    global session
 
-logs_client = boto3.client('logs')
+    with session_lock:
+        session = new_session
+        clients.clear()
+        resources.clear()
 
 
 def get_aws_account_id():
-    """ Returns AWS account ID"""
-    response = ec2_client.describe_security_groups(GroupNames=['Default'])
-    return response['SecurityGroups'][0]['OwnerId']
+    """ Returns AWS account ID. The ID is cached locally per access key, so it's only looked up once a week"""
+
+    def lookup():
+        response = client('ec2').describe_security_groups(GroupNames=['Default'])
+        return response['SecurityGroups'][0]['OwnerId']
+
+    credentials = get_session().get_credentials()
+    if credentials is None:
+        return lookup()
+
+    key_hash = hashlib.sha256(credentials.access_key.encode('utf-8')).hexdigest()[:16]
+    return TTLCache().get('aws-account:' + key_hash, lookup, ACCOUNT_ID_TTL)
 
 
 def get_default_region():
     """Regions default region"""
-    return boto3.Session().region_name
+    return get_session().region_name
 
 
 def create_bucket(region, bucket_name):
@@ -34,7 +99,7 @@ def create_bucket(region, bucket_name):
     :return:                        Name of bucket
     """
     try:
-        s3_resource.create_bucket(Bucket=bucket_name
+        resource('s3').create_bucket(Bucket=bucket_name
                                   , CreateBucketConfiguration={'LocationConstraint': region})
     except ClientError as exception:
         if exception.response['Error']['Code'] == 'BucketAlreadyOwnedByYou':
@@ -47,14 +112,17 @@ def create_bucket(region, bucket_name):
     return bucket_name
 
 
-def upload_to_s3(bucket_name, file_object, file_name, fingerprint):
-    """ Uploads file to S3
+def upload_to_s3(bucket_name, file_name, fingerprint, write, part_size=8 * 1024 * 1024, concurrency=4):
+    """ Streams file to S3 using a multipart upload. Parts are uploaded concurrently while the file is written.
+    Nothing is written when the fingerprint matches that of the deployed file.
     :param bucket_name:                 Bucket name
-    :param file_object:                 File to upload
     :param file_name:                   Name of zip file in S3
-    :param fingerprint:                 Fingerprint of file_object
+    :param fingerprint:                 Fingerprint of file
+    :param write:                       Function which writes the file to the file object passed to it
+    :param part_size:                   Size of each uploaded part in bytes
+    :param concurrency:                 Number of parts to upload concurrently
     """
-    bucket = s3_resource.Bucket(bucket_name)
+    bucket = resource('s3').Bucket(bucket_name)
 
     try:
         cur_fingerprint = bucket.Object(file_name).metadata.get('fingerprint')
@@ -70,16 +138,268 @@ def upload_to_s3(bucket_name, file_object, file_name, fingerprint):
         else:
             print('Local package does not match deployed. Uploading')
 
-    bucket.put_object(Body=file_object, Key=file_name, Metadata={'fingerprint': fingerprint})
+    writer = MultipartWriter(client('s3'), bucket_name, file_name, fingerprint, part_size, concurrency)
+    write(writer)
+    writer.close()
+
+
+class S3Mirror:
+    """Mirrors a small text file, such as the project state, to S3"""
+
+    def __init__(self, bucket_name, key):
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def read(self):
+        """Returns mirrored text, or None if nothing has been mirrored yet"""
+        try:
+            response = client('s3').get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', 'NoSuchBucket'):
+                return None
+            raise e
+        return response['Body'].read().decode('utf-8')
+
+    def write(self, text):
+        try:
+            client('s3').put_object(Bucket=self.bucket_name, Key=self.key, Body=text.encode('utf-8'))
+        except ClientError as e:
+            # The bucket is removed by undeploy, together with the mirror
+            if e.response['Error']['Code'] != 'NoSuchBucket':
+                raise e
+
+
+def put_objects(bucket_name, objects, concurrency=8):
+    """ Uploads small objects concurrently
+    :param bucket_name:                 Bucket name
+    :param objects:                     Dict mapping keys to contents
+    :param concurrency:                 Number of objects to upload at the same time
+    """
+    s3_client = client('s3')
+
+    def put(key):
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=objects[key].encode('utf-8'))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(put, objects))
+
+
+def list_objects(bucket_name, prefix):
+    """ Returns last modified time of all objects under prefix
+    :param bucket_name:                 Bucket name
+    :param prefix:                      Key prefix
+    :return:                            Dict mapping keys to datetimes
+    """
+    paginator = client('s3').get_paginator('list_objects_v2')
+    return {item['Key']: item['LastModified']
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+            for item in page.get('Contents', [])}
+
+
+def object_exists(bucket_name, key):
+    """ Checks whether object exists in S3
+    :param bucket_name:                 Bucket name
+    :param key:                         Object key
+    :return:                            True if object exists
+    """
+    try:
+        client('s3').head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket'):
+            return False
+        raise e
+    return True
+
+
+def delete_object(bucket_name, key):
+    """ Deletes object from S3. Deleting an object that doesn't exist succeeds
+    :param bucket_name:                 Bucket name
+    :param key:                         Object key
+    """
+    client('s3').delete_object(Bucket=bucket_name, Key=key)
+
+
+def get_object_metadata(bucket_name, key):
+    """ Returns user metadata and modification time of object
+    :param bucket_name:                 Bucket name
+    :param key:                         Object key
+    :return:                            Tuple of metadata dict and datetime, or None if object doesn't exist
+    """
+    try:
+        response = client('s3').head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket'):
+            return None
+        raise e
+    return response['Metadata'], response['LastModified']
+
+
+def list_project_buckets():
+    """Returns names of all buckets in the account named after a project id"""
+    return [bucket['Name'] for bucket in client('s3').list_buckets()['Buckets']
+            if utils.parse_project_id(bucket['Name'])]
 
 
 def get_subnet(subnet_id):
-    return ec2_resource.Subnet(subnet_id)
+    return resource('ec2').Subnet(subnet_id)
+
+
+def get_subnet_info(subnet_id):
+    """ Returns VPC and availability zone of subnet. Cached locally, as a subnet can't move
+    :param subnet_id:               Subnet ID
+    :return:                        Dict with vpc_id and zone
+    """
+    def lookup():
+        subnet = get_subnet(subnet_id)
+        return {'vpc_id': subnet.vpc_id, 'zone': subnet.availability_zone}
+
+    return TTLCache().get('subnet:{}:{}'.format(get_session().region_name, subnet_id), lookup)
+
+
+def get_vpc_id(subnet_id):
+    """ Returns ID of the VPC subnet belongs to
+    :param subnet_id:               Subnet ID
+    :return:                        VPC ID
+    """
+    return get_subnet_info(subnet_id)['vpc_id']
+
+
+def get_spot_prices(instance_types, zones):
+    """ Returns current spot prices of instance types in availability zones. Prices are cached locally for a
+    while, so repeated runs don't have to page through the price history again.
+    :param instance_types:          Instance types
+    :param zones:                   Availability zones
+    :return:                        List of [instance type, zone, price], cheapest first
+    """
+    def lookup():
+        paginator = client('ec2').get_paginator('describe_spot_price_history')
+        pages = paginator.paginate(InstanceTypes=list(instance_types)
+                                   , ProductDescriptions=['Linux/UNIX']
+                                   , StartTime=datetime.now(timezone.utc))
+        prices = {}
+        for page in pages:
+            for entry in page['SpotPriceHistory']:
+                pool = (entry['InstanceType'], entry['AvailabilityZone'])
+                # History is returned newest first
+                if pool not in prices and pool[1] in zones:
+                    prices[pool] = float(entry['SpotPrice'])
+        return sorted(([pool[0], pool[1], price] for pool, price in prices.items()), key=lambda item: item[2])
+
+    key = 'spot-prices:{}:{}:{}'.format(get_session().region_name, ','.join(sorted(instance_types))
+                                        , ','.join(sorted(zones)))
+    return TTLCache().get(key, lookup, SPOT_PRICE_TTL)
+
+
+def put_launch_template(template_name, launch_spec):
+    """ Stores launch specification in a launch template, adding a new version if the template exists
+    :param template_name:           Name of launch template
+    :param launch_spec:             EC2 launch specification. Instance type and subnet are left to the fleet
+    :return:                        Launch template specification referring to the new version
+    """
+    data = {key: value for key, value in launch_spec.items() if key not in ('InstanceType', 'SubnetId')}
+
+    try:
+        response = client('ec2').create_launch_template(LaunchTemplateName=template_name
+                                                        , LaunchTemplateData=data)
+        version = response['LaunchTemplate']['LatestVersionNumber']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.AlreadyExistsException':
+            raise e
+        response = client('ec2').create_launch_template_version(LaunchTemplateName=template_name
+                                                                , LaunchTemplateData=data)
+        version = response['LaunchTemplateVersion']['VersionNumber']
+
+    return {'LaunchTemplateName': template_name, 'Version': str(version)}
+
+
+def fleet_overrides(instance_types, subnet_ids, max_price=None, allocation_strategy='capacity-optimized'):
+    """ Returns fleet overrides for all combinations of instance type and subnet. Pools whose current price is above
+    max_price are left out; the remaining pools are prioritised cheapest first.
+    :param instance_types:          Instance types to choose from
+    :param subnet_ids:              Subnets to choose from, one per availability zone
+    :param max_price:               Max price to pay per instance hour
+    :param allocation_strategy:     Fleet spot allocation strategy, e.g. lowest-price or capacity-optimized
+    :return:                        List of overrides
+    """
+    subnets_by_zone = {}
+    for subnet_id in subnet_ids:
+        subnets_by_zone.setdefault(get_subnet_info(subnet_id)['zone'], []).append(subnet_id)
+
+    overrides = []
+    for instance_type, zone, price in get_spot_prices(instance_types, sorted(subnets_by_zone)):
+        if max_price and price > float(max_price):
+            continue
+        for subnet_id in subnets_by_zone[zone]:
+            override = {'InstanceType': instance_type, 'SubnetId': subnet_id}
+            if max_price:
+                override['MaxPrice'] = str(max_price)
+            if allocation_strategy.endswith('prioritized'):
+                override['Priority'] = float(len(overrides))
+            overrides.append(override)
+
+    if not overrides:
+        raise RuntimeError('No spot pool of {} is currently available for at most {}'.format(
+            ', '.join(instance_types), max_price))
+
+    return overrides
+
+
+def launch_fleet(project_id, launch_template, overrides, instance_count, allocation_strategy='capacity-optimized'):
+    """ Launches spot instances with an instant EC2 fleet, which picks from all pools in overrides instead of waiting
+    for capacity in a single pool. Instances are tagged on creation.
+    :param project_id:              Global project id
+    :param launch_template:         Launch template specification, see put_launch_template
+    :param overrides:               Pools to choose from, see fleet_overrides
+    :param instance_count:          Number of instances to launch
+    :param allocation_strategy:     Fleet spot allocation strategy, e.g. lowest-price or capacity-optimized
+    :return:                        IDs of launched instances
+    """
+    tags = [{'Key': 'bokchoi-id', 'Value': project_id}]
+
+    response = client('ec2').create_fleet(
+        Type='instant',
+        TargetCapacitySpecification={'TotalTargetCapacity': instance_count
+                                     , 'DefaultTargetCapacityType': 'spot'},
+        SpotOptions={'AllocationStrategy': allocation_strategy},
+        LaunchTemplateConfigs=[{'LaunchTemplateSpecification': launch_template, 'Overrides': overrides}],
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}]
+    )
+
+    instance_ids = [instance_id for launched in response.get('Instances', [])
+                    for instance_id in launched['InstanceIds']]
+
+    for error in response.get('Errors', []):
+        pool = error.get('LaunchTemplateAndOverrides', {}).get('Overrides', {})
+        print('Could not launch {} in {}: {}'.format(pool.get('InstanceType'), pool.get('SubnetId')
+                                                     , error.get('ErrorMessage') or error.get('ErrorCode')))
+
+    if not instance_ids:
+        raise RuntimeError('Fleet did not launch any instances')
+
+    if len(instance_ids) < instance_count:
+        print('Launched {} of {} instances'.format(len(instance_ids), instance_count))
+
+    return instance_ids
+
+
+def delete_launch_template(template_name, dryrun=True):
+
+    if dryrun:
+        print('Dryrun flag set. Would have deleted launch template ' + template_name)
+        return
+
+    try:
+        client('ec2').delete_launch_template(LaunchTemplateName=template_name)
+        print('Deleted launch template ' + template_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('InvalidLaunchTemplateName.NotFoundException'
+                                               , 'InvalidLaunchTemplateId.NotFound'):
+            raise e
 
 
 def create_security_group(group_name, project_id, vpc_id, *rules):
     try:
-        group = ec2_resource.create_security_group(
+        group = resource('ec2').create_security_group(
             Description='Bokchoi default security group',
             GroupName=group_name,
             VpcId=vpc_id
@@ -87,7 +407,7 @@ def create_security_group(group_name, project_id, vpc_id, *rules):
     except ClientError as e:
         if e.response['Error']['Code'] == 'InvalidGroup.Duplicate':
             print('Security group already exists ' + group_name)
-            return
+            return get_security_groups(project_id, group_name)[0]
         else:
             raise e
 
@@ -108,9 +428,9 @@ def get_security_groups(project_id, *group_names):
     if group_names:
         filters.append({'Name': 'group-name', 'Values': list(group_names)})
 
-    response = ec2_client.describe_security_groups(Filters=filters)
+    response = client('ec2').describe_security_groups(Filters=filters)
 
-    return [ec2_resource.SecurityGroup(group['GroupId']) for group in response['SecurityGroups']]
+    return [resource('ec2').SecurityGroup(group['GroupId']) for group in response['SecurityGroups']]
 
 
 def delete_security_group(group, dryrun=True):
@@ -132,7 +452,7 @@ def create_instance_profile(profile_name, role_name=None):
     :return:                        API response
     """
     try:
-        create_instance_profile_response = iam_client.create_instance_profile(
+        create_instance_profile_response = client('iam').create_instance_profile(
             InstanceProfileName=profile_name
         )
     except ClientError as e:
@@ -143,7 +463,7 @@ def create_instance_profile(profile_name, role_name=None):
             raise e
 
     if role_name:
-        iam_client.add_role_to_instance_profile(
+        client('iam').add_role_to_instance_profile(
             InstanceProfileName=profile_name,
             RoleName=role_name
         )
@@ -155,17 +475,22 @@ def create_policy(policy_name, document):
     """ Creates IAM policy
     :param policy_name:             Name of policy to create
     :param document:                Policy document associated with policy
+    :return:                        Boto3 policy resource
     """
     try:
-        iam_client.create_policy(PolicyName=policy_name
-                                 , PolicyDocument=document)
+        response = client('iam').create_policy(PolicyName=policy_name
+                                            , PolicyDocument=document)
         print('Created policy: ' + policy_name)
+        policy_arn = response['Policy']['Arn']
     except ClientError as e:
         if e.response['Error']['Code'] == 'EntityAlreadyExists':
             print('Policy already exists ' + policy_name)
+            policy_arn = 'arn:aws:iam::{}:policy/{}'.format(get_aws_account_id(), policy_name)
         else:
             raise e
 
+    return resource('iam').Policy(policy_arn)
+
 
 def create_role(role_name, trust_policy, *policies):
     """ Creates IAM role
@@ -175,58 +500,181 @@ def create_role(role_name, trust_policy, *policies):
     :return:                        API response
     """
     try:
-        iam_client.create_role(RoleName=role_name
+        client('iam').create_role(RoleName=role_name
                                , AssumeRolePolicyDocument=trust_policy)
     except ClientError as e:
         if e.response['Error']['Code'] == 'EntityAlreadyExists':
             print('Role already exists ' + role_name)
-            return iam_resource.Role(role_name)
+            return resource('iam').Role(role_name)
         else:
             raise e
 
     for policy in policies:
         if not policy:
             continue
-        iam_client.attach_role_policy(
+        client('iam').attach_role_policy(
             RoleName=role_name,
             PolicyArn=policy.arn
         )
     print('Created role: ' + role_name)
-    return iam_resource.Role(role_name)
+    return resource('iam').Role(role_name)
 
 
-def request_spot_instances(project_id, launch_spec, spot_price):
-    """ Create spot instance request
+def run_spot_instances(project_id, launch_spec, spot_price, instance_count=1, persistent=False):
+    """ Launches one-time spot instances. Returns as soon as EC2 has accepted the request; instances and their spot
+    requests are tagged on creation, so they're found by get_instances right away.
     :param project_id:                  Global project id
     :param launch_spec:                 EC2 launch specification
     :param spot_price:                  Max price to bid for spot instance
+    :param instance_count:              Number of instances to launch. Either all or none are launched.
+    :param persistent:                  Use persistent spot requests, so instances can be stopped and started
+    :return:                            Instance ids
+    """
+    params = dict(launch_spec)
+
+    # Unlike spot launch specifications, run_instances takes user data unencoded
+    if 'UserData' in params:
+        params['UserData'] = b64decode(params['UserData']).decode('utf-8')
+
+    tags = [{'Key': 'bokchoi-id', 'Value': project_id}]
+
+    spot_options = {'MaxPrice': str(spot_price), 'SpotInstanceType': 'one-time'}
+    if persistent:
+        spot_options.update(SpotInstanceType='persistent', InstanceInterruptionBehavior='stop')
+
+    response = client('ec2').run_instances(
+        MinCount=instance_count,
+        MaxCount=instance_count,
+        InstanceMarketOptions={'MarketType': 'spot', 'SpotOptions': spot_options},
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}
+                           , {'ResourceType': 'spot-instances-request', 'Tags': tags}],
+        **params
+    )
+
+    return [instance['InstanceId'] for instance in response['Instances']]
+
+
+def start_instances(project_id, instance_ids):
+    """ Starts the project's stopped instances among instance_ids
+    :param project_id:                  Global project id
+    :param instance_ids:                Instance ids
+    """
+    stopped = [instance.instance_id for instance in get_instances(project_id, instance_ids)
+               if instance.state['Name'] == 'stopped']
+    if stopped:
+        client('ec2').start_instances(InstanceIds=stopped)
+
+
+def wait_until_running(instance_ids):
+    """ Blocks until all instances are running
+    :param instance_ids:                Instance ids
+    """
+    if instance_ids:
+        client('ec2').get_waiter('instance_running').wait(InstanceIds=instance_ids)
+
+
+def launch_builder(project_id, launch_spec):
+    """ Launches on-demand instance which builds an image and stops itself when done. Spot instances can't be
+    stopped, so builders aren't launched as spot instances.
+    :param project_id:                  Global project id
+    :param launch_spec:                 EC2 launch specification, with unencoded user data
+    :return:                            Instance id
+    """
+    tags = [{'Key': 'bokchoi-id', 'Value': project_id}]
+
+    response = client('ec2').run_instances(
+        MinCount=1,
+        MaxCount=1,
+        InstanceInitiatedShutdownBehavior='stop',
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}],
+        **launch_spec
+    )
+
+    return response['Instances'][0]['InstanceId']
+
+
+def wait_until_stopped(instance_id, timeout=3600):
+    """ Blocks until instance has stopped
+    :param instance_id:                 Instance id
+    :param timeout:                     Seconds to wait at most
+    """
+    client('ec2').get_waiter('instance_stopped').wait(InstanceIds=[instance_id]
+                                                      , WaiterConfig={'Delay': 15, 'MaxAttempts': timeout // 15})
+
+
+def create_image(project_id, instance_id, image_name, image_hash):
+    """ Creates image from stopped instance and waits until it's available. The image and its snapshots are tagged
+    with the project id and the hash of what's installed on it.
+    :param project_id:                  Global project id
+    :param instance_id:                 Instance id
+    :param image_name:                  Name of image, unique within the account
+    :param image_hash:                  Hash identifying the contents of the image
+    :return:                            Image id
     """
-    response = ec2_client.request_spot_instances(LaunchSpecification=launch_spec
-                                                 , SpotPrice=spot_price)
+    tags = [{'Key': 'bokchoi-id', 'Value': project_id}, {'Key': 'bokchoi-image-hash', 'Value': image_hash}]
 
-    spot_request_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
+    image_id = client('ec2').create_image(InstanceId=instance_id
+                                          , Name=image_name
+                                          , TagSpecifications=[{'ResourceType': 'image', 'Tags': tags}
+                                                               , {'ResourceType': 'snapshot', 'Tags': tags}]
+                                          )['ImageId']
 
-    waiter = ec2_client.get_waiter('spot_instance_request_fulfilled')
-    waiter.wait(SpotInstanceRequestIds=[spot_request_id])
+    client('ec2').get_waiter('image_available').wait(ImageIds=[image_id]
+                                                     , WaiterConfig={'Delay': 15, 'MaxAttempts': 240})
+    return image_id
 
-    ec2_client.create_tags(Resources=[spot_request_id]
-                           , Tags=[{'Key': 'bokchoi-id', 'Value': project_id}])
 
-    response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=[spot_request_id])
-    instance_ids = [request['InstanceId'] for request in response['SpotInstanceRequests']]
+def get_images(project_id, image_ids=None, image_hash=None):
+    """ Returns images made for project, newest first. Images are found by filtering on project_id tag
+    :param project_id:                  Global project id
+    :param image_ids:                   Only consider these images, if known
+    :param image_hash:                  Only return available images with this hash
+    :return:                            List of ec2.Image
+    """
+    filters = [{'Name': 'tag:bokchoi-id', 'Values': [str(project_id)]}]
+
+    if image_ids is not None:
+        if not image_ids:
+            return []
+        filters.append({'Name': 'image-id', 'Values': image_ids})
 
-    ec2_client.create_tags(Resources=instance_ids, Tags=[{'Key': 'bokchoi-id', 'Value': project_id}])
+    if image_hash:
+        filters += [{'Name': 'tag:bokchoi-image-hash', 'Values': [image_hash]}
+                    , {'Name': 'state', 'Values': ['available']}]
+
+    images = resource('ec2').images.filter(Owners=['self'], Filters=filters)
+    return sorted(images, key=lambda image: image.creation_date, reverse=True)
+
+
+def deregister_image(image, dryrun=True):
+    """ Deregisters image and deletes its snapshots
+    :param image:                       ec2.Image
+    :param dryrun:                      If True print image that would be deregistered
+    """
+    if dryrun:
+        print('Dryrun flag set. Would have deregistered image ' + image.image_id)
+        return
+
+    snapshot_ids = [mapping['Ebs']['SnapshotId'] for mapping in image.block_device_mappings or []
+                    if 'SnapshotId' in mapping.get('Ebs', {})]
+
+    image.deregister()
+    for snapshot_id in snapshot_ids:
+        client('ec2').delete_snapshot(SnapshotId=snapshot_id)
+
+    print('Deregistered image ' + image.image_id)
 
 
 def cancel_spot_request(project_id, dryrun):
-    """ Cancels spot instance request. Request is found by filtering on project_id tag.
+    """ Cancels spot instance request. Request is found by filtering on project_id tag. Requests of stopped warm pool
+    instances are disabled rather than active, and would start a new instance if left behind.
     :param project_id:              Global project id
     :param dryrun:                  If true list id's of spot requests to cancel
     """
     print('\nCancelling spot request')
     filters = [{'Name': 'tag:bokchoi-id', 'Values': [str(project_id)]}
-               , {'Name': 'state', 'Values': ['open', 'active']}]
-    response = ec2_client.describe_spot_instance_requests(Filters=filters)
+               , {'Name': 'state', 'Values': ['open', 'active', 'disabled']}]
+    response = client('ec2').describe_spot_instance_requests(Filters=filters)
 
     spot_request_ids = [request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests']]
 
@@ -235,7 +683,7 @@ def cancel_spot_request(project_id, dryrun):
         return
 
     try:
-        ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=spot_request_ids)
+        client('ec2').cancel_spot_instance_requests(SpotInstanceRequestIds=spot_request_ids)
         print('Spot requests cancelled')
     except ClientError as e:
         if e.response['Error']['Code'] == 'InvalidParameterCombination':
@@ -244,14 +692,117 @@ def cancel_spot_request(project_id, dryrun):
             raise e
 
 
-def get_instances(project_id):
+def get_instances(project_id, instance_ids=None):
     """ Returns all instances for project. Instances are found by filtering on project_id tag
     :param project_id:
+    :param instance_ids:            Only consider these instances, if known
     :return:
     """
     filters = [{'Name': 'tag:bokchoi-id', 'Values': [str(project_id)]},
                {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]
-    return list(ec2_resource.instances.filter(Filters=filters))
+
+    if instance_ids is not None:
+        if not instance_ids:
+            return []
+        filters.append({'Name': 'instance-id', 'Values': instance_ids})
+
+    return list(resource('ec2').instances.filter(Filters=filters))
+
+
+def _project_filters(project_ids):
+    """Filters matching resources of projects, in chunks of the number of values EC2 accepts in one filter"""
+    if project_ids is None:
+        return [[{'Name': 'tag-key', 'Values': ['bokchoi-id']}]]
+    project_ids = sorted(project_ids)
+    return [[{'Name': 'tag:bokchoi-id', 'Values': project_ids[start:start + FILTER_VALUES]}]
+            for start in range(0, len(project_ids), FILTER_VALUES)]
+
+
+def describe_project_instances(project_ids=None):
+    """ Returns instances of several projects, fetched page by page in stead of instance by instance
+    :param project_ids:             Project ids, all projects with instances in the account if not given
+    :return:                        Dict mapping project id to list of instance descriptions
+    """
+    paginator = client('ec2').get_paginator('describe_instances')
+    instances = {}
+
+    for filters in _project_filters(project_ids):
+        filters.append({'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']})
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    project_id = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}['bokchoi-id']
+                    instances.setdefault(project_id, []).append(instance)
+
+    return instances
+
+
+def describe_project_spot_requests(project_ids=None):
+    """ Returns open, active and disabled spot requests of several projects
+    :param project_ids:             Project ids, all projects with spot requests in the account if not given
+    :return:                        Dict mapping project id to list of spot request descriptions
+    """
+    paginator = client('ec2').get_paginator('describe_spot_instance_requests')
+    requests = {}
+
+    for filters in _project_filters(project_ids):
+        filters.append({'Name': 'state', 'Values': ['open', 'active', 'disabled']})
+        for page in paginator.paginate(Filters=filters):
+            for request in page['SpotInstanceRequests']:
+                project_id = {tag['Key']: tag['Value'] for tag in request.get('Tags', [])}['bokchoi-id']
+                requests.setdefault(project_id, []).append(request)
+
+    return requests
+
+
+def add_undeploy_tasks(graph, project_id, dryrun, state):
+    """ Adds tasks removing the project's instances, bucket and IAM resources to task graph. Instances are
+    terminated after spot requests are cancelled. Roles are deleted after they have been removed from instance
+    profiles and their policies have been deleted. Resources recorded in the project state are addressed
+    directly, the account is only scanned for projects without state.
+    :param graph:                   TaskGraph
+    :param project_id:              Global project id
+    :param dryrun:                  If True only print resources that would be deleted
+    :param state:                   bokchoi.state.State
+    :return:                        Names of instance termination tasks
+    """
+    spot_task = graph.add('spot-requests', cancel_spot_request, project_id=project_id, dryrun=dryrun)
+
+    instance_tasks = [graph.add('instance:' + instance.instance_id, terminate_instance, spot_task
+                                , instance=instance, dryrun=dryrun)
+                      for instance in get_instances(project_id, state.get('instances'))]
+
+    graph.add('bucket', delete_bucket, project_id=project_id, dryrun=dryrun)
+
+    policy_arns = state.get('policies')
+    if policy_arns is None:
+        policies = get_policies(project_id)
+    else:
+        policies = [resource('iam').Policy(arn) for arn in policy_arns]
+
+    policy_tasks = [graph.add('policy:' + policy.arn.split('/')[-1], delete_policy, policy=policy, dryrun=dryrun)
+                    for policy in policies]
+
+    profile_names = state.get('instance_profiles')
+    if profile_names is None:
+        profiles = get_instance_profiles(project_id)
+    else:
+        profiles = [resource('iam').InstanceProfile(name) for name in profile_names]
+
+    profile_tasks = [graph.add('instance-profile:' + profile.instance_profile_name, delete_instance_profile
+                               , instance_profile=profile, dryrun=dryrun)
+                     for profile in profiles]
+
+    role_names = state.get('roles')
+    if role_names is None:
+        roles = get_roles(project_id)
+    else:
+        roles = [resource('iam').Role(name) for name in role_names]
+
+    for role in roles:
+        graph.add('role:' + role.role_name, delete_role, *(policy_tasks + profile_tasks), role=role, dryrun=dryrun)
+
+    return instance_tasks
 
 
 def terminate_instance(instance, dryrun=True):
@@ -277,7 +828,7 @@ def delete_bucket(project_id, dryrun=True):
     """
     print('\nDelete Bucket')
 
-    bucket = s3_resource.Bucket(project_id)
+    bucket = resource('s3').Bucket(project_id)
 
     if dryrun:
         print('Dryrun flag set. Would have deleted bucket ' + bucket.name)
@@ -297,7 +848,7 @@ def get_instance_profiles(project_id):
     """ Yields all instance profiles associated with deployment
     :param project_id:              Global project id
     """
-    for instance_profile in iam_resource.instance_profiles.all():
+    for instance_profile in resource('iam').instance_profiles.all():
         if project_id in instance_profile.instance_profile_name:
             yield instance_profile
 
@@ -339,7 +890,7 @@ def get_roles(project_id):
     :param project_id:              Global project id
     :return:                        IAM role
     """
-    for role in iam_resource.roles.all():
+    for role in resource('iam').roles.all():
         if project_id in role.role_name:
             yield role
 
@@ -385,7 +936,7 @@ def get_policies(project_id, pattern=None):
 
     policies = []
 
-    for policy in iam_resource.policies.filter(Scope='Local'):
+    for policy in resource('iam').policies.filter(Scope='Local'):
 
         policy_name = policy.policy_name
 
@@ -435,7 +986,7 @@ def delete_policy(policy, dryrun):
 def create_log_group(log_group_name):
 
     try:
-        logs_client.create_log_group(
+        client('logs').create_log_group(
             logGroupName=log_group_name
         )
         print('Created log group ' + log_group_name)
@@ -447,15 +998,28 @@ def create_log_group(log_group_name):
 
 
 def create_log_stream(log_group_name, log_stream_name):
-    logs_client.create_log_stream(
+    client('logs').create_log_stream(
+        logGroupName=log_group_name
+        , logStreamName=log_stream_name
+    )
+
+
+def put_log_message(log_group_name, log_stream_name, message):
+    """ Logs a single message
+    :param log_group_name:          Log group name
+    :param log_stream_name:         Log stream name
+    :param message:                 Message
+    """
+    client('logs').put_log_events(
         logGroupName=log_group_name
         , logStreamName=log_stream_name
+        , logEvents=[{'timestamp': int(1000 * time.time()), 'message': message}]
     )
 
 
 def get_most_recent_log_stream(log_group_name):
     try:
-        response = logs_client.describe_log_streams(
+        response = client('logs').describe_log_streams(
             logGroupName=log_group_name,
             orderBy='LogStreamName',
             descending=True,
@@ -477,23 +1041,77 @@ def get_most_recent_log_stream(log_group_name):
     return log_stream['logStreamName']
 
 
-def get_log_messages(log_group_name, log_stream_name, next_token=None):
+def list_project_log_groups():
+    """Returns names of all log groups in the account named after a project id"""
+    paginator = client('logs').get_paginator('describe_log_groups')
+    return [group['logGroupName']
+            for page in paginator.paginate(logGroupNamePrefix='bokchoi-')
+            for group in page['logGroups'] if utils.parse_project_id(group['logGroupName'])]
+
 
+def describe_latest_log_stream(log_group_name):
+    """ Returns description of the log stream of the latest run
+    :param log_group_name:          Log group name
+    :return:                        Log stream description, or None if there are no runs
+    """
+    try:
+        response = client('logs').describe_log_streams(logGroupName=log_group_name
+                                                       , orderBy='LogStreamName'
+                                                       , descending=True
+                                                       , limit=1)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise e
+
+    return next(iter(response['logStreams']), None)
+
+
+def get_log_tail(log_group_name, log_stream_name, limit):
+    """ Returns the last messages of a log stream
+    :param log_group_name:          Log group name
+    :param log_stream_name:         Log stream name
+    :param limit:                   Number of messages to return
+    :return:                        List of log events, oldest first
+    """
+    response = client('logs').get_log_events(
+        logGroupName=log_group_name,
+        logStreamName=log_stream_name,
+        startFromHead=False,
+        limit=limit
+    )
+    return response['events']
+
+
+def filter_log_messages(log_group_name, log_stream_name, start_time=None, filter_pattern=None):
+    """ Returns all messages currently available in log stream, filtered server-side. Fetches pages until
+    Cloudwatch has no more to give.
+    :param log_group_name:          Log group name
+    :param log_stream_name:         Log stream name
+    :param start_time:              Only return messages at or after this time (ms since epoch)
+    :param filter_pattern:          Cloudwatch filter pattern
+    :return:                        List of log events, oldest first
+    """
     log_request = {
         'logGroupName': log_group_name,
-        'logStreamName': log_stream_name
+        'logStreamNames': [log_stream_name]
     }
 
-    if next_token:
-        log_request['nextToken'] = next_token
+    if start_time is not None:
+        log_request['startTime'] = start_time
+    if filter_pattern:
+        log_request['filterPattern'] = filter_pattern
 
-    response = logs_client.get_log_events(
-        **log_request
-    )
+    events = []
+
+    while True:
+        response = client('logs').filter_log_events(**log_request)
+        events += response['events']
 
-    next_token = response['nextForwardToken'] if response['events'] else next_token
+        if not response.get('nextToken'):
+            return events
 
-    return response['events'], next_token
+        log_request['nextToken'] = response['nextToken']
 
 
 def delete_log_group(log_group_name, dryrun=True):
@@ -503,7 +1121,7 @@ def delete_log_group(log_group_name, dryrun=True):
         return
 
     try:
-        logs_client.delete_log_group(
+        client('logs').delete_log_group(
             logGroupName=log_group_name
         )
         print('Deleted log group ' + log_group_name)
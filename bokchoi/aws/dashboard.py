@@ -0,0 +1,103 @@
+"""
+Status of several projects in one table. Instances and spot requests of all projects are fetched with one paginated
+call each; the latest log stream and the deployed package, which can only be looked up per project, are fetched
+concurrently.
+"""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bokchoi import utils
+from bokchoi.aws import common
+
+STATUS_CONCURRENCY = 16
+
+COLUMNS = ['project', 'instances', 'spot requests', 'latest run', 'last log', 'package', 'deployed']
+
+
+def collect(project_ids=None):
+    """ Fetches status of projects
+    :param project_ids:             Project ids. If not given, projects are discovered from the buckets, log groups,
+                                    instances and spot requests in the account
+    :return:                        List of status dicts, ordered by project id
+    """
+    with ThreadPoolExecutor(STATUS_CONCURRENCY) as executor:
+        instances = executor.submit(common.describe_project_instances, project_ids)
+        requests = executor.submit(common.describe_project_spot_requests, project_ids)
+
+        if project_ids is None:
+            buckets = executor.submit(common.list_project_buckets)
+            log_groups = executor.submit(common.list_project_log_groups)
+            buckets, log_groups = set(buckets.result()), set(log_groups.result())
+            project_ids = buckets | log_groups | set(instances.result()) | set(requests.result())
+        else:
+            buckets = log_groups = set(project_ids)
+
+        streams = {project_id: executor.submit(common.describe_latest_log_stream, project_id)
+                   for project_id in project_ids if project_id in log_groups}
+        packages = {project_id: executor.submit(common.get_object_metadata, project_id, package_key(project_id))
+                    for project_id in project_ids if project_id in buckets}
+
+        return [{'project_id': project_id,
+                 'instances': instances.result().get(project_id, []),
+                 'spot_requests': requests.result().get(project_id, []),
+                 'log_stream': streams[project_id].result() if project_id in streams else None,
+                 'package': packages[project_id].result() if project_id in packages else None}
+                for project_id in sorted(project_ids)]
+
+
+def package_key(project_id):
+    """Key of the package deployed to the project bucket"""
+    return 'bokchoi-' + utils.parse_project_id(project_id) + '.zip'
+
+
+def format_row(status):
+    """ Formats status of project as table cells
+    :param status:                  Status dict returned by collect
+    :return:                        List of strings, one per column
+    """
+    instances = Counter(instance['State']['Name'] for instance in status['instances'])
+    requests = Counter(request['State'] for request in status['spot_requests'])
+
+    latest_run = last_log = package = deployed = '-'
+
+    log_stream = status['log_stream']
+    if log_stream:
+        # Log streams are named after the time the run started, e.g. bokchoi-1528100000
+        started = log_stream['logStreamName'].rpartition('-')[2]
+        latest_run = _format_time(int(started)) if started.isdigit() else log_stream['logStreamName']
+        if 'lastEventTimestamp' in log_stream:
+            last_log = _format_time(log_stream['lastEventTimestamp'] / 1000)
+
+    if status['package']:
+        metadata, modified = status['package']
+        package = metadata.get('fingerprint', '?')[:12]
+        deployed = _format_time(modified.timestamp())
+
+    return [utils.parse_project_id(status['project_id'])
+            , ', '.join('{} {}'.format(count, state) for state, count in sorted(instances.items())) or '-'
+            , ', '.join('{} {}'.format(count, state) for state, count in sorted(requests.items())) or '-'
+            , latest_run
+            , last_log
+            , package
+            , deployed]
+
+
+def format_table(statuses):
+    """ Formats status of projects as a table with a row per project
+    :param statuses:                Status dicts returned by collect
+    :return:                        Table
+    """
+    if not statuses:
+        return 'No projects found'
+
+    rows = [COLUMNS] + [format_row(status) for status in statuses]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(COLUMNS))]
+
+    return '\n'.join('  '.join('{:<{}}'.format(cell, width) for cell, width in zip(row, widths)).rstrip()
+                     for row in rows)
+
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
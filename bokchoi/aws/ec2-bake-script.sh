@@ -0,0 +1,56 @@
+#!/bin/bash
+
+# Runs on the builder instance of 'bokchoi bake'. Installs everything the startup script would install on every
+# run, then stops the instance so it can be turned into an image.
+
+export REGION={region}
+
+STATE_DIR=/var/lib/bokchoi
+
+# Install aws-cli and pip3
+sudo curl "https://s3.amazonaws.com/aws-cli/awscli-bundle.zip" -o "awscli-bundle.zip"
+python3 -c "import zipfile; zf = zipfile.ZipFile('/awscli-bundle.zip'); zf.extractall('/');"
+sudo chmod u+x /awscli-bundle/install
+python3 /awscli-bundle/install -i /usr/local/aws -b /usr/local/bin/aws
+
+curl -sS https://bootstrap.pypa.io/get-pip.py | sudo python3
+
+cat > /tmp/requirements.txt <<'REQUIREMENTS'
+{requirements}
+REQUIREMENTS
+
+# Requirements are installed from the project's wheelhouse, which is built here if it doesn't exist yet
+WHEELHOUSE=s3://{bucket}/{wheelhouse}
+mkdir -p /tmp/wheelhouse
+if aws s3 cp $WHEELHOUSE /tmp/wheelhouse.tar.gz
+then
+    tar -xzf /tmp/wheelhouse.tar.gz -C /tmp/wheelhouse
+else
+    pip3 wheel -r /tmp/requirements.txt boto3 -w /tmp/wheelhouse \
+        && tar -czf /tmp/wheelhouse.tar.gz -C /tmp/wheelhouse . \
+        && aws s3 cp /tmp/wheelhouse.tar.gz $WHEELHOUSE.$(hostname).tmp \
+        && aws s3 mv $WHEELHOUSE.$(hostname).tmp $WHEELHOUSE
+fi
+
+# Same steps as install_jupyter in the startup script. Tornado is pinned after Jupyter is installed, the pin conflicts
+# with what Jupyter itself requires.
+install_jupyter() {{
+    pip3 install jupyter \
+        && pip3 install jupyterlab \
+        && jupyter serverextension enable --py jupyterlab --sys-prefix \
+        && pip3 install tornado==4.5.2
+}}
+
+if pip3 install --no-index --find-links /tmp/wheelhouse -r /tmp/requirements.txt boto3 \
+    && {{ [ "{notebook}" != "True" ] || install_jupyter; }}
+then
+    # Instances launched from the image skip setup, and installing requirements if the image hash matches
+    mkdir -p $STATE_DIR
+    touch $STATE_DIR/setup-done
+    echo "{image_hash}" > $STATE_DIR/image-hash
+
+    rm -rf /tmp/wheelhouse /tmp/wheelhouse.tar.gz /awscli-bundle /awscli-bundle.zip
+    echo done | aws s3 cp - s3://{bucket}/{marker}
+fi
+
+shutdown -h now
@@ -3,50 +3,211 @@
 export REGION={region}
 export BOKCHOI_PROJECT_ID={project_id}
 
-# Install aws-cli
-sudo curl "https://s3.amazonaws.com/aws-cli/awscli-bundle.zip" -o "awscli-bundle.zip"
-python3 -c "import zipfile; zf = zipfile.ZipFile('/awscli-bundle.zip'); zf.extractall('/');"
-sudo chmod u+x /awscli-bundle/install
-python3 /awscli-bundle/install -i /usr/local/aws -b /usr/local/bin/aws
+WARM_POOL={warm_pool}
+IDLE_SECONDS={idle_seconds}
+STATE_DIR=/var/lib/bokchoi
+PER_BOOT_SCRIPT=/var/lib/cloud/scripts/per-boot/bokchoi.sh
+TRACE_FILE=/tmp/bokchoi-trace
 
-# Download project zip
-aws s3 cp s3://{bucket}/{package} /tmp/
-python3 -c "import zipfile; zf = zipfile.ZipFile('/tmp/{package}'); zf.extractall('/tmp/');"
+# Settings of the run the instance is launched for. The dispatch of every run sets them again, so instances reused
+# from the warm pool run with the settings of the current run.
+ENTRYPOINT={entrypoint}
+WHEELHOUSE_KEY={wheelhouse_key}
+IMAGE_HASH={image_hash}
+NOTEBOOK={notebook}
+PUBLIC_KEY={public_key}
 
-# Make cloudwatch logger executable and fix line endings
-sudo chmod u+x /tmp/cloudwatch_logger.py
-sed -i $'s/\\r$//' /tmp/cloudwatch_logger.py    # Convert Windows line endings to unix
+# Times a command and keeps the span until the logger is available: span NAME COMMAND [ARGS...]
+span() {{
+    local NAME=$1
+    shift
+    local START=$(date +%s.%N)
+    "$@"
+    local STATUS=$?
+    echo "$NAME $START $(date +%s.%N)" >> $TRACE_FILE
+    return $STATUS
+}}
 
-echo "Downloaded and unpacked project zip" | /tmp/cloudwatch_logger.py bokchoi
+# Logs spans to the log stream of the run, where 'bokchoi trace' picks them up
+flush_trace() {{
+    if [ -s $TRACE_FILE ]
+    then
+        /tmp/cloudwatch_logger.py trace < $TRACE_FILE && rm -f $TRACE_FILE
+    fi
+}}
+
+# Time from kernel start to this script
+BOOTED=$(python3 -c "import time; print(time.time() - float(open('/proc/uptime').read().split()[0]))")
+echo "boot $BOOTED $(date +%s.%N)" >> $TRACE_FILE
+
+# User data only runs on first boot. Warm pool instances are stopped when idle, so install this script to run on
+# every boot, picking up new runs when the instance is started again.
+if [ "$WARM_POOL" = "True" ] && [ "$0" != "$PER_BOOT_SCRIPT" ]
+then
+    mkdir -p $(dirname $PER_BOOT_SCRIPT)
+    cp "$0" $PER_BOOT_SCRIPT
+    chmod +x $PER_BOOT_SCRIPT
+fi
+
+TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 300")
+INSTANCE_ID=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/instance-id)
 
-# Install pip3 and install requirements.txt from project zip if included
-curl -sS https://bootstrap.pypa.io/get-pip.py | sudo python3
-[ -f /tmp/requirements.txt ] && pip3 install -r /tmp/requirements.txt && pip3 install boto3
+install_aws_cli() {{
+    sudo curl "https://s3.amazonaws.com/aws-cli/awscli-bundle.zip" -o "awscli-bundle.zip"
+    python3 -c "import zipfile; zf = zipfile.ZipFile('/awscli-bundle.zip'); zf.extractall('/');"
+    sudo chmod u+x /awscli-bundle/install
+    python3 /awscli-bundle/install -i /usr/local/aws -b /usr/local/bin/aws
+}}
 
-echo "Installed requirements" | /tmp/cloudwatch_logger.py bokchoi
+install_pip() {{
+    curl -sS https://bootstrap.pypa.io/get-pip.py | sudo python3
+}}
 
-if [ "{notebook}" = "True" ]
+# Install aws-cli and pip3, once per instance
+if [ ! -f $STATE_DIR/setup-done ]
 then
-    #Add public key
-    echo "ssh-rsa {public_key}" >> /home/ubuntu/.ssh/authorized_keys
-    #Install Jupyter
+    span aws-cli install_aws_cli
+    span pip install_pip
+
+    mkdir -p $STATE_DIR
+    touch $STATE_DIR/setup-done
+fi
+
+# Only a complete wheelhouse is uploaded. It's uploaded under a temporary key first, so other instances never
+# download a partial upload.
+build_wheelhouse() {{
+    pip3 wheel -r /tmp/requirements.txt boto3 -w /tmp/wheelhouse \
+        && tar -czf /tmp/wheelhouse.tar.gz -C /tmp/wheelhouse . \
+        && aws s3 cp /tmp/wheelhouse.tar.gz $1.$INSTANCE_ID.tmp \
+        && aws s3 mv $1.$INSTANCE_ID.tmp $1
+}}
+
+install_jupyter() {{
     pip3 install jupyter
     pip3 install jupyterlab
     jupyter serverextension enable --py jupyterlab --sys-prefix
     pip3 install tornado==4.5.2
-    echo "c.NotebookApp.token = u''" >> ~/.jupyter/jupyter_notebook_config.py
-    jupyter lab --no-browser --allow-root --ip=0.0.0.0 --port=8888 --NotebookApp.token=
-else
-    # Run app
-    cd /tmp
+}}
+
+run_app() {{
+    python3 -u $ENTRYPOINT | /tmp/cloudwatch_logger.py app
+}}
+
+run_job() {{
+    # Images made by 'bokchoi bake' come with all of this installed
+    BAKED=
+    if [ "$(cat $STATE_DIR/image-hash 2>/dev/null)" = "$IMAGE_HASH" ]
+    then
+        BAKED=True
+    fi
+
+    # Download project zip
+    span download aws s3 cp s3://{bucket}/{package} /tmp/
+    span extract python3 -c "import zipfile; zf = zipfile.ZipFile('/tmp/{package}'); zf.extractall('/tmp/');"
 
-    echo "Running app" | /tmp/cloudwatch_logger.py bokchoi
+    # Make cloudwatch logger executable and fix line endings
+    sudo chmod u+x /tmp/cloudwatch_logger.py
+    sed -i $'s/\\r$//' /tmp/cloudwatch_logger.py    # Convert Windows line endings to unix
 
-    python3 -u {entrypoint} | ./cloudwatch_logger.py app
-    aws s3 cp /var/log/cloud-init-output.log s3://{bucket}/cloud-init-output.log
+    echo "Downloaded and unpacked project zip" | /tmp/cloudwatch_logger.py bokchoi
 
-    echo "Finished running app" | /tmp/cloudwatch_logger.py bokchoi
+    # Install requirements.txt from project zip if included. Requirements are installed from a wheelhouse stored
+    # in the project bucket. The first instance to run with a new set of requirements builds it.
+    if [ -f /tmp/requirements.txt ] && [ -z "$BAKED" ]
+    then
+        WHEELHOUSE=s3://{bucket}/$WHEELHOUSE_KEY
+        mkdir -p /tmp/wheelhouse
+        if span wheelhouse-download aws s3 cp $WHEELHOUSE /tmp/wheelhouse.tar.gz
+        then
+            tar -xzf /tmp/wheelhouse.tar.gz -C /tmp/wheelhouse
+            echo "Downloaded requirements wheelhouse" | /tmp/cloudwatch_logger.py bokchoi
+        else
+            span wheelhouse-build build_wheelhouse $WHEELHOUSE
+            echo "Built requirements wheelhouse" | /tmp/cloudwatch_logger.py bokchoi
+        fi
+        span pip-install pip3 install --no-index --find-links /tmp/wheelhouse -r /tmp/requirements.txt boto3
+    fi
 
+    echo "Installed requirements" | /tmp/cloudwatch_logger.py bokchoi
+
+    if [ "$NOTEBOOK" = "True" ]
+    then
+        #Add public key
+        echo "ssh-rsa $PUBLIC_KEY" >> /home/ubuntu/.ssh/authorized_keys
+        #Install Jupyter
+        if [ -z "$BAKED" ]
+        then
+            span jupyter-install install_jupyter
+        fi
+        echo "c.NotebookApp.token = u''" >> ~/.jupyter/jupyter_notebook_config.py
+        flush_trace
+        jupyter lab --no-browser --allow-root --ip=0.0.0.0 --port=8888 --NotebookApp.token=
+    else
+        # Run app
+        cd /tmp
+
+        echo "Running app" | /tmp/cloudwatch_logger.py bokchoi
+
+        span app run_app
+        span upload-log aws s3 cp /var/log/cloud-init-output.log s3://{bucket}/cloud-init-output.log
+        flush_trace
+
+        echo "Finished running app" | /tmp/cloudwatch_logger.py bokchoi
+    fi
+}}
+
+# Runs are dispatched through an object holding the run id, shard index, shard count and matrix parameters of this
+# instance, and the settings of the run. It's uploaded once the instance has been launched or picked from the warm pool.
+DISPATCH=s3://{bucket}/{shards}$INSTANCE_ID.env
+
+if [ "$WARM_POOL" = "True" ]
+then
+    # Wait for runs until the instance has been idle for IDLE_SECONDS, then stop it. The idle marker tells bokchoi
+    # run that this instance can take another run.
+    IDLE_SINCE=$(date +%s)
+    MARKED_IDLE=
+    while true
+    do
+        if aws s3 cp $DISPATCH /tmp/shard.env --quiet && source /tmp/shard.env \
+            && [ "$BOKCHOI_RUN_ID" != "$(cat $STATE_DIR/last-run 2>/dev/null)" ]
+        then
+            echo "$BOKCHOI_RUN_ID" > $STATE_DIR/last-run
+            run_job
+            echo "log-termination" | /tmp/cloudwatch_logger.py bokchoi
+            IDLE_SINCE=$(date +%s)
+            MARKED_IDLE=
+        elif [ $(( $(date +%s) - IDLE_SINCE )) -ge $IDLE_SECONDS ]
+        then
+            shutdown -h now
+            exit
+        else
+            if [ -z "$MARKED_IDLE" ]
+            then
+                echo $IDLE_SINCE | aws s3 cp - s3://{bucket}/{pool}$INSTANCE_ID && MARKED_IDLE=1
+            fi
+            sleep 5
+        fi
+    done
+fi
+
+# Wait up to five minutes for the run to be dispatched
+wait_for_dispatch() {{
+    for attempt in $(seq 150)
+    do
+        aws s3 cp $DISPATCH /tmp/shard.env && return
+        sleep 2
+    done
+}}
+span dispatch wait_for_dispatch
+if [ -f /tmp/shard.env ]
+then
+    source /tmp/shard.env
+fi
+
+run_job
+
+if [ "$NOTEBOOK" != "True" ]
+then
     if [ "{shutdown}" = "True" ]
     then
         echo "Shutting down..." | /tmp/cloudwatch_logger.py bokchoi
@@ -55,5 +216,4 @@ else
     fi
 
     echo "log-termination" | /tmp/cloudwatch_logger.py end
-
-fi
\ No newline at end of file
+fi
@@ -4,12 +4,22 @@ Class which can be used to deploy and run EC2 spot instances
 """
 
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 import os
+from shlex import quote
+import socket
+import sys
 import time
 
-from bokchoi import utils
-from bokchoi.ssh import SSH
-from bokchoi.aws import common
+from botocore.exceptions import ClientError
+
+from bokchoi import control, trace, utils
+from bokchoi.cache import PackageCache
+from bokchoi.state import State
+from bokchoi.taskgraph import TaskGraph
+from bokchoi.aws import common, dashboard
 
 DEFAULT_TRUST_POLICY = """{
   "Version": "2012-10-17",
@@ -48,10 +58,28 @@ DEFAULT_POLICY = """{{
 }}"""
 
 
+SHARD_PREFIX = 'shards/'
+POOL_PREFIX = 'pool/'
+BAKE_PREFIX = 'bake/'
+
+DEFAULT_IDLE_MINUTES = 10
+# Idle instances this close to stopping aren't handed new runs
+IDLE_MARGIN = 30
+
+LAUNCH_CONCURRENCY = 8
+# Fleets can start fewer instances than asked for. Missing instances are launched again this many times.
+LAUNCH_RETRIES = 1
+
+# Logged by run with the number of instances it started, e.g. '[bokchoi]: run-instances 4'
+RUN_INSTANCES = 'run-instances'
+
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 10
+
+
 class EC2:
     """Create EC2 object which can be used to schedule jobs"""
 
-    region = common.get_default_region()
 
     default_config = {
             'SpotPrice': '0.10',
@@ -69,11 +97,69 @@ class EC2:
         self.config = config
 
         self.launch_spec = config['EC2']['LaunchSpecification']
-        self.subnet = common.get_subnet(self.launch_spec['SubnetId'])
+        # Runs may swap in a baked image, hashes are based on the configured one
+        self.base_image_id = self.launch_spec['ImageId']
 
-        self.project_id = utils.create_project_id(project_name, common.get_aws_account_id())
+        self.project_name = project_name
         self.package_name = 'bokchoi-' + project_name + '.zip'
 
+    @utils.lazy_property
+    def region(self):
+        return common.get_default_region()
+
+    @utils.lazy_property
+    def project_id(self):
+        return utils.create_project_id(self.project_name, common.get_aws_account_id())
+
+    @utils.lazy_property
+    def vpc_id(self):
+        return common.get_vpc_id(self.launch_spec['SubnetId'])
+
+    @property
+    def instance_count(self):
+        """Number of instances in a run: InstanceCount for each point of the parameter matrix"""
+        return self.config['EC2'].get('InstanceCount', 1) * len(utils.expand_matrix(self.config['EC2'].get('Matrix')))
+
+    @property
+    def idle_seconds(self):
+        """Seconds instances stay idle before they're stopped when WarmPool is enabled, otherwise None"""
+        warm_pool = self.config['EC2'].get('WarmPool')
+        if not warm_pool:
+            return None
+        if warm_pool is True:
+            warm_pool = {}
+        return int(warm_pool.get('IdleMinutes', DEFAULT_IDLE_MINUTES) * 60)
+
+    def warm_instances(self):
+        """ Returns instances of the warm pool that can take a new run: stopped instances and running instances which
+        have finished their last run and won't stop before picking up the next one
+        :return:                    Instance ids, running instances first
+        """
+        idle_markers = common.list_objects(self.project_id, POOL_PREFIX)
+        dispatches = common.list_objects(self.project_id, SHARD_PREFIX)
+        now = datetime.now(timezone.utc)
+
+        running, stopped = [], []
+
+        for instance in common.get_instances(self.project_id, self.state.get('instances')):
+            instance_id = instance.instance_id
+            if instance.state['Name'] == 'stopped':
+                stopped.append(instance_id)
+            elif instance.state['Name'] == 'running':
+                idle_since = idle_markers.get(POOL_PREFIX + instance_id)
+                dispatched = dispatches.get(shard_key(instance_id))
+                if not idle_since or (dispatched and dispatched >= idle_since):
+                    continue
+                if (now - idle_since).total_seconds() < self.idle_seconds - IDLE_MARGIN:
+                    running.append(instance_id)
+
+        return running + stopped
+
+    @utils.lazy_property
+    def state(self):
+        mirror = common.S3Mirror(self.project_id, common.STATE_KEY) if self.config.get('MirrorState') else None
+        return State(self.config.path, mirror)
+
     def validate(self, config):
 
         non_optional = {'SpotPrice', 'LaunchSpecification'}
@@ -85,89 +171,338 @@ class EC2:
     def deploy(self, path):
         """Zip package and deploy to S3"""
 
-        bucket_name = common.create_bucket(self.region, self.project_id)
-
-        package, fingerprint = utils.zip_package(path, self.config.get('Requirements', []))
-        common.upload_to_s3(bucket_name, package, self.package_name, fingerprint)
+        tracer = trace.Tracer('deploy-{}'.format(int(time.time())), os.path.join(self.config.path, trace.TRACE_FILE))
+        try:
+            with tracer.span('deploy'):
+                self._deploy(path, tracer)
+        finally:
+            tracer.save()
 
-        policies = self.create_policies(self.config['EC2'].get('CustomPolicy'))
+        if common.object_exists(self.project_id, utils.wheelhouse_key(self.requirements_hash())):
+            print('Requirements wheelhouse is up to date')
+        else:
+            print('Requirements wheelhouse will be built on first run')
 
-        self.create_default_role_and_profile(policies)
+        return 'Deployed!'
 
-        common.create_security_group(self.project_id
-                                     , self.project_id
-                                     , self.subnet.vpc_id
-                                     , {'CidrIp': utils.get_my_ip() + '/32'
-                                        , 'FromPort': 22
-                                        , 'ToPort': 22
-                                        , 'IpProtocol': 'tcp'}
-                                     )
+    def _deploy(self, path, tracer):
+
+        with tracer.span('bucket'):
+            bucket_name = common.create_bucket(self.region, self.project_id)
+
+        requirements = self.config.get('Requirements', [])
+        cache = PackageCache()
+
+        with tracer.span('manifest'):
+            files, fingerprint = utils.package_manifest(path, requirements, cache, self.config.get('Exclude'))
+
+        # The package is zipped while it's being uploaded
+        with tracer.span('package-upload'):
+            common.upload_to_s3(bucket_name
+                                , self.package_name
+                                , fingerprint
+                                , partial(utils.write_package, files=files, requirements=requirements, cache=cache)
+                                , **utils.upload_options(self.config))
+
+        with tracer.span('iam'):
+            policies = self.create_policies(self.config['EC2'].get('CustomPolicy'))
+            self.state.add('policies', *[policy.arn for policy in policies])
+
+            self.create_default_role_and_profile(policies)
+            self.state.add('roles', self.project_id)
+            self.state.add('instance_profiles', self.project_id)
+
+        with tracer.span('security-group'):
+            group = common.create_security_group(self.project_id
+                                                 , self.project_id
+                                                 , self.vpc_id
+                                                 , {'CidrIp': utils.get_my_ip() + '/32'
+                                                    , 'FromPort': 22
+                                                    , 'ToPort': 22
+                                                    , 'IpProtocol': 'tcp'}
+                                                 )
+            self.state.add('security_groups', group.group_id)
+
+        with tracer.span('log-group'):
+            common.create_log_group(self.project_id)
+
+        # Instances and images made before the project had state, or from a machine without the mirror, are only
+        # found by their tags. Record them once, stop and undeploy don't scan for them anymore after this
+        if not self.state.exists:
+            with tracer.span('state'):
+                instances = common.get_instances(self.project_id)
+                self.state.add('instances', *[instance.instance_id for instance in instances])
+                self.state.add('images', *[image.image_id for image in common.get_images(self.project_id)])
+
+        self.state.save(create=True)
 
-        common.create_log_group(self.project_id)
+    def undeploy(self, dryrun):
+        """Deletes all policies, users, and instances permanently. Resources that don't depend on each other are
+        deleted concurrently."""
 
-        return 'Deployed!'
+        graph = TaskGraph()
 
-    def undeploy(self, dryrun):
-        """Deletes all policies, users, and instances permanently"""
+        instance_tasks = common.add_undeploy_tasks(graph, self.project_id, dryrun, self.state)
 
-        common.cancel_spot_request(self.project_id, dryrun)
+        group_ids = self.state.get('security_groups')
+        if group_ids is None:
+            groups = common.get_security_groups(self.project_id)
+        else:
+            groups = [common.resource('ec2').SecurityGroup(group_id) for group_id in group_ids]
 
-        for instance in common.get_instances(self.project_id):
-            common.terminate_instance(instance, dryrun)
+        for group in groups:
+            graph.add('security-group:' + group.group_id, common.delete_security_group, *instance_tasks
+                      , group=group, dryrun=dryrun)
 
-        common.delete_bucket(self.project_id, dryrun)
+        graph.add('log-group', common.delete_log_group, log_group_name=self.project_id, dryrun=dryrun)
 
-        for policy in common.get_policies(self.project_id):
-            common.delete_policy(policy, dryrun)
+        for image in common.get_images(self.project_id, self.state.get('images')):
+            graph.add('image:' + image.image_id, common.deregister_image, image=image, dryrun=dryrun)
 
-        for instance_profile in common.get_instance_profiles(self.project_id):
-            common.delete_instance_profile(instance_profile, dryrun)
+        # The launch template is named after the project, so it's cheap to try for projects without state
+        for template_name in self.state.get('launch_templates') or [self.project_id]:
+            graph.add('launch-template:' + template_name, common.delete_launch_template
+                      , template_name=template_name, dryrun=dryrun)
 
-        for role in common.get_roles(self.project_id):
-            common.delete_role(role, dryrun)
+        failed = graph.run()
 
-        for group in common.get_security_groups(self.project_id):
-            common.delete_security_group(group, dryrun)
+        if failed:
+            return 'Undeploy failed for: ' + ', '.join('{} ({})'.format(name, error) for name, error in failed.items())
 
-        common.delete_log_group(self.project_id, dryrun)
+        if not dryrun:
+            self.state.delete()
 
         return 'Undeployed!'
 
-    def run(self):
-        """Create EC2 machine with given AMI and instance settings"""
+    def run(self, wait=False):
+        """ Create EC2 machines with given AMI and instance settings. Returns once the instances have been requested.
+        :param wait:                Wait until all instances are running
+        """
+        # The log stream doubles as run id. Instances get it as BOKCHOI_RUN_ID and log their spans to it.
+        log_stream_name = 'bokchoi-{}'.format(int(time.time()))
+
+        tracer = trace.Tracer(log_stream_name, os.path.join(self.config.path, trace.TRACE_FILE))
+        try:
+            with tracer.span('run'):
+                return self._run(log_stream_name, tracer, wait)
+        finally:
+            tracer.save()
 
-        public_key = SSH(self.project_id).public_key if self.config.get('Notebook') else ''
+    def _run(self, log_stream_name, tracer, wait):
 
+        public_key = ''
         if self.config.get('Notebook'):
-            security_group = common.get_security_groups(self.project_id, self.project_id)[0]
+            from bokchoi.ssh import SSH
+            public_key = SSH(self.project_id).public_key
+
+        if self.config.get('Notebook'):
+            group_ids = self.state.get('security_groups')
+            if not group_ids:
+                group_ids = [common.get_security_groups(self.project_id, self.project_id)[0].group_id]
             if self.launch_spec.get('SecurityGroupIds'):
-                self.launch_spec['SecurityGroupIds'] += [security_group.group_id]
+                self.launch_spec['SecurityGroupIds'] += group_ids[:1]
             else:
-                self.launch_spec['SecurityGroupIds'] = [security_group.group_id]
+                self.launch_spec['SecurityGroupIds'] = group_ids[:1]
 
         with open(os.path.join(os.path.dirname(__file__), 'ec2-startup-script.sh'), 'r') as _file:
             startup_script = _file.read()
 
+        run_settings = self.run_settings(public_key)
+
         user_data = startup_script.format(region=self.region
                                           , project_id=self.project_id
                                           , bucket=self.project_id
                                           , package=self.package_name
-                                          , entrypoint=self.config['EntryPoint']
+                                          , shards=SHARD_PREFIX
+                                          , pool=POOL_PREFIX
+                                          , warm_pool=self.idle_seconds is not None
+                                          , idle_seconds=self.idle_seconds or 0
                                           , shutdown=self.config.get('Shutdown', True)
-                                          , notebook=self.config.get('Notebook', False)
-                                          , public_key=public_key)
+                                          , **{name: quote(str(value)) for name, value in run_settings.items()})
 
         self.launch_spec['UserData'] = b64encode(user_data.encode('ascii')).decode('ascii')
         self.launch_spec['IamInstanceProfile'] = {'Name': self.project_id}
 
-        common.request_spot_instances(self.project_id, self.launch_spec, self.config['EC2']['SpotPrice'])
+        # Projects that never baked an image don't have to look for one
+        image_ids = self.state.get('images')
+        if image_ids is None or image_ids:
+            with tracer.span('image-lookup'):
+                images = common.get_images(self.project_id, image_ids, self.image_hash())
+            if images:
+                self.launch_spec['ImageId'] = images[0].image_id
+                print('Using baked image: ' + images[0].image_id)
+
+        points = utils.expand_matrix(self.config['EC2'].get('Matrix'))
+        shard_count = self.config['EC2'].get('InstanceCount', 1)
+
+        # Instances log to the most recent stream, so it has to exist before they boot
+        with tracer.span('log-stream'):
+            common.create_log_stream(self.project_id, log_stream_name)
+
+        total = shard_count * len(points)
+        shards = {}
+        reused = []
+
+        if self.idle_seconds is not None:
+            with tracer.span('warm-pool'):
+                reused = self.warm_instances()[:total]
+            shards.update(zip(reused, range(total)))
+            if reused:
+                print('Reusing {} warm instance(s)'.format(len(reused)))
+
+        # Indexes of instances still to be launched, by matrix point
+        missing = {}
+        for index in range(len(shards), total):
+            missing.setdefault(index // shard_count, []).append(index)
+
+        if self.config['EC2'].get('InstanceTypes'):
+            strategy = self.config['EC2'].get('AllocationStrategy', 'capacity-optimized')
+            with tracer.span('launch-template'):
+                overrides = common.fleet_overrides(self.config['EC2']['InstanceTypes']
+                                                   , self.config['EC2'].get('Subnets')
+                                                   or [self.launch_spec['SubnetId']]
+                                                   , self.config['EC2'].get('SpotPrice')
+                                                   , strategy)
+                launch_template = common.put_launch_template(self.project_id, self.launch_spec)
+            self.state.add('launch_templates', self.project_id)
+            launch = partial(common.launch_fleet, self.project_id, launch_template, overrides
+                             , allocation_strategy=strategy)
+        else:
+            launch = partial(common.run_spot_instances, self.project_id, self.launch_spec
+                             , self.config['EC2']['SpotPrice'], persistent=self.idle_seconds is not None)
+
+        for attempt in range(LAUNCH_RETRIES + 1):
+            # Instances of each point of the matrix are launched by a separate request, all in flight at the same time
+            with tracer.span('spot-request'), ThreadPoolExecutor(max_workers=LAUNCH_CONCURRENCY) as executor:
+                launches = {point_index: executor.submit(launch, instance_count=len(indexes))
+                            for point_index, indexes in missing.items()}
+
+            for point_index, future in launches.items():
+                try:
+                    instance_ids = future.result()
+                except (ClientError, RuntimeError) as e:
+                    print('Could not launch instances for {}: {}'.format(points[point_index] or 'run', e))
+                    continue
+                shards.update(zip(instance_ids, missing[point_index]))
+                missing[point_index] = missing[point_index][len(instance_ids):]
+
+            missing = {point_index: indexes for point_index, indexes in missing.items() if indexes}
+            if not missing:
+                break
+            if attempt < LAUNCH_RETRIES:
+                print('Launching {} missing instance(s) again'.format(sum(map(len, missing.values()))))
+
+        self.state.add('instances', *shards)
+        self.state.save()
+
+        if not shards:
+            return 'No instances were launched'
+
+        missed = sorted(index for indexes in missing.values() for index in indexes)
+        if missed:
+            print('Could not launch {} of {} instances, shards {} won\'t run'.format(
+                len(missed), total, ', '.join(map(str, missed))))
+
+        # Logs waits for as many instances as were started, not as the settings ask for. Instances only log once
+        # they're dispatched, so this is the first message of the run.
+        common.put_log_message(self.project_id, log_stream_name, '[bokchoi]: {} {}'.format(RUN_INSTANCES, len(shards)))
+
+        # Instances pick up their run by instance id once they've booted, or while they're idle in the warm pool
+        with tracer.span('dispatch'):
+            common.put_objects(self.project_id
+                               , {shard_key(instance_id): utils.shard_environment(index, shard_count, points
+                                                                                   , log_stream_name)
+                                  + settings_environment(run_settings)
+                                  for instance_id, index in shards.items()})
+
+        # Stopped instances only pick up their run once they're started, after it's been dispatched
+        if reused:
+            with tracer.span('start-instances'):
+                common.start_instances(self.project_id, reused)
+
+        print('Running on {} instance(s): {}'.format(len(shards), ', '.join(shards)))
+        print('Writing logs to: ' + log_stream_name)
 
-        log_stream_name = 'bokchoi-{}'.format(int(time.time()))
-        common.create_log_stream(self.project_id, log_stream_name)
+        if wait:
+            print('Waiting for instances to start')
+            with tracer.span('wait-running'):
+                common.wait_until_running(list(shards))
+            return 'Instances running' if not missed else '{} of {} instances running'.format(len(shards), total)
 
-        print('Writing logs to: ' + log_stream_name)
+        return 'Running application' if not missed else 'Running application on {} of {} instances'.format(
+            len(shards), total)
+
+    def run_settings(self, public_key):
+        """ Settings which can change between runs of instances in the warm pool
+        :param public_key:          Public key added to the instance for notebooks
+        :return:                    Dict mapping names in the startup script to values
+        """
+        return {'entrypoint': self.config['EntryPoint']
+                , 'wheelhouse_key': utils.wheelhouse_key(self.requirements_hash())
+                , 'image_hash': self.image_hash()
+                , 'notebook': self.config.get('Notebook', False)
+                , 'public_key': public_key}
+
+    def requirements_hash(self):
+        """Hash of requirements and the image they are installed on"""
+        return utils.requirements_hash(self.config.get('Requirements', []), self.base_image_id)
+
+    def image_hash(self):
+        """Hash of everything installed on a baked image"""
+        return utils.requirements_hash(self.config.get('Requirements', []), self.base_image_id
+                                       , self.config.get('Notebook', False))
+
+    def bake(self):
+        """ Builds image with the AWS CLI, pip and requirements preinstalled. Launches a builder instance from the
+        configured image, which installs everything and stops itself, then turns it into an image tagged with the
+        image hash. Runs use the image as long as the hash matches.
+        """
+        image_hash = self.image_hash()
+
+        images = common.get_images(self.project_id, self.state.get('images'), image_hash)
+        if images:
+            return 'Image is up to date: ' + images[0].image_id
+
+        marker = BAKE_PREFIX + image_hash
+
+        with open(os.path.join(os.path.dirname(__file__), 'ec2-bake-script.sh'), 'r') as _file:
+            bake_script = _file.read()
+
+        user_data = bake_script.format(region=self.region
+                                       , bucket=self.project_id
+                                       , requirements='\n'.join(self.config.get('Requirements', []))
+                                       , wheelhouse=utils.wheelhouse_key(self.requirements_hash())
+                                       , notebook=self.config.get('Notebook', False)
+                                       , image_hash=image_hash
+                                       , marker=marker)
+
+        launch_spec = dict(self.launch_spec, UserData=user_data, IamInstanceProfile={'Name': self.project_id})
+
+        # The builder writes the marker once everything is installed, so one left by an earlier bake has to go
+        common.delete_object(self.project_id, marker)
+
+        instance_id = common.launch_builder(self.project_id, launch_spec)
+        self.state.add('instances', instance_id)
+        self.state.save()
+
+        print('Building image on instance: ' + instance_id)
+
+        try:
+            common.wait_until_stopped(instance_id)
 
-        return 'Running application'
+            if not common.object_exists(self.project_id, marker):
+                return 'Building image failed, see the console output of ' + instance_id
+
+            print('Creating image')
+            image_id = common.create_image(self.project_id, instance_id
+                                           , '{}-{}'.format(self.project_id, image_hash), image_hash)
+            self.state.add('images', image_id)
+        finally:
+            common.terminate_instance(common.resource('ec2').Instance(instance_id), dryrun=False)
+            self.state.discard('instances', instance_id)
+            self.state.save()
+
+        return 'Baked image: ' + image_id
 
     def create_default_role_and_profile(self, policies):
         """ Creates default role and instance profile for EC2 deployment.
@@ -184,42 +519,131 @@ class EC2:
         # declare default policy settings
         default_policy_name = self.project_id + '-default-policy'
         default_policy_document = DEFAULT_POLICY.format(bucket=self.project_id)
-        common.create_policy(default_policy_name, default_policy_document)
-
-        policies.append(common.get_policies(default_policy_name)[0])
+        policies.append(common.create_policy(default_policy_name, default_policy_document))
 
         if custom_policy:
             print('Creating custom policy')
 
             custom_policy_name = self.project_id + '-custom-policy'
-            common.create_policy(custom_policy_name, custom_policy)
-            policies.append(common.get_policies(custom_policy_name)[0])
+            policies.append(common.create_policy(custom_policy_name, custom_policy))
 
         return policies
 
-    def connect(self, local_port, remote_port):
-        """Set up port forwarding to remote server"""
-        instance = common.get_instances(self.project_id)[0]
+    def connect(self, forwards, stats=False, close=False, command=None):
+        """ Set up port forwarding to remote server. Connections are kept by a control daemon in the background,
+        which is started on first use and shared by later calls.
+        :param forwards:            List of (local port, remote port) pairs
+        :param stats:               Print connection and channel stats instead
+        :param close:               Stop the control daemon instead
+        :param command:             Run shell command on the instance over the shared connection instead
+        """
+        instance = common.get_instances(self.project_id, self.state.get('instances'))[0]
         instance_ip = instance.public_ip_address or instance.private_ip_address
-        SSH(self.project_id).forward(local_port or 8888, instance_ip, remote_port or 8888, 'ubuntu')
+
+        path = control.socket_path(self.project_id, instance_ip)
+        alive = control.is_alive(path)
+
+        if close or (stats and not alive):
+            if alive:
+                control.request(path, {'op': 'stop'})
+            print('Connection to {} closed'.format(instance_ip) if alive else 'Not connected to ' + instance_ip)
+            return
+
+        if not alive:
+            print('Connecting to ssh host {} ...'.format(instance_ip))
+            control.start_daemon(path, instance_ip, 'ubuntu', self.project_id)
+
+        if stats:
+            print(control.format_stats(control.request(path, {'op': 'stats'})))
+        elif command:
+            with control.attach(path, {'op': 'exec', 'command': command}) as sock:
+                sock.shutdown(socket.SHUT_WR)
+                for data in iter(partial(sock.recv, 65536), b''):
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.buffer.flush()
+        else:
+            reply = control.request(path, {'op': 'forward', 'forwards': forwards})
+            for local_port, remote_port in reply['forwards']:
+                print('Forwarding localhost:{} to {}:{}'.format(local_port, instance_ip, remote_port))
+            print('Run connect --close to disconnect')
 
     def stop(self, dryrun=False):
         """Stop all running instances"""
         common.cancel_spot_request(self.project_id, dryrun)
 
-        for instance in common.get_instances(self.project_id):
+        for instance in common.get_instances(self.project_id, self.state.get('instances')):
             common.terminate_instance(instance, dryrun)
 
+        if not dryrun:
+            self.state.discard('instances', *self.state.get('instances') or [])
+            self.state.save()
+
         return 'Instances stopped'
 
+    def trace(self, last=5, export=None):
+        """ Durations of the phases of recent deploys and runs. Spans of the client are read from the trace file,
+        spans of instances from the log streams of the runs.
+        :param last:                Number of deploys and runs to show
+        :param export:              File to write spans to, in the Trace Event Format
+        :return:                    Table with a row per phase and a column per deploy or run
+        """
+        spans = trace.load(os.path.join(self.config.path, trace.TRACE_FILE))
+        trace_ids = trace.recent_trace_ids(spans, last)
+
+        if not trace_ids:
+            return 'No traces found. Traces are recorded by deploy and run.'
+
+        run_ids = [trace_id for trace_id in trace_ids if not trace_id.startswith('deploy-')]
+        with ThreadPoolExecutor(max_workers=LAUNCH_CONCURRENCY) as executor:
+            for instance_spans in executor.map(self._instance_spans, run_ids):
+                spans += instance_spans
+
+        if export:
+            trace.export_chrome_trace([span for span in spans if span['trace_id'] in trace_ids], export)
+            print('Spans written to ' + export)
+
+        return trace.format_table(spans, trace_ids)
+
+    def _instance_spans(self, run_id):
+        """ Spans logged by the instances of a run
+        :param run_id:              Run id, the name of its log stream
+        :return:                    List of spans
+        """
+        try:
+            events = common.filter_log_messages(self.project_id, run_id
+                                                , filter_pattern='"[{}"'.format(trace.INSTANCE_STAGE))
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                return []
+            raise e
+
+        return [span for span in (trace.parse_instance_span(run_id, event['message']) for event in events) if span]
+
     def status(self):
         """Status of current deployment"""
-        print('\nStatus:')
-        for instance in common.get_instances(self.project_id):
-            print('\t' + instance.instance_id + ' : ' + instance.state['Name'])
-
-    def logs(self):
-        """Retrieve logs of latest run if available"""
+        status = dashboard.collect([self.project_id])[0]
+
+        print(dashboard.format_table([status]))
+        print('\nInstances:')
+        for instance in status['instances']:
+            print('\t' + instance['InstanceId'] + ' : ' + instance['State']['Name'])
+
+    @staticmethod
+    def status_all(project_ids=None):
+        """ Status of several projects in one table
+        :param project_ids:         Project ids, all projects in the account if not given
+        :return:                    Table
+        """
+        return dashboard.format_table(dashboard.collect(project_ids))
+
+    def logs(self, follow=True, since=None, grep=None, tail=None):
+        """ Retrieve logs of latest run if available
+        :param follow:              Keep polling for new messages until the run has finished
+        :param since:               Only show messages after this time, e.g. 10m or an ISO 8601 timestamp
+        :param grep:                Only show messages containing this term. Filtered server-side.
+        :param tail:                Start with the last this many messages in stead of the whole stream
+        """
+        finished = set()
 
         most_recent_log_stream = common.get_most_recent_log_stream(self.project_id)
 
@@ -228,16 +652,100 @@ class EC2:
 
         print('Reading logs from: ' + most_recent_log_stream)
 
-        next_token = None
+        instance_count = self.run_instance_count(most_recent_log_stream)
+        start_time = utils.parse_since(since) if since else None
+
+        if tail:
+            events = common.get_log_tail(self.project_id, most_recent_log_stream, tail)
+            finished |= self._print_events(events, grep)
+            if len(finished) >= instance_count or not follow:
+                return
+            if events:
+                start_time = events[-1]['timestamp'] + 1
+
+        # The termination sentinel has to get through the filter, so OR it with the search term
+        filter_pattern = '?"{}" ?"log-termination"'.format(grep.replace('"', '')) if grep else None
+
+        seen = set()
+        delay = MIN_POLL_INTERVAL
 
         while True:
-            events, next_token = common.get_log_messages(self.project_id, most_recent_log_stream, next_token)
+            events = [event for event in common.filter_log_messages(self.project_id
+                                                                    , most_recent_log_stream
+                                                                    , start_time
+                                                                    , filter_pattern)
+                      if event['eventId'] not in seen]
+
+            finished |= self._print_events(events, grep)
+            if len(finished) >= instance_count or not follow:
+                return
+
+            if events:
+                # Next poll starts at the last timestamp seen, skipping events at that timestamp already printed
+                last_timestamp = events[-1]['timestamp']
+                if last_timestamp != start_time:
+                    seen = set()
+                seen.update(event['eventId'] for event in events if event['timestamp'] == last_timestamp)
+                start_time = last_timestamp
+                delay = MIN_POLL_INTERVAL
+            else:
+                delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+            time.sleep(delay)
+
+    def run_instance_count(self, log_stream_name):
+        """ Returns the number of instances a run started. Runs that didn't log it are expected to have as many
+        instances as the settings ask for.
+        :param log_stream_name:     Log stream of the run
+        """
+        for event in common.filter_log_messages(self.project_id, log_stream_name
+                                                , filter_pattern='"{}"'.format(RUN_INSTANCES)):
+            return int(event['message'].split()[-1])
+        return self.instance_count
+
+    @staticmethod
+    def _print_events(events, grep=None):
+        """ Prints log events
+        :param events:              Log events
+        :param grep:                Only print messages containing this term
+        :return:                    Labels of the instances whose termination message was found
+        """
+        finished = set()
+
+        for event in events:
+
+            if 'log-termination' in event['message']:
+                finished.add(instance_label(event['message']))
+                continue
 
-            for event in events:
+            if RUN_INSTANCES in event['message']:
+                continue
 
-                if 'log-termination' in event['message']:
-                    return
+            # Spans are read by 'bokchoi trace'
+            if event['message'].startswith('[' + trace.INSTANCE_STAGE):
+                continue
 
+            if not grep or grep in event['message']:
                 print(event['message'].strip('\n'))
 
-            time.sleep(2)
+        return finished
+
+
+def shard_key(instance_id):
+    """Key of the object holding the shard environment of an instance"""
+    return SHARD_PREFIX + instance_id + '.env'
+
+
+def settings_environment(run_settings):
+    """Run settings as shell assignments, sourced by instances along with their shard environment"""
+    return ''.join('{}={}\n'.format(name.upper(), quote(str(value))) for name, value in sorted(run_settings.items()))
+
+
+def instance_label(message):
+    """ Returns label of the instance which logged message, e.g. '3' for '[bokchoi#3]: ...'. Messages of runs with
+    a single instance aren't labelled.
+    :param message:                 Log message
+    :return:                        Instance label, empty if there is none
+    """
+    stage = message.split(']', 1)[0]
+    return stage.partition('#')[2]
@@ -3,59 +3,102 @@
 Class which can be used to deploy and run EMR jobs
 """
 
+from functools import partial
 import os
 import sys
 import time
 
-import boto3
-
 from bokchoi import utils
+from bokchoi.cache import PackageCache
+from bokchoi.state import State
+from bokchoi.taskgraph import TaskGraph
 from bokchoi.aws import common
 
+# Installs requirements from the project's wheelhouse, building and uploading the wheelhouse first if it doesn't exist.
+# Only a complete wheelhouse is uploaded, under a temporary key first so a partial upload is never downloaded.
+INSTALL_REQUIREMENTS = """
+mkdir -p {root_dir}wheelhouse
+if aws s3 cp {wheelhouse} {root_dir}wheelhouse.tar.gz
+then
+    tar -xzf {root_dir}wheelhouse.tar.gz -C {root_dir}wheelhouse
+else
+    sudo pip-3.4 wheel -r {root_dir}requirements.txt -w {root_dir}wheelhouse \\
+        && tar -czf {root_dir}wheelhouse.tar.gz -C {root_dir}wheelhouse . \\
+        && aws s3 cp {root_dir}wheelhouse.tar.gz {wheelhouse}.$(hostname).tmp \\
+        && aws s3 mv {wheelhouse}.$(hostname).tmp {wheelhouse}
+fi
+sudo pip-3.4 install --no-index --find-links {root_dir}wheelhouse -r {root_dir}requirements.txt
+"""
+
+
 class EMR(object):
     """Create EMR object which can be used to schedule jobs"""
     def __init__(self, project, settings):
         self.settings = settings
         self.project_name = project
-
-        aws_account_id = common.get_aws_account_id()
-        self.project_id = utils.create_project_id(project, aws_account_id)
         self.job_flow_id = None
 
+    @utils.lazy_property
+    def project_id(self):
+        return utils.create_project_id(self.project_name, common.get_aws_account_id())
+
+    @utils.lazy_property
+    def state(self):
+        mirror = common.S3Mirror(self.project_id, common.STATE_KEY) if self.settings.get('MirrorState') else None
+        return State(self.settings.path, mirror)
+
     def deploy(self, path=''):
         """Zip package and deploy to S3 so it can be used by EMR"""
         bucket_name = common.create_bucket(self.settings['Region'], self.project_id)
 
         cwd = os.getcwd()
-        package, fingerprint = utils.zip_package(path or cwd, self.settings.get('Requirements'))
+        requirements = self.settings.get('Requirements')
+        cache = PackageCache()
+        files, fingerprint = utils.package_manifest(path or cwd, requirements, cache, self.settings.get('Exclude'))
 
         package_name = 'bokchoi-' + self.project_name + '.zip'
-        common.upload_to_s3(bucket_name, package, package_name, fingerprint)
+        common.upload_to_s3(bucket_name
+                            , package_name
+                            , fingerprint
+                            , partial(utils.write_package, files=files, requirements=requirements, cache=cache)
+                            , **utils.upload_options(self.settings))
+
+        if common.object_exists(bucket_name, utils.wheelhouse_key(self.requirements_hash())):
+            print('Requirements wheelhouse is up to date')
+        else:
+            print('Requirements wheelhouse will be built on first run')
 
-    def run(self):
-        """Create Spark cluster and run specified job"""
-        emr_client = boto3.client('emr')
-        self.start_spark_cluster(emr_client)
-        self.step_prepare_env(emr_client)
-        self.step_spark_submit(emr_client)
+    def requirements_hash(self):
+        """Hash of requirements and the EMR release they are installed on"""
+        return utils.requirements_hash(self.settings.get('Requirements'), self.settings['EMR']['Version'])
 
-    def undeploy(self, dryrun):
-        """Deletes all policies, users, and instances permanently"""
+    def run(self, wait=False):
+        """ Create Spark cluster and run specified job
+        :param wait:                Wait until the cluster is running
+        """
+        self.start_spark_cluster(common.client('emr'))
+        self.step_prepare_env(common.client('emr'))
+        self.step_spark_submit(common.client('emr'))
+
+        if wait:
+            print('Waiting for cluster to start')
+            common.client('emr').get_waiter('cluster_running').wait(ClusterId=self.job_flow_id)
 
-        common.cancel_spot_request(self.project_id, dryrun)
-        common.terminate_instances(self.project_id, dryrun)
+    def undeploy(self, dryrun):
+        """Deletes all policies, users, and instances permanently. Resources that don't depend on each other are
+        deleted concurrently."""
 
-        for pol in common.get_policies(self.project_id):
-            common.delete_policy(pol, dryrun)
+        graph = TaskGraph()
+        common.add_undeploy_tasks(graph, self.project_id, dryrun, self.state)
+        failed = graph.run()
 
-        for prof in common.get_instance_profiles(self.project_id):
-            common.delete_instance_profile(prof, dryrun)
+        if failed:
+            return 'Undeploy failed for: ' + ', '.join('{} ({})'.format(name, error) for name, error in failed.items())
 
-        for role in common.get_roles(self.project_id):
-            common.delete_role(role, dryrun)
+        if not dryrun:
+            self.state.delete()
 
-        # remove s3 bucket
-        common.delete_bucket(self.project_id, dryrun)
+        return 'Undeployed!'
 
     def start_spark_cluster(self, emr_client):
         """
@@ -160,7 +203,10 @@ class EMR(object):
                     'ActionOnFailure': 'CANCEL_AND_WAIT',
                     'HadoopJarStep': {
                         'Jar': 'command-runner.jar',
-                        'Args': ['sudo', 'pip-3.4', 'install', '-r', root_dir + 'requirements.txt']
+                        'Args': ['bash', '-c', INSTALL_REQUIREMENTS.format(
+                            root_dir=root_dir,
+                            wheelhouse='s3://{}/{}'.format(self.project_id,
+                                                           utils.wheelhouse_key(self.requirements_hash())))]
                     }
                 }
             ]
@@ -0,0 +1,870 @@
+"""
+In-process stand-in for the AWS services used by bokchoi, so commands can be run and timed without an account.
+
+The fake hooks into botocore's event system and answers API calls before they are sent, which means boto3
+clients, resources, paginators and waiters all work as usual on top of it. Latency can be added to every call
+and operations can be made to fail with throttling errors at a given rate.
+
+    fake = FakeAWS(latency=0.05, throttle={'PutLogEvents': 0.1})
+    common.use_session(fake.session())
+"""
+
+from collections import Counter
+import copy
+from datetime import datetime, timezone
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore import xform_name
+
+ACCOUNT_ID = '123456789012'
+
+THROTTLE_ERRORS = {'ec2': 'RequestLimitExceeded', 's3': 'SlowDown'}
+
+
+class FakeError(Exception):
+    """Raised by fake services to return an error response"""
+
+    def __init__(self, code, message='', status=400):
+        super(FakeError, self).__init__(code)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class FakeAWS:
+    """Holds the state of all fake services and answers API calls made through sessions it created"""
+
+    def __init__(self, latency=0, throttle=None, region='us-east-1', seed=None):
+        """
+        :param latency:             Seconds added to every API call
+        :param throttle:            Dict mapping operation names, e.g. 'PutLogEvents', to the fraction of calls
+                                    that fail with a throttling error
+        :param region:              Region of created sessions
+        :param seed:                Seed for throttling decisions
+        """
+        self.latency = latency
+        self.throttle = throttle or {}
+        self.region = region
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.calls = Counter()
+
+        self.services = {'ec2': FakeEC2(self),
+                         's3': FakeS3(self),
+                         'iam': FakeIAM(self),
+                         'logs': FakeLogs(self),
+                         'emr': FakeEMR(self)}
+
+    def session(self):
+        """Returns boto3 session whose clients and resources are served by this fake"""
+        session = boto3.Session(aws_access_key_id='fake'
+                                , aws_secret_access_key='fake'
+                                , region_name=self.region)
+        session.events.register('before-parameter-build.*.*', self._capture_params)
+        session.events.register('before-call.*.*', self._respond)
+        return session
+
+    def reset_calls(self):
+        """Resets API call counters and returns the counts up to now"""
+        with self.lock:
+            calls = self.calls
+            self.calls = Counter()
+        return calls
+
+    @staticmethod
+    def _capture_params(params, context, **kwargs):
+        context['fake_params'] = params
+
+    def _respond(self, model, context, **kwargs):
+        service_name = model.service_model.service_name
+        params = context.get('fake_params', {})
+
+        with self.lock:
+            self.calls['{}.{}'.format(service_name, model.name)] += 1
+            throttled = self.random.random() < self.throttle.get(model.name, 0)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        try:
+            if throttled:
+                raise FakeError(THROTTLE_ERRORS.get(service_name, 'ThrottlingException'), 'Rate exceeded')
+
+            handler = getattr(self.services[service_name], xform_name(model.name), None)
+            if handler is None:
+                raise NotImplementedError('Fake {} does not implement {}'.format(service_name, model.name))
+
+            # botocore post-processes responses in place, so never hand out stored state
+            with self.lock:
+                response = copy.deepcopy(handler(**params) or {})
+            status = 200
+        except FakeError as e:
+            response = {'Error': {'Code': e.code, 'Message': e.message}}
+            status = e.status
+
+        response['ResponseMetadata'] = {'HTTPStatusCode': status, 'RequestId': 'fake'}
+
+        return AWSResponse(None, status, {}, None), response
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def new_id(prefix, counter=itertools.count(1)):
+    return '{}-{:017x}'.format(prefix, next(counter))
+
+
+def tags_dict(tags):
+    return {tag['Key']: tag['Value'] for tag in tags or []}
+
+
+def matches_filters(item, filters, fields):
+    """ Checks EC2 style filters against item
+    :param item:                    Resource dict with Tags
+    :param filters:                 List of {'Name': ..., 'Values': [...]}
+    :param fields:                  Dict mapping filter names to functions extracting the value from item
+    :return:                        True if all filters match
+    """
+    tags = tags_dict(item.get('Tags'))
+    for _filter in filters or []:
+        name, values = _filter['Name'], _filter['Values']
+        if name.startswith('tag:'):
+            if tags.get(name[4:]) not in values:
+                return False
+        elif name == 'tag-key':
+            if not set(tags) & set(values):
+                return False
+        elif name == 'tag-value':
+            if not set(tags.values()) & set(values):
+                return False
+        elif name in fields:
+            if fields[name](item) not in values:
+                return False
+        else:
+            raise NotImplementedError('Fake does not support filter ' + name)
+    return True
+
+
+class FakeEC2:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.instances = {}
+        self.spot_requests = {}
+        self.launch_templates = {}
+        self.images = {}
+        self.snapshots = {}
+        self.unavailable_pools = set()
+        self.security_groups = {'sg-default': {'GroupId': 'sg-default', 'GroupName': 'default',
+                                               'Description': 'default VPC security group', 'VpcId': 'vpc-fake',
+                                               'OwnerId': ACCOUNT_ID, 'IpPermissions': [], 'Tags': []}}
+
+    def _resource(self, resource_id):
+        for collection in (self.instances, self.spot_requests, self.security_groups, self.images):
+            if resource_id in collection:
+                return collection[resource_id]
+        raise FakeError('InvalidID', 'The ID {} is not valid'.format(resource_id))
+
+    def create_tags(self, Resources, Tags, **kwargs):
+        for resource_id in Resources:
+            resource = self._resource(resource_id)
+            tags = tags_dict(resource.get('Tags'))
+            tags.update(tags_dict(Tags))
+            resource['Tags'] = [{'Key': key, 'Value': value} for key, value in tags.items()]
+
+    def describe_subnets(self, SubnetIds=None, **kwargs):
+        return {'Subnets': [{'SubnetId': subnet_id, 'VpcId': 'vpc-fake', 'CidrBlock': '10.0.0.0/24',
+                             'AvailabilityZone': self.zone(subnet_id), 'State': 'available'}
+                            for subnet_id in SubnetIds or ['subnet-fake']]}
+
+    def zone(self, subnet_id):
+        """Spreads subnets over three availability zones"""
+        return self.aws.region + 'abc'[int(hashlib.md5(subnet_id.encode()).hexdigest(), 16) % 3]
+
+    def spot_price(self, instance_type, zone):
+        """Stable made-up price of spot pool"""
+        return 0.02 + int(hashlib.md5((instance_type + zone).encode()).hexdigest(), 16) % 1000 / 10000
+
+    def describe_spot_price_history(self, InstanceTypes, AvailabilityZone=None, **kwargs):
+        zones = [AvailabilityZone] if AvailabilityZone else [self.aws.region + suffix for suffix in 'abc']
+        return {'SpotPriceHistory': [{'InstanceType': instance_type, 'AvailabilityZone': zone,
+                                      'ProductDescription': 'Linux/UNIX', 'Timestamp': now(),
+                                      'SpotPrice': '{:.4f}'.format(self.spot_price(instance_type, zone))}
+                                     for instance_type in InstanceTypes for zone in zones]}
+
+    def create_launch_template(self, LaunchTemplateName, LaunchTemplateData, **kwargs):
+        if LaunchTemplateName in self.launch_templates:
+            raise FakeError('InvalidLaunchTemplateName.AlreadyExistsException',
+                            'Launch template name already in use.')
+        self.launch_templates[LaunchTemplateName] = [LaunchTemplateData]
+        return {'LaunchTemplate': {'LaunchTemplateName': LaunchTemplateName, 'LaunchTemplateId': new_id('lt'),
+                                   'LatestVersionNumber': 1, 'DefaultVersionNumber': 1}}
+
+    def _launch_template(self, name):
+        if name not in self.launch_templates:
+            raise FakeError('InvalidLaunchTemplateName.NotFoundException',
+                            'The specified launch template, with template name {}, does not exist.'.format(name))
+        return self.launch_templates[name]
+
+    def create_launch_template_version(self, LaunchTemplateName, LaunchTemplateData, **kwargs):
+        versions = self._launch_template(LaunchTemplateName)
+        versions.append(LaunchTemplateData)
+        return {'LaunchTemplateVersion': {'LaunchTemplateName': LaunchTemplateName,
+                                          'VersionNumber': len(versions)}}
+
+    def delete_launch_template(self, LaunchTemplateName, **kwargs):
+        self._launch_template(LaunchTemplateName)
+        del self.launch_templates[LaunchTemplateName]
+        return {'LaunchTemplate': {'LaunchTemplateName': LaunchTemplateName}}
+
+    def create_fleet(self, LaunchTemplateConfigs, TargetCapacitySpecification, Type='maintain', SpotOptions=None,
+                     TagSpecifications=None, **kwargs):
+        """Instant fleets only. Pools listed in unavailable_pools have no capacity."""
+        if Type != 'instant':
+            raise NotImplementedError('Fake only supports instant fleets')
+
+        strategy = (SpotOptions or {}).get('AllocationStrategy', 'lowest-price')
+        tags = [tag for spec in TagSpecifications or [] if spec['ResourceType'] == 'instance' for tag in spec['Tags']]
+
+        pools = []
+        for config in LaunchTemplateConfigs:
+            spec = config['LaunchTemplateSpecification']
+            versions = self._launch_template(spec['LaunchTemplateName'])
+            data = versions[int(spec.get('Version', len(versions))) - 1]
+            for override in config.get('Overrides', []):
+                price = self.spot_price(override['InstanceType'], self.zone(override['SubnetId']))
+                if 'MaxPrice' in override and price > float(override['MaxPrice']):
+                    continue
+                pools.append((override.get('Priority', 0) if strategy.endswith('prioritized') else price,
+                              spec, data, override))
+
+        pools.sort(key=lambda pool: pool[0])
+
+        instances, errors = [], []
+        remaining = TargetCapacitySpecification['TotalTargetCapacity']
+        for _, spec, data, override in pools:
+            if (override['InstanceType'], override['SubnetId']) in self.unavailable_pools:
+                errors.append({'LaunchTemplateAndOverrides': {'LaunchTemplateSpecification': spec,
+                                                              'Overrides': override},
+                               'Lifecycle': 'spot', 'ErrorCode': 'InsufficientInstanceCapacity',
+                               'ErrorMessage': 'There is no Spot capacity available that matches your request.'})
+                continue
+            launch_spec = dict(data, InstanceType=override['InstanceType'], SubnetId=override['SubnetId'])
+            instance_ids = [self.launch_instance(launch_spec, tags, InstanceLifecycle='spot')['InstanceId']
+                            for _ in range(remaining)]
+            instances.append({'LaunchTemplateAndOverrides': {'LaunchTemplateSpecification': spec,
+                                                             'Overrides': override},
+                              'Lifecycle': 'spot', 'InstanceIds': instance_ids,
+                              'InstanceType': override['InstanceType']})
+            break
+
+        return {'FleetId': new_id('fleet'), 'Instances': instances, 'Errors': errors}
+
+    def describe_security_groups(self, GroupNames=None, GroupIds=None, Filters=None, **kwargs):
+        groups = []
+        for group in self.security_groups.values():
+            if GroupNames and group['GroupName'].lower() not in [name.lower() for name in GroupNames]:
+                continue
+            if GroupIds and group['GroupId'] not in GroupIds:
+                continue
+            if not matches_filters(group, Filters, {'group-name': lambda g: g['GroupName'],
+                                                    'group-id': lambda g: g['GroupId']}):
+                continue
+            groups.append(group)
+
+        if (GroupNames or GroupIds) and not groups:
+            raise FakeError('InvalidGroup.NotFound', 'The security group does not exist')
+
+        return {'SecurityGroups': groups}
+
+    def create_security_group(self, GroupName, Description, VpcId=None, **kwargs):
+        if any(group['GroupName'] == GroupName for group in self.security_groups.values()):
+            raise FakeError('InvalidGroup.Duplicate', 'The security group already exists')
+        group_id = new_id('sg')
+        self.security_groups[group_id] = {'GroupId': group_id, 'GroupName': GroupName, 'Description': Description,
+                                          'VpcId': VpcId, 'OwnerId': ACCOUNT_ID, 'IpPermissions': [], 'Tags': []}
+        return {'GroupId': group_id}
+
+    def authorize_security_group_ingress(self, GroupId, **kwargs):
+        self.security_groups[GroupId]['IpPermissions'].append(kwargs)
+        return {'Return': True}
+
+    def delete_security_group(self, GroupId, **kwargs):
+        if GroupId not in self.security_groups:
+            raise FakeError('InvalidGroup.NotFound', 'The security group does not exist')
+        for instance in self.instances.values():
+            in_use = any(group['GroupId'] == GroupId for group in instance['SecurityGroups'])
+            if in_use and instance['State']['Name'] != 'terminated':
+                raise FakeError('DependencyViolation', 'resource has a dependent object')
+        del self.security_groups[GroupId]
+
+    def launch_instance(self, launch_spec, tags=None, **extra):
+        """Creates running instance from launch specification"""
+        instance_id = new_id('i')
+        number = len(self.instances) + 1
+        self.instances[instance_id] = dict({
+            'InstanceId': instance_id,
+            'ImageId': launch_spec.get('ImageId'),
+            'InstanceType': launch_spec.get('InstanceType'),
+            'SubnetId': launch_spec.get('SubnetId'),
+            'VpcId': 'vpc-fake',
+            'State': {'Code': 16, 'Name': 'running'},
+            'LaunchTime': now(),
+            'PrivateIpAddress': '10.0.{}.{}'.format(number // 250, number % 250 + 4),
+            'PublicIpAddress': '198.51.100.{}'.format(number % 250 + 1),
+            'SecurityGroups': [{'GroupId': group_id, 'GroupName': self.security_groups[group_id]['GroupName']}
+                               for group_id in launch_spec.get('SecurityGroupIds', [])
+                               if group_id in self.security_groups],
+            'AmiLaunchIndex': 0,
+            'Tags': list(tags or []),
+        }, **extra)
+        return self.instances[instance_id]
+
+    def request_spot_instances(self, LaunchSpecification, SpotPrice=None, InstanceCount=1, **kwargs):
+        requests = []
+        for _ in range(InstanceCount):
+            request_id = new_id('sir')
+            instance = self.launch_instance(LaunchSpecification, SpotInstanceRequestId=request_id,
+                                            InstanceLifecycle='spot')
+            self.spot_requests[request_id] = {
+                'SpotInstanceRequestId': request_id,
+                'SpotPrice': SpotPrice,
+                'State': 'active',
+                'Status': {'Code': 'fulfilled'},
+                'InstanceId': instance['InstanceId'],
+                'LaunchSpecification': LaunchSpecification,
+                'CreateTime': now(),
+                'Tags': [],
+            }
+            requests.append(self.spot_requests[request_id])
+        return {'SpotInstanceRequests': requests}
+
+    def run_instances(self, MinCount, MaxCount, InstanceMarketOptions=None, TagSpecifications=None, **kwargs):
+        tags = {spec['ResourceType']: spec['Tags'] for spec in TagSpecifications or []}
+        spot = (InstanceMarketOptions or {}).get('MarketType') == 'spot'
+
+        instances = []
+        for _ in range(MaxCount):
+            extra = {}
+            if spot:
+                request_id = new_id('sir')
+                extra = {'SpotInstanceRequestId': request_id, 'InstanceLifecycle': 'spot'}
+            instance = self.launch_instance(kwargs, tags.get('instance'), **extra)
+            # On-demand instances that stop themselves, such as image builders, finish their user data right away
+            if not spot and kwargs.get('InstanceInitiatedShutdownBehavior') == 'stop':
+                instance['State'] = {'Code': 80, 'Name': 'stopped'}
+            if spot:
+                self.spot_requests[request_id] = {
+                    'SpotInstanceRequestId': request_id,
+                    'SpotPrice': InstanceMarketOptions.get('SpotOptions', {}).get('MaxPrice'),
+                    'State': 'active',
+                    'Status': {'Code': 'fulfilled'},
+                    'Type': InstanceMarketOptions.get('SpotOptions', {}).get('SpotInstanceType', 'one-time'),
+                    'InstanceId': instance['InstanceId'],
+                    'CreateTime': now(),
+                    'Tags': list(tags.get('spot-instances-request', [])),
+                }
+            instances.append(instance)
+
+        return {'ReservationId': new_id('r'), 'OwnerId': ACCOUNT_ID, 'Instances': instances}
+
+    def describe_spot_instance_requests(self, SpotInstanceRequestIds=None, Filters=None, **kwargs):
+        requests = [request for request in self.spot_requests.values()
+                    if (not SpotInstanceRequestIds or request['SpotInstanceRequestId'] in SpotInstanceRequestIds)
+                    and matches_filters(request, Filters, {'state': lambda r: r['State'],
+                                                           'spot-instance-request-id':
+                                                               lambda r: r['SpotInstanceRequestId']})]
+        return {'SpotInstanceRequests': requests}
+
+    def cancel_spot_instance_requests(self, SpotInstanceRequestIds, **kwargs):
+        if not SpotInstanceRequestIds:
+            raise FakeError('InvalidParameterCombination', 'No spot instance request ids')
+        for request_id in SpotInstanceRequestIds:
+            self.spot_requests[request_id]['State'] = 'cancelled'
+        return {'CancelledSpotInstanceRequests': [{'SpotInstanceRequestId': request_id, 'State': 'cancelled'}
+                                                  for request_id in SpotInstanceRequestIds]}
+
+    def describe_instances(self, InstanceIds=None, Filters=None, **kwargs):
+        instances = [instance for instance in self.instances.values()
+                     if (not InstanceIds or instance['InstanceId'] in InstanceIds)
+                     and matches_filters(instance, Filters, {'instance-state-name': lambda i: i['State']['Name'],
+                                                             'instance-id': lambda i: i['InstanceId']})]
+        if InstanceIds and not instances:
+            raise FakeError('InvalidInstanceID.NotFound', 'The instance IDs do not exist')
+        return {'Reservations': [{'ReservationId': 'r-' + instance['InstanceId'][2:],
+                                  'OwnerId': ACCOUNT_ID,
+                                  'Instances': [instance]} for instance in instances]}
+
+    def _set_state(self, instance_ids, code, name):
+        changes = []
+        for instance_id in instance_ids:
+            instance = self.instances[instance_id]
+            changes.append({'InstanceId': instance_id,
+                            'PreviousState': dict(instance['State']),
+                            'CurrentState': {'Code': code, 'Name': name}})
+            instance['State'] = {'Code': code, 'Name': name}
+        return changes
+
+    def _set_request_state(self, instance_ids, state):
+        """Persistent spot requests are disabled while their instance is stopped"""
+        for request in self.spot_requests.values():
+            if request['InstanceId'] in instance_ids and request.get('Type') == 'persistent' \
+                    and request['State'] in ('active', 'disabled'):
+                request['State'] = state
+
+    def create_image(self, InstanceId, Name, TagSpecifications=None, **kwargs):
+        tags = {spec['ResourceType']: spec['Tags'] for spec in TagSpecifications or []}
+        if any(image['Name'] == Name for image in self.images.values()):
+            raise FakeError('InvalidAMIName.Duplicate', 'AMI name {} is already in use'.format(Name))
+
+        snapshot_id = new_id('snap')
+        self.snapshots[snapshot_id] = {'SnapshotId': snapshot_id, 'Tags': list(tags.get('snapshot', []))}
+
+        image_id = new_id('ami')
+        self.images[image_id] = {
+            'ImageId': image_id,
+            'Name': Name,
+            'State': 'available',
+            'OwnerId': ACCOUNT_ID,
+            'CreationDate': now().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            'SourceInstanceId': InstanceId,
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': snapshot_id}}],
+            'Tags': list(tags.get('image', [])),
+        }
+        return {'ImageId': image_id}
+
+    def describe_images(self, ImageIds=None, Owners=None, Filters=None, **kwargs):
+        images = [image for image in self.images.values()
+                  if (not ImageIds or image['ImageId'] in ImageIds)
+                  and matches_filters(image, Filters, {'state': lambda i: i['State'],
+                                                       'image-id': lambda i: i['ImageId']})]
+        return {'Images': images}
+
+    def deregister_image(self, ImageId, **kwargs):
+        if ImageId not in self.images:
+            raise FakeError('InvalidAMIID.NotFound', 'The image id does not exist')
+        del self.images[ImageId]
+
+    def delete_snapshot(self, SnapshotId, **kwargs):
+        if SnapshotId not in self.snapshots:
+            raise FakeError('InvalidSnapshot.NotFound', 'The snapshot does not exist')
+        del self.snapshots[SnapshotId]
+
+    def terminate_instances(self, InstanceIds, **kwargs):
+        return {'TerminatingInstances': self._set_state(InstanceIds, 48, 'terminated')}
+
+    def stop_instances(self, InstanceIds, **kwargs):
+        self._set_request_state(InstanceIds, 'disabled')
+        return {'StoppingInstances': self._set_state(InstanceIds, 80, 'stopped')}
+
+    def start_instances(self, InstanceIds, **kwargs):
+        for instance_id in InstanceIds:
+            if self.instances[instance_id]['State']['Name'] != 'stopped':
+                raise FakeError('IncorrectInstanceState', 'The instance is not in a state from which it can be started')
+        self._set_request_state(InstanceIds, 'active')
+        return {'StartingInstances': self._set_state(InstanceIds, 16, 'running')}
+
+
+class FakeS3:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.buckets = {}
+        self.uploads = {}
+
+    def _bucket(self, name):
+        if name not in self.buckets:
+            raise FakeError('NoSuchBucket', 'The specified bucket does not exist', 404)
+        return self.buckets[name]
+
+    def create_bucket(self, Bucket, **kwargs):
+        if Bucket in self.buckets:
+            raise FakeError('BucketAlreadyOwnedByYou', 'Your previous request to create the named bucket '
+                                                       'succeeded and you already own it.', 409)
+        self.buckets[Bucket] = {}
+        return {'Location': '/' + Bucket}
+
+    def list_buckets(self, **kwargs):
+        return {'Buckets': [{'Name': name, 'CreationDate': now()} for name in sorted(self.buckets)]}
+
+    def delete_bucket(self, Bucket, **kwargs):
+        if self._bucket(Bucket):
+            raise FakeError('BucketNotEmpty', 'The bucket you tried to delete is not empty', 409)
+        del self.buckets[Bucket]
+
+    def head_object(self, Bucket, Key, **kwargs):
+        obj = self._bucket(Bucket).get(Key)
+        if obj is None:
+            raise FakeError('404', 'Not Found', 404)
+        return {'ContentLength': len(obj['Body']), 'ETag': obj['ETag'], 'Metadata': obj['Metadata'],
+                'LastModified': obj['LastModified']}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        obj = self._bucket(Bucket).get(Key)
+        if obj is None:
+            raise FakeError('NoSuchKey', 'The specified key does not exist.', 404)
+        return {'ContentLength': len(obj['Body']), 'ETag': obj['ETag'], 'Metadata': obj['Metadata'],
+                'Body': FakeStreamingBody(obj['Body'])}
+
+    def _store(self, bucket, key, body, metadata, etag=None):
+        self._bucket(bucket)[key] = {'Body': body,
+                                     'ETag': etag or '"{}"'.format(hashlib.md5(body).hexdigest()),
+                                     'Metadata': metadata or {},
+                                     'LastModified': now()}
+        return self.buckets[bucket][key]['ETag']
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, **kwargs):
+        return {'ETag': self._store(Bucket, Key, read_body(Body), Metadata)}
+
+    def list_objects(self, Bucket, Prefix='', **kwargs):
+        return {'Contents': [{'Key': key, 'Size': len(obj['Body']), 'ETag': obj['ETag'],
+                              'LastModified': obj['LastModified']}
+                             for key, obj in sorted(self._bucket(Bucket).items()) if key.startswith(Prefix)],
+                'IsTruncated': False}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        response = self.list_objects(Bucket, Prefix)
+        response['KeyCount'] = len(response['Contents'])
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._bucket(Bucket).pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            self._bucket(Bucket).pop(obj['Key'], None)
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata=None, **kwargs):
+        self._bucket(Bucket)
+        upload_id = new_id('upload')
+        self.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Metadata': Metadata, 'Parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def _upload(self, upload_id):
+        if upload_id not in self.uploads:
+            raise FakeError('NoSuchUpload', 'The specified upload does not exist.', 404)
+        return self.uploads[upload_id]
+
+    def upload_part(self, UploadId, PartNumber, Body, **kwargs):
+        body = read_body(Body)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self._upload(UploadId)['Parts'][PartNumber] = {'Body': body, 'ETag': etag}
+        return {'ETag': etag}
+
+    def list_parts(self, UploadId, **kwargs):
+        parts = self._upload(UploadId)['Parts']
+        return {'Parts': [{'PartNumber': number, 'ETag': part['ETag'], 'Size': len(part['Body'])}
+                          for number, part in sorted(parts.items())],
+                'IsTruncated': False}
+
+    def complete_multipart_upload(self, UploadId, MultipartUpload, **kwargs):
+        upload = self._upload(UploadId)
+        body = b''
+        for part in MultipartUpload['Parts']:
+            stored = upload['Parts'].get(part['PartNumber'])
+            if stored is None or stored['ETag'] != part['ETag']:
+                raise FakeError('InvalidPart', 'One or more of the specified parts could not be found.')
+            body += stored['Body']
+        etag = self._store(upload['Bucket'], upload['Key'], body, upload['Metadata'],
+                           '"{}-{}"'.format(hashlib.md5(body).hexdigest(), len(MultipartUpload['Parts'])))
+        del self.uploads[UploadId]
+        return {'Bucket': upload['Bucket'], 'Key': upload['Key'], 'ETag': etag}
+
+    def abort_multipart_upload(self, UploadId, **kwargs):
+        self._upload(UploadId)
+        del self.uploads[UploadId]
+
+
+class FakeStreamingBody:
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, amt=None):
+        data, self.body = (self.body, b'') if amt is None else (self.body[:amt], self.body[amt:])
+        return data
+
+    def close(self):
+        pass
+
+
+def read_body(body):
+    if hasattr(body, 'read'):
+        if hasattr(body, 'seek'):
+            body.seek(0)
+        return body.read()
+    return body.encode() if isinstance(body, str) else bytes(body)
+
+
+class FakeIAM:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.roles = {}
+        self.instance_profiles = {}
+        self.policies = {}
+
+    @staticmethod
+    def _get(collection, name, kind):
+        if name not in collection:
+            raise FakeError('NoSuchEntity', 'The {} with name {} cannot be found.'.format(kind, name), 404)
+        return collection[name]
+
+    @staticmethod
+    def _list(key, items):
+        return {key: list(items), 'IsTruncated': False}
+
+    def create_role(self, RoleName, AssumeRolePolicyDocument, **kwargs):
+        if RoleName in self.roles:
+            raise FakeError('EntityAlreadyExists', 'Role with name {} already exists.'.format(RoleName), 409)
+        self.roles[RoleName] = {'Path': '/', 'RoleName': RoleName, 'RoleId': new_id('AROA'),
+                                'Arn': 'arn:aws:iam::{}:role/{}'.format(ACCOUNT_ID, RoleName),
+                                'CreateDate': now(), 'AssumeRolePolicyDocument': AssumeRolePolicyDocument,
+                                'AttachedPolicies': []}
+        return {'Role': self.roles[RoleName]}
+
+    def get_role(self, RoleName, **kwargs):
+        return {'Role': self._get(self.roles, RoleName, 'role')}
+
+    def list_roles(self, **kwargs):
+        return self._list('Roles', self.roles.values())
+
+    def delete_role(self, RoleName, **kwargs):
+        role = self._get(self.roles, RoleName, 'role')
+        in_profile = any(RoleName in [r['RoleName'] for r in profile['Roles']]
+                         for profile in self.instance_profiles.values())
+        if role['AttachedPolicies'] or in_profile:
+            raise FakeError('DeleteConflict', 'Cannot delete entity, must detach all policies first.', 409)
+        del self.roles[RoleName]
+
+    def create_policy(self, PolicyName, PolicyDocument, **kwargs):
+        arn = 'arn:aws:iam::{}:policy/{}'.format(ACCOUNT_ID, PolicyName)
+        if arn in self.policies:
+            raise FakeError('EntityAlreadyExists', 'A policy called {} already exists.'.format(PolicyName), 409)
+        self.policies[arn] = {'PolicyName': PolicyName, 'PolicyId': new_id('ANPA'), 'Arn': arn, 'Path': '/',
+                              'DefaultVersionId': 'v1', 'AttachmentCount': 0, 'IsAttachable': True,
+                              'CreateDate': now(), 'UpdateDate': now()}
+        return {'Policy': self.policies[arn]}
+
+    def get_policy(self, PolicyArn, **kwargs):
+        return {'Policy': self._get(self.policies, PolicyArn, 'policy')}
+
+    def list_policies(self, **kwargs):
+        return self._list('Policies', self.policies.values())
+
+    def delete_policy(self, PolicyArn, **kwargs):
+        policy = self._get(self.policies, PolicyArn, 'policy')
+        if policy['AttachmentCount']:
+            raise FakeError('DeleteConflict', 'Cannot delete a policy attached to entities.', 409)
+        del self.policies[PolicyArn]
+
+    def attach_role_policy(self, RoleName, PolicyArn, **kwargs):
+        role = self._get(self.roles, RoleName, 'role')
+        policy = self._get(self.policies, PolicyArn, 'policy')
+        if PolicyArn not in role['AttachedPolicies']:
+            role['AttachedPolicies'].append(PolicyArn)
+            policy['AttachmentCount'] += 1
+
+    def detach_role_policy(self, RoleName, PolicyArn, **kwargs):
+        role = self._get(self.roles, RoleName, 'role')
+        if PolicyArn not in role['AttachedPolicies']:
+            raise FakeError('NoSuchEntity', 'Policy {} was not found.'.format(PolicyArn), 404)
+        role['AttachedPolicies'].remove(PolicyArn)
+        self.policies[PolicyArn]['AttachmentCount'] -= 1
+
+    def list_attached_role_policies(self, RoleName, **kwargs):
+        role = self._get(self.roles, RoleName, 'role')
+        return self._list('AttachedPolicies', [{'PolicyArn': arn, 'PolicyName': self.policies[arn]['PolicyName']}
+                                               for arn in role['AttachedPolicies']])
+
+    def list_entities_for_policy(self, PolicyArn, **kwargs):
+        self._get(self.policies, PolicyArn, 'policy')
+        response = self._list('PolicyRoles', [{'RoleName': role['RoleName'], 'RoleId': role['RoleId']}
+                                              for role in self.roles.values()
+                                              if PolicyArn in role['AttachedPolicies']])
+        response.update({'PolicyGroups': [], 'PolicyUsers': []})
+        return response
+
+    def create_instance_profile(self, InstanceProfileName, **kwargs):
+        if InstanceProfileName in self.instance_profiles:
+            raise FakeError('EntityAlreadyExists', 'Instance Profile {} already exists.'.format(InstanceProfileName),
+                            409)
+        self.instance_profiles[InstanceProfileName] = {
+            'Path': '/', 'InstanceProfileName': InstanceProfileName, 'InstanceProfileId': new_id('AIPA'),
+            'Arn': 'arn:aws:iam::{}:instance-profile/{}'.format(ACCOUNT_ID, InstanceProfileName),
+            'CreateDate': now(), 'Roles': []}
+        return {'InstanceProfile': self.instance_profiles[InstanceProfileName]}
+
+    def get_instance_profile(self, InstanceProfileName, **kwargs):
+        return {'InstanceProfile': self._get(self.instance_profiles, InstanceProfileName, 'instance profile')}
+
+    def list_instance_profiles(self, **kwargs):
+        return self._list('InstanceProfiles', self.instance_profiles.values())
+
+    def add_role_to_instance_profile(self, InstanceProfileName, RoleName, **kwargs):
+        profile = self._get(self.instance_profiles, InstanceProfileName, 'instance profile')
+        profile['Roles'].append(self._get(self.roles, RoleName, 'role'))
+
+    def remove_role_from_instance_profile(self, InstanceProfileName, RoleName, **kwargs):
+        profile = self._get(self.instance_profiles, InstanceProfileName, 'instance profile')
+        profile['Roles'] = [role for role in profile['Roles'] if role['RoleName'] != RoleName]
+
+    def delete_instance_profile(self, InstanceProfileName, **kwargs):
+        profile = self._get(self.instance_profiles, InstanceProfileName, 'instance profile')
+        if profile['Roles']:
+            raise FakeError('DeleteConflict', 'Cannot delete entity, must remove roles from instance profile first.',
+                            409)
+        del self.instance_profiles[InstanceProfileName]
+
+
+class FakeLogs:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.groups = {}
+
+    def _group(self, name):
+        if name not in self.groups:
+            raise FakeError('ResourceNotFoundException', 'The specified log group does not exist.')
+        return self.groups[name]
+
+    def _stream(self, group_name, stream_name):
+        streams = self._group(group_name)
+        if stream_name not in streams:
+            raise FakeError('ResourceNotFoundException', 'The specified log stream does not exist.')
+        return streams[stream_name]
+
+    def create_log_group(self, logGroupName, **kwargs):
+        if logGroupName in self.groups:
+            raise FakeError('ResourceAlreadyExistsException', 'The specified log group already exists')
+        self.groups[logGroupName] = {}
+
+    def delete_log_group(self, logGroupName, **kwargs):
+        self._group(logGroupName)
+        del self.groups[logGroupName]
+
+    def describe_log_groups(self, logGroupNamePrefix='', **kwargs):
+        return {'logGroups': [{'logGroupName': name} for name in sorted(self.groups)
+                              if name.startswith(logGroupNamePrefix)]}
+
+    def create_log_stream(self, logGroupName, logStreamName, **kwargs):
+        streams = self._group(logGroupName)
+        if logStreamName in streams:
+            raise FakeError('ResourceAlreadyExistsException', 'The specified log stream already exists')
+        streams[logStreamName] = {'logStreamName': logStreamName,
+                                  'creationTime': int(1000 * time.time()),
+                                  'events': []}
+
+    def describe_log_streams(self, logGroupName, logStreamNamePrefix='', descending=False, limit=50, **kwargs):
+        streams = sorted((stream for name, stream in self._group(logGroupName).items()
+                          if name.startswith(logStreamNamePrefix)),
+                         key=lambda stream: stream['logStreamName'], reverse=descending)
+        return {'logStreams': [self._describe_stream(stream) for stream in streams[:limit]]}
+
+    @staticmethod
+    def _describe_stream(stream):
+        description = {key: value for key, value in stream.items() if key != 'events'}
+        if stream['events']:
+            description['firstEventTimestamp'] = stream['events'][0]['timestamp']
+            description['lastEventTimestamp'] = stream['events'][-1]['timestamp']
+        return description
+
+    def put_log_events(self, logGroupName, logStreamName, logEvents, **kwargs):
+        stream = self._stream(logGroupName, logStreamName)
+        ingestion_time = int(1000 * time.time())
+        for event in logEvents:
+            stream['events'].append({'eventId': str(len(stream['events'])),
+                                     'timestamp': event['timestamp'],
+                                     'message': event['message'],
+                                     'ingestionTime': ingestion_time})
+        return {'nextSequenceToken': str(len(stream['events']))}
+
+    def get_log_events(self, logGroupName, logStreamName, nextToken=None, startFromHead=False, limit=10000,
+                       **kwargs):
+        events = self._stream(logGroupName, logStreamName)['events']
+
+        if nextToken:
+            start = int(nextToken[2:])
+        elif startFromHead:
+            start = 0
+        else:
+            start = max(len(events) - limit, 0)
+        end = min(start + limit, len(events))
+
+        return {'events': [{key: event[key] for key in ('timestamp', 'message', 'ingestionTime')}
+                           for event in events[start:end]],
+                'nextForwardToken': 'f/{}'.format(end),
+                'nextBackwardToken': 'b/{}'.format(start)}
+
+    def filter_log_events(self, logGroupName, logStreamNames=None, startTime=None, endTime=None,
+                          filterPattern=None, nextToken=None, limit=1000, **kwargs):
+        events = []
+        for stream_name, stream in sorted(self._group(logGroupName).items()):
+            if logStreamNames and stream_name not in logStreamNames:
+                continue
+            events += [dict(event, logStreamName=stream_name) for event in stream['events']
+                       if (startTime is None or event['timestamp'] >= startTime)
+                       and (endTime is None or event['timestamp'] <= endTime)
+                       and matches_pattern(event['message'], filterPattern)]
+        events.sort(key=lambda event: event['timestamp'])
+
+        start = int(nextToken) if nextToken else 0
+        response = {'events': events[start:start + limit], 'searchedLogStreams': []}
+        if start + limit < len(events):
+            response['nextToken'] = str(start + limit)
+        return response
+
+
+def matches_pattern(message, pattern):
+    """Supports the term subset of Cloudwatch filter patterns: all plain terms must match, or any ?term"""
+    if not pattern:
+        return True
+    terms = [term.strip('"') for term in re.findall(r'\??"[^"]*"|\S+', pattern)]
+    optional = [term[1:].strip('"') for term in terms if term.startswith('?')]
+    required = [term for term in terms if not term.startswith('?')]
+    return all(term in message for term in required) and (not optional or any(term in message for term in optional))
+
+
+class FakeEMR:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.clusters = {}
+
+    def run_job_flow(self, Name, Instances=None, **kwargs):
+        cluster_id = new_id('j')
+        self.clusters[cluster_id] = {'Id': cluster_id, 'Name': Name, 'Status': {'State': 'STARTING'},
+                                     'Tags': kwargs.get('Tags', []), 'Steps': []}
+
+        # Tags of the cluster are propagated to its instances
+        tags = kwargs.get('Tags', []) + [{'Key': 'aws:elasticmapreduce:job-flow-id', 'Value': cluster_id}]
+        for group in (Instances or {}).get('InstanceGroups', []):
+            for _ in range(group['InstanceCount']):
+                self.aws.services['ec2'].launch_instance({'InstanceType': group['InstanceType']
+                                                          , 'SubnetId': Instances.get('Ec2SubnetId')}, tags)
+
+        return {'JobFlowId': cluster_id}
+
+    def describe_cluster(self, ClusterId, **kwargs):
+        cluster = self.clusters[ClusterId]
+        # Clusters start up the moment anyone looks
+        cluster['Status'] = {'State': 'RUNNING'}
+        return {'Cluster': cluster}
+
+    def add_job_flow_steps(self, JobFlowId, Steps, **kwargs):
+        cluster = self.clusters[JobFlowId]
+        step_ids = []
+        for step in Steps:
+            step_ids.append(new_id('s'))
+            cluster['Steps'].append(dict(step, Id=step_ids[-1]))
+        return {'StepIds': step_ids}
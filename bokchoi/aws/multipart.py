@@ -0,0 +1,164 @@
+"""
+File object which streams everything written to it into an S3 multipart upload
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+
+from botocore.exceptions import ClientError
+
+from bokchoi.cache import CACHE_DIR
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartWriter:
+    """Buffers written data into parts and uploads them concurrently. At most concurrency + 1 parts are held in
+    memory at any time; write blocks while all upload slots are taken.
+
+    The upload id is stored locally until the upload completes. When a previous upload of a package with the
+    same fingerprint failed, it is resumed and parts that were already uploaded with the same content are
+    skipped.
+    """
+
+    def __init__(self, s3_client, bucket_name, key, fingerprint, part_size=8 * 1024 * 1024, concurrency=4):
+
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.fingerprint = fingerprint
+        self.part_size = max(part_size, MIN_PART_SIZE)
+
+        self.state_path = os.path.join(CACHE_DIR, 'uploads', '{}-{}.json'.format(bucket_name, key))
+
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency + 1)
+
+        self.buffer = bytearray()
+        self.position = 0
+        self.part_number = 0
+        self.futures = []
+
+        self.upload_id = None
+        self.uploaded_parts = {}
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit(part)
+
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Uploads remaining data and completes the upload. Packages smaller than a single part are uploaded with
+        a single put_object call."""
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket_name
+                                        , Key=self.key
+                                        , Body=bytes(self.buffer)
+                                        , Metadata={'fingerprint': self.fingerprint})
+                return
+
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+
+            parts = [future.result() for future in self.futures]
+
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket_name
+                                                   , Key=self.key
+                                                   , UploadId=self.upload_id
+                                                   , MultipartUpload={'Parts': parts})
+            os.remove(self.state_path)
+        finally:
+            self.executor.shutdown()
+
+    def _submit(self, data):
+        """Schedules upload of a single part, waiting for a free slot first"""
+        self._start()
+
+        self.part_number += 1
+
+        self.slots.acquire()
+        future = self.executor.submit(self._upload_part, self.part_number, data)
+        future.add_done_callback(lambda _: self.slots.release())
+
+        self.futures.append(future)
+
+    def _upload_part(self, part_number, data):
+
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+
+        if self.uploaded_parts.get(part_number) != etag:
+            response = self.s3_client.upload_part(Bucket=self.bucket_name
+                                                , Key=self.key
+                                                , UploadId=self.upload_id
+                                                , PartNumber=part_number
+                                                , Body=data)
+            etag = response['ETag']
+
+        return {'PartNumber': part_number, 'ETag': etag}
+
+    def _start(self):
+        """Resumes previous upload of the same package if there is one, otherwise starts a new upload"""
+        if self.upload_id is not None:
+            return
+
+        try:
+            with open(self.state_path, 'r') as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            state = None
+
+        if state and state['fingerprint'] == self.fingerprint:
+            try:
+                self.uploaded_parts = self._list_parts(state['upload_id'])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    raise e
+            else:
+                self.upload_id = state['upload_id']
+                print('Resuming upload. {} parts already uploaded.'.format(len(self.uploaded_parts)))
+                return
+
+        if state:
+            self._abort(state['upload_id'])
+
+        response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name
+                                                        , Key=self.key
+                                                        , Metadata={'fingerprint': self.fingerprint})
+        self.upload_id = response['UploadId']
+
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'w') as state_file:
+            json.dump({'upload_id': self.upload_id, 'fingerprint': self.fingerprint}, state_file)
+
+    def _list_parts(self, upload_id):
+        """Returns ETags of parts uploaded so far by part number"""
+        paginator = self.s3_client.get_paginator('list_parts')
+        parts = {}
+        for page in paginator.paginate(Bucket=self.bucket_name, Key=self.key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+        return parts
+
+    def _abort(self, upload_id):
+        """Aborts stale upload so its parts don't keep taking up storage"""
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=upload_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise e
@@ -0,0 +1,60 @@
+"""
+Registry of platforms bokchoi can deploy to. Backends are only imported once they're used, so commands don't pay
+for importing the SDKs of platforms they don't use.
+"""
+
+from importlib import import_module
+
+ENTRY_POINT_GROUP = 'bokchoi.backends'
+
+BUILTIN_BACKENDS = {'EC2': 'bokchoi.aws.ec2:EC2',
+                    'EMR': 'bokchoi.aws.emr:EMR',
+                    'GCP': 'bokchoi.gcp.gcp:GCP'}
+
+
+def get_backend(platform):
+    """ Imports and returns backend class of platform. Built-in backends are resolved without scanning installed
+    packages, other platforms are looked up among the bokchoi.backends entry points
+    :param platform:                Platform name, e.g. 'EC2'
+    :return:                        Backend class
+    """
+    if platform in BUILTIN_BACKENDS:
+        return load(BUILTIN_BACKENDS[platform])
+
+    for name, target in entry_points():
+        if name == platform:
+            return load(target)
+
+    raise KeyError('Unknown platform: {}. Available platforms: {}'.format(platform, ', '.join(platforms())))
+
+
+def platforms():
+    """Returns names of all available platforms"""
+    return sorted(set(BUILTIN_BACKENDS) | {name for name, _ in entry_points()})
+
+
+def load(target):
+    """ Imports object from 'module:attribute' string
+    :param target:                  Object reference
+    :return:                        Object
+    """
+    module_name, _, attribute = target.partition(':')
+    return getattr(import_module(module_name), attribute)
+
+
+def entry_points():
+    """Returns (name, target) of all registered backend entry points"""
+    try:
+        from importlib.metadata import entry_points as metadata_entry_points
+    except ImportError:
+        import pkg_resources
+        return [(ep.name, '{}:{}'.format(ep.module_name, '.'.join(ep.attrs)))
+                for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)]
+
+    found = metadata_entry_points()
+    if hasattr(found, 'select'):
+        found = found.select(group=ENTRY_POINT_GROUP)
+    else:
+        found = found.get(ENTRY_POINT_GROUP, [])
+
+    return [(ep.name, ep.value) for ep in found]
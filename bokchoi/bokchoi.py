@@ -1,7 +1,8 @@
 
+from bokchoi import utils
+from bokchoi.backends import get_backend
+from bokchoi.cache import PackageCache
 from bokchoi.config import Config
-from bokchoi.aws import EMR, EC2
-from bokchoi.gcp import GCP
 
 
 def requires_config(fn):
@@ -19,8 +20,6 @@ def requires_config(fn):
 
 class Bokchoi:
 
-    backends = {'EC2': EC2, 'EMR': EMR, 'GCP': GCP}
-
     def __init__(self, path):
 
         self.config = Config(path)
@@ -29,8 +28,11 @@ class Bokchoi:
             self.config.load()
         except FileNotFoundError:
             print('Config not found')
-        else:
-            self.backend = self.backends[self.config['Platform']](self.config.name, self.config)
+
+    @utils.lazy_property
+    def backend(self):
+        """Backend of the configured platform. Only created once a command needs it"""
+        return get_backend(self.config['Platform'])(self.config.name, self.config)
 
     def init(self, name, platform):
         """ Initialise new project
@@ -41,7 +43,7 @@ class Bokchoi:
 
         if self.config.loaded:
             return 'Project already initialised. Deploy using \'bokchoi deploy\'.'
-        self.config.init(name, platform, self.backends[platform].default_config)
+        self.config.init(name, platform, get_backend(platform).default_config)
 
         return 'Project initialised. Deploy using \'bokchoi deploy\'.'
 
@@ -50,28 +52,90 @@ class Bokchoi:
         print('Deploying: ' + self.config.name)
         return self.backend.deploy(path=self.config.path)
 
+    @requires_config
+    def package(self, output=None, report=False):
+        """ Build deployment package locally
+        :param output:              File to write package to. Package is only measured if not given
+        :param report:              Print largest contributors to package size
+        :return:                    Response object
+        """
+        requirements = self.config.get('Requirements', [])
+        cache = PackageCache()
+
+        files, fingerprint = utils.package_manifest(self.config.path, requirements, cache, self.config.get('Exclude'))
+
+        if output:
+            with open(output, 'wb') as file_object:
+                infos = utils.write_package(file_object, files, requirements, cache)
+                package_size = file_object.tell()
+        else:
+            counter = utils.ByteCounter()
+            infos = utils.write_package(counter, files, requirements, cache)
+            package_size = counter.tell()
+
+        if report:
+            print(utils.package_report(infos, package_size))
+
+        if output:
+            return 'Package written to ' + output
+        return 'Package fingerprint: ' + fingerprint
+
     @requires_config
     def undeploy(self, dryrun):
         print('Undeploying: ' + self.config.name)
         return self.backend.undeploy(dryrun)
 
     @requires_config
-    def run(self):
+    def run(self, wait=False):
         print('Running: ' + self.config.name)
-        return self.backend.run()
+        return self.backend.run(wait=wait)
+
+    @requires_config
+    def bake(self):
+        if not hasattr(self.backend, 'bake'):
+            return 'Baking images is not supported on ' + self.config['Platform']
+        print('Baking: ' + self.config.name)
+        return self.backend.bake()
+
+    @requires_config
+    def trace(self, last=5, export=None):
+        if not hasattr(self.backend, 'trace'):
+            return 'Tracing is not supported on ' + self.config['Platform']
+        return self.backend.trace(last, export)
 
     @requires_config
     def stop(self, *args, **kwargs):
         return self.backend.stop(*args, **kwargs)
 
     @requires_config
-    def connect(self, dryrun, *args, **kwargs):
-        self.backend.connect(dryrun, *args, **kwargs)
+    def connect(self, *args, **kwargs):
+        self.backend.connect(*args, **kwargs)
 
     @requires_config
     def status(self):
         return self.backend.status()
 
+    @staticmethod
+    def status_all(directories=()):
+        """ Status of several AWS projects in one table
+        :param directories:         Project directories. All projects in the account are shown if none are given
+        :return:                    Table
+        """
+        project_ids = None
+        if directories:
+            project_ids = []
+            for directory in directories:
+                project = Bokchoi(directory)
+                if not project.config.loaded:
+                    continue
+                if project.config['Platform'] not in ('EC2', 'EMR'):
+                    print('Skipping {}, status of {} projects is not supported'.format(
+                        project.config.name, project.config['Platform']))
+                    continue
+                project_ids.append(project.backend.project_id)
+
+        return get_backend('EC2').status_all(project_ids)
+
     @requires_config
-    def logs(self):
-        return self.backend.logs()
+    def logs(self, *args, **kwargs):
+        return self.backend.logs(*args, **kwargs)
@@ -0,0 +1,192 @@
+"""
+Local on-disk caches used to speed up repeated bokchoi commands
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import time
+import zlib
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.bokchoi', 'cache')
+
+HASH_BLOCK_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+
+def hash_file(file_path):
+    """ Returns sha256 hex digest of file contents. Large files are hashed through a memory map, which avoids
+    copying them through read buffers
+    :param file_path:               Path to file
+    :return:                        Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as _file:
+        if os.fstat(_file.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            for block in iter(lambda: _file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class PackageCache:
+    """Stores deflated package entries on disk so unchanged files don't have to be compressed again.
+
+    Entries are stored by content hash. An index maps each file path to the size, mtime and content hash
+    it had when it was last seen, so files that haven't been touched don't even have to be re-read to find
+    their cached entry or to fingerprint the package. Least recently used entries are evicted once the cache
+    exceeds max_size bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_size=512 * 1024 * 1024):
+
+        self.cache_dir = cache_dir or os.path.join(CACHE_DIR, 'package')
+        self.blob_dir = os.path.join(self.cache_dir, 'blobs')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.max_size = max_size
+        self.opened = time.time()
+        self.seen = set()
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        try:
+            with open(self.index_path, 'r') as index_file:
+                index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            index = {}
+
+        self.files = index.get('files', {})
+        self.blobs = index.get('blobs', {})
+
+    def content_hash(self, file_path):
+        """ Returns content hash of file. The file is only read if its size or mtime changed since it was last hashed
+        :param file_path:           Path to file
+        :return:                    Hex digest
+        """
+        stat = os.stat(file_path)
+        file_path = os.path.abspath(file_path)
+        self.seen.add(file_path)
+
+        known = self.files.get(file_path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['hash']
+
+        content_hash = hash_file(file_path)
+        self.files[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash}
+        return content_hash
+
+    def lookup(self, file_path):
+        """ Returns cached entry for file, compressing and storing it first if it isn't cached yet
+        :param file_path:           Path to file
+        :return:                    Tuple of (CRC, uncompressed size, content hash)
+        """
+        content_hash = self.content_hash(file_path)
+
+        blob = self.blobs.get(content_hash)
+
+        if not blob or not os.path.exists(self._blob_path(content_hash)):
+            with open(file_path, 'rb') as _file:
+                raw = _file.read()
+            data = compress(raw)
+            blob = {'crc': zlib.crc32(raw) & 0xffffffff, 'size': len(raw), 'compressed_size': len(data)}
+            with open(self._blob_path(content_hash), 'wb') as blob_file:
+                blob_file.write(data)
+            self.blobs[content_hash] = blob
+
+        blob['used'] = time.time()
+
+        return blob['crc'], blob['size'], content_hash
+
+    def read(self, content_hash):
+        """ Returns deflated data of cached entry
+        :param content_hash:        Content hash returned by lookup
+        :return:                    Deflated data
+        """
+        with open(self._blob_path(content_hash), 'rb') as blob_file:
+            return blob_file.read()
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash)
+
+    def save(self):
+        """Evicts least recently used entries until the cache fits its budget and writes the index. Entries used
+        since the cache was opened are kept, as they may still be needed to write the current package."""
+        total = sum(blob['compressed_size'] for blob in self.blobs.values())
+
+        for content_hash, blob in sorted(self.blobs.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_size or blob['used'] >= self.opened:
+                break
+            try:
+                os.remove(self._blob_path(content_hash))
+            except FileNotFoundError:
+                pass
+            total -= blob['compressed_size']
+            del self.blobs[content_hash]
+
+        self.files = {path: known for path, known in self.files.items()
+                      if known['hash'] in self.blobs or path in self.seen}
+
+        with open(self.index_path, 'w') as index_file:
+            json.dump({'files': self.files, 'blobs': self.blobs}, index_file)
+
+
+class TTLCache:
+    """Small JSON store for values that are slow to look up but rarely change, such as the AWS account id. Values
+    expire ttl seconds after they were stored."""
+
+    def __init__(self, path=None, ttl=24 * 3600):
+
+        self.path = path or os.path.join(CACHE_DIR, 'identity.json')
+        self.ttl = ttl
+
+        try:
+            with open(self.path, 'r') as cache_file:
+                self.values = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            self.values = {}
+
+    def get(self, key, compute, ttl=None):
+        """ Returns cached value, calling compute and storing its result if the value is missing or expired
+        :param key:                 Cache key
+        :param compute:             Function without arguments returning the value
+        :param ttl:                 Seconds the value stays valid, defaults to the ttl of the cache
+        :return:                    Value
+        """
+        entry = self.values.get(key)
+
+        if entry and entry['expires'] > time.time():
+            return entry['value']
+
+        value = compute()
+        self.values[key] = {'value': value, 'expires': time.time() + (self.ttl if ttl is None else ttl)}
+        self.save()
+
+        return value
+
+    def invalidate(self, key):
+        if self.values.pop(key, None) is not None:
+            self.save()
+
+    def save(self):
+        """Writes cache through a temporary file, so concurrent commands never read a partially written cache"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        now = time.time()
+        values = {key: entry for key, entry in self.values.items() if entry['expires'] > now}
+
+        temp_path = '{}.{}'.format(self.path, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            json.dump(values, cache_file)
+        os.replace(temp_path, self.path)
+
+
+def compress(data):
+    """ Deflates data the way zipfile does for ZIP_DEFLATED entries
+    :param data:                    Bytes to compress
+    :return:                        Raw deflate stream
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
@@ -29,6 +29,15 @@ def deploy(directory):
     click.secho(response, fg='green')
 
 
+@cli.command('package', help='Build deployment package locally')
+@click.option('--directory', '-d', default='.', help="Application directory")
+@click.option('--output', '-o', default=None, help="File to write package to")
+@click.option('--report', is_flag=True, default=False, help="Print largest contributors to package size")
+def package(directory, output, report):
+    response = Bokchoi(directory).package(output, report)
+    click.secho(response, fg='green')
+
+
 @cli.command('undeploy', help='Remove your project deployment')
 @click.option('--directory', '-d', default='.', help="Application directory")
 @click.option('--dryrun', is_flag=True, default=False, help="Only prints actions")
@@ -39,11 +48,27 @@ def undeploy(directory, dryrun):
 
 @cli.command('run', help='Run your application')
 @click.option('--directory', '-d', default='.', help="Application directory")
-def run(directory):
-    response = Bokchoi(directory).run()
+@click.option('--wait', is_flag=True, default=False, help="Wait until instances are running")
+def run(directory, wait):
+    response = Bokchoi(directory).run(wait)
     click.secho(response, fg='green')
 
 
+@cli.command('bake', help='Build an image with your requirements preinstalled')
+@click.option('--directory', '-d', default='.', help="Application directory")
+def bake(directory):
+    response = Bokchoi(directory).bake()
+    click.secho(response, fg='green')
+
+
+@cli.command('trace', help='Show how long the phases of recent deploys and runs took')
+@click.option('--directory', '-d', default='.', help="Application directory")
+@click.option('--last', '-n', type=int, default=5, help="Number of deploys and runs to show")
+@click.option('--export', default=None, help="Write spans to file in Trace Event Format, e.g. for chrome://tracing")
+def trace(directory, last, export):
+    click.echo(Bokchoi(directory).trace(last, export))
+
+
 @cli.command('stop', help='Stop any running applications')
 @click.option('--directory', '-d', default='.', help="Application directory")
 @click.option('--dryrun', is_flag=True, default=False, help="Print in stead of terminate")
@@ -52,21 +77,50 @@ def stop(directory, dryrun):
     click.secho(response, fg='green')
 
 
+def parse_forward(ctx, param, values):
+    """Parses LOCAL:REMOTE port pairs, a single port forwards to the same port"""
+    forwards = []
+    for value in values:
+        local_port, _, remote_port = value.partition(':')
+        try:
+            forwards.append((int(local_port), int(remote_port or local_port)))
+        except ValueError:
+            raise click.BadParameter('{} is not a port or LOCAL:REMOTE port pair'.format(value))
+    return forwards
+
+
 @cli.command('connect', help='Connect to your running application')
 @click.option('--directory', '-d', default='.', help="Application directory")
-@click.option('--local-port', help='Local port to bind to')
-@click.option('--remote-port', help='Remote port to bind to')
-def connect(directory, local_port, remote_port):
-    Bokchoi(directory).connect(local_port, remote_port)
+@click.option('--local-port', type=int, help='Local port to bind to')
+@click.option('--remote-port', type=int, help='Remote port to bind to')
+@click.option('--forward', '-L', multiple=True, callback=parse_forward, metavar='LOCAL:REMOTE'
+              , help='Forward local port to remote port. Can be repeated.')
+@click.option('--stats', is_flag=True, default=False, help="Print connection and channel stats")
+@click.option('--close', is_flag=True, default=False, help="Close connection and forwarded ports")
+@click.option('--exec', 'command', default=None, help="Run command on instance over the connection")
+def connect(directory, local_port, remote_port, forward, stats, close, command):
+    if local_port or remote_port or not forward:
+        forward.append((local_port or 8888, remote_port or 8888))
+    Bokchoi(directory).connect(forward, stats=stats, close=close, command=command)
 
 
 @cli.command('status', help='Status of deployed project')
 @click.option('--directory', '-d', default='.', help="Application directory")
-def status(directory):
-    Bokchoi(directory).status()
+@click.option('--all', 'all_projects', is_flag=True, default=False
+              , help="Show all projects in the account, or the projects in DIRECTORIES, in one table")
+@click.argument('directories', nargs=-1)
+def status(directory, all_projects, directories):
+    if all_projects or directories:
+        click.echo(Bokchoi.status_all(directories))
+    else:
+        Bokchoi(directory).status()
 
 
 @cli.command('logs', help='View logs of current or latest run')
 @click.option('--directory', '-d', default='.', help="Application directory")
-def logs(directory):
-    Bokchoi(directory).logs()
+@click.option('--follow/--no-follow', default=True, help="Keep reading until the run has finished")
+@click.option('--since', default=None, help="Only show messages after this time, e.g. 10m, 2h or 2018-06-01T12:00")
+@click.option('--grep', default=None, help="Only show messages containing this term")
+@click.option('--tail', type=int, default=None, help="Start with the last N messages")
+def logs(directory, follow, since, grep, tail):
+    Bokchoi(directory).logs(follow=follow, since=since, grep=grep, tail=tail)
@@ -0,0 +1,141 @@
+"""
+Client side of the SSH control daemon. The daemon (bokchoi.ssh.ControlDaemon) keeps one authenticated SSH transport
+to an instance open in the background and listens on a unix socket next to its log file. Every request is a line of
+JSON answered by a line of JSON; requests for a channel turn the connection into the channel once answered.
+
+Doesn't import paramiko, so commands can talk to a running daemon without loading it.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+CONTROL_DIR = os.path.join(os.path.expanduser('~'), '.bokchoi', 'control')
+
+# The daemon retries connecting for a minute while the instance boots
+START_TIMEOUT = 90
+
+
+def socket_path(project_id, host):
+    """Path of the control socket of the daemon connected to host"""
+    return os.path.join(CONTROL_DIR, '{}-{}.sock'.format(project_id, host))
+
+
+def log_path(path):
+    """Path of the log file of the daemon listening on control socket path"""
+    return os.path.splitext(path)[0] + '.log'
+
+
+def request(path, message):
+    """ Sends request to daemon
+    :param path:                    Control socket path
+    :param message:                 Dict with at least 'op'
+    :return:                        Reply dict
+    """
+    with _connect(path) as sock:
+        return _send(sock, message)
+
+
+def attach(path, message):
+    """ Requests a channel from daemon
+    :param path:                    Control socket path
+    :param message:                 Dict with 'op' 'channel' and a 'port', or 'exec' and a 'command'
+    :return:                        Socket relayed to the channel
+    """
+    sock = _connect(path)
+    try:
+        _send(sock, message)
+    except (OSError, ValueError):
+        sock.close()
+        raise
+    return sock
+
+
+def is_alive(path):
+    """Whether a daemon is listening on control socket path"""
+    try:
+        request(path, {'op': 'ping'})
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def start_daemon(path, host, user_name, private_key_name):
+    """ Starts daemon in the background and waits until it's connected
+    :param path:                    Control socket path
+    :param host:                    Host to connect to
+    :param user_name:               User to use in ssh connection
+    :param private_key_name:        Name of private key in ~/.ssh
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(log_path(path), 'a') as log:
+        command = [sys.executable, '-u', '-m', 'bokchoi.ssh', path, host, user_name, private_key_name]
+        process = subprocess.Popen(command
+                                   , stdin=subprocess.DEVNULL
+                                   , stdout=log
+                                   , stderr=subprocess.STDOUT
+                                   , start_new_session=True)
+
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if is_alive(path):
+            return
+        if process.poll() is not None:
+            raise ConnectionError('Could not connect to {}, see {}'.format(host, log_path(path)))
+        time.sleep(0.1)
+
+    process.terminate()
+    raise TimeoutError()
+
+
+def format_stats(stats):
+    """ Formats stats reply of daemon
+    :param stats:                   Reply to 'stats' request
+    :return:                        Text
+    """
+    lines = ['Connected to {} since {}, reconnected {} times'.format(
+        stats['host'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['connected_since']))
+        , stats['reconnects'])]
+
+    for local_port, remote_port in stats['forwards']:
+        lines.append('Forwarding localhost:{} to {}:{}'.format(local_port, stats['host'], remote_port))
+
+    lines.append('{:<32} {:>12} {:>12} {:>10} {:>10}'.format('channel', 'sent', 'received', 'pending', 'seconds'))
+    for connection in stats['connections']:
+        lines.append('{label:<32} {sent:>12} {received:>12} {pending:>10} {seconds:>10}'.format(**connection))
+    for label, totals in sorted(stats['closed'].items()):
+        lines.append('{:<32} {:>12} {:>12} {:>10} {:>10}'.format(
+            '{} ({} closed)'.format(label, totals['connections']), totals['sent'], totals['received'], '-', '-'))
+
+    return '\n'.join(lines)
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _send(sock, message):
+    """Sends request and reads the reply, byte by byte so nothing sent on a channel after it is consumed"""
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+    line = bytearray()
+    while not line.endswith(b'\n'):
+        data = sock.recv(1)
+        if not data:
+            raise ConnectionError('Control daemon closed the connection')
+        line += data
+
+    reply = json.loads(line.decode())
+    if 'error' in reply:
+        raise ConnectionError(reply['error'])
+    return reply
@@ -0,0 +1,150 @@
+"""
+File object which streams everything written to it into parts in Google Storage, composed into one blob on close
+"""
+
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
+
+from google.api_core import exceptions
+
+# Maximum number of sources of a single compose request
+MAX_COMPOSE_SOURCES = 32
+
+
+class CompositeWriter:
+    """Buffers written data into parts and uploads them concurrently as separate blobs, which are composed into
+    the target blob server-side once everything is written. At most concurrency + 1 parts are held in memory at any
+    time; write blocks while all upload slots are taken.
+
+    Parts are named after the package fingerprint, so when a previous upload of the same package failed, parts that
+    were already uploaded with the same content are skipped. Parts of other packages are removed on close.
+    """
+
+    def __init__(self, bucket, name, fingerprint, part_size=8 * 1024 * 1024, concurrency=4):
+
+        self.bucket = bucket
+        self.name = name
+        self.fingerprint = fingerprint
+        self.part_size = part_size
+
+        self.parts_prefix = '{}.parts/'.format(name)
+        self.prefix = '{}{}/'.format(self.parts_prefix, fingerprint[:16])
+
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency + 1)
+
+        self.buffer = bytearray()
+        self.position = 0
+        self.part_number = 0
+        self.futures = []
+
+        self.uploaded_parts = None
+        self.stale_parts = []
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit(part)
+
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Uploads remaining data, composes the parts and removes them. Packages smaller than a single part are
+        uploaded as a single blob."""
+        try:
+            if self.uploaded_parts is None:
+                blob = self.bucket.blob(self.name)
+                blob.metadata = {'fingerprint': self.fingerprint}
+                blob.upload_from_string(bytes(self.buffer))
+                return
+
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+
+            parts = [future.result() for future in self.futures]
+            used = parts + self._compose(parts)
+
+            # Parts of a larger earlier attempt at this package aren't overwritten, so they're removed as well
+            names = {blob.name for blob in used}
+            leftovers = [self.bucket.blob(name) for name in self.uploaded_parts if name not in names]
+            list(self.executor.map(self._delete, used + leftovers + self.stale_parts))
+        finally:
+            self.executor.shutdown()
+
+    def _submit(self, data):
+        """Schedules upload of a single part, waiting for a free slot first"""
+        self._start()
+
+        self.part_number += 1
+
+        self.slots.acquire()
+        future = self.executor.submit(self._upload_part, self.part_number, data)
+        future.add_done_callback(lambda _: self.slots.release())
+
+        self.futures.append(future)
+
+    def _upload_part(self, part_number, data):
+
+        blob = self.bucket.blob('{}{:05d}'.format(self.prefix, part_number))
+
+        if self.uploaded_parts.get(blob.name) != b64encode(hashlib.md5(data).digest()).decode():
+            blob.upload_from_string(data)
+
+        return blob
+
+    def _compose(self, parts):
+        """ Composes parts into the target blob. More parts than a single request takes are composed in groups first
+        :return:                        Intermediate blobs
+        """
+        intermediates = []
+        level = 0
+
+        while len(parts) > MAX_COMPOSE_SOURCES:
+            level += 1
+            groups = [parts[start:start + MAX_COMPOSE_SOURCES] for start in range(0, len(parts), MAX_COMPOSE_SOURCES)]
+            names = ['{}composed-{}-{:05d}'.format(self.prefix, level, index) for index in range(len(groups))]
+            parts = list(self.executor.map(self._compose_blob, names, groups))
+            intermediates += parts
+
+        self._compose_blob(self.name, parts, {'fingerprint': self.fingerprint})
+        return intermediates
+
+    def _compose_blob(self, name, sources, metadata=None):
+        blob = self.bucket.blob(name)
+        if metadata:
+            blob.metadata = metadata
+        blob.compose(sources)
+        return blob
+
+    def _delete(self, blob):
+        try:
+            blob.delete()
+        except exceptions.GoogleAPICallError as e:
+            print('Could not remove {}: {}'.format(blob.name, e))
+
+    def _start(self):
+        """Looks up parts left behind by earlier uploads, keeping those of this package"""
+        if self.uploaded_parts is not None:
+            return
+
+        self.uploaded_parts = {}
+        for blob in self.bucket.list_blobs(prefix=self.parts_prefix):
+            if blob.name.startswith(self.prefix):
+                self.uploaded_parts[blob.name] = blob.md5_hash
+            else:
+                self.stale_parts.append(blob)
+
+        if self.uploaded_parts:
+            print('Resuming upload. {} parts already uploaded.'.format(len(self.uploaded_parts)))
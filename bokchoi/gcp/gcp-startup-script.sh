@@ -18,10 +18,67 @@ ENTRYPOINT=$(curl http://metadata/computeMetadata/v1/instance/attributes/entry_p
 INSTANCE_NAME=$(curl http://metadata/computeMetadata/v1/instance/attributes/instance_name -H "Metadata-Flavor: Google")
 ZONE=$(curl http://metadata/computeMetadata/v1/instance/attributes/zone -H "Metadata-Flavor: Google")
 
+# Exports the run id, shard index, shard count, parameters and label of this instance
+curl http://metadata/computeMetadata/v1/instance/attributes/shard_environment -H "Metadata-Flavor: Google" > shard.env
+. ./shard.env
+
+# Everything logged is uploaded in chunks every few seconds while the job runs, 'bokchoi logs' reads them in order.
+# Once logs-done exists and the last chunk is uploaded, an empty 'done' object marks the end of the instance's part.
+# Instances of runs with more than one instance upload under their label.
+LOG_PREFIX=gs://${BUCKET_NAME}/${PACKAGE_NAME}-logs/${BOKCHOI_RUN_ID}${BOKCHOI_INSTANCE_LABEL:+/${BOKCHOI_INSTANCE_LABEL}}
+LOG_INTERVAL=5
+
+ship_logs() {
+    SHIPPED=0
+    CHUNK=0
+    while true
+    do
+        # Checked before measuring, so everything logged before the end is in the last chunk
+        [ -f logs-done ] && LAST=1
+        SIZE=$(stat -c %s logs.txt)
+        if [ ${SIZE} -gt ${SHIPPED} ]
+        then
+            tail -c +$((SHIPPED + 1)) logs.txt | head -c $((SIZE - SHIPPED)) > log-chunk
+            if gsutil -q cp log-chunk ${LOG_PREFIX}/$(printf '%06d' ${CHUNK})
+            then
+                SHIPPED=${SIZE}
+                CHUNK=$((CHUNK + 1))
+            fi
+        fi
+        if [ -n "${LAST}" ] && [ ${SIZE} -eq ${SHIPPED} ]
+        then
+            break
+        fi
+        sleep ${LOG_INTERVAL}
+    done
+    echo -n | gsutil -q cp - ${LOG_PREFIX}/done
+}
+
+touch logs.txt
+ship_logs &
+SHIPPER=$!
+
 gsutil cp gs://${BUCKET_NAME}/${PACKAGE_NAME} .
 unzip ${PACKAGE_NAME}
 
-python3 -m pip install -r requirements.txt >> logs.txt 2>&1
+# Install requirements from the project's wheelhouse. The first instance to run with a new set of requirements
+# builds it and uploads it to the bucket. Only a complete wheelhouse is uploaded, under a temporary name first so
+# other instances never download a partial upload.
+WHEELHOUSE=gs://${BUCKET_NAME}/$(curl http://metadata/computeMetadata/v1/instance/attributes/wheelhouse -H "Metadata-Flavor: Google")
+mkdir -p wheelhouse
+if gsutil cp ${WHEELHOUSE} wheelhouse.tar.gz
+then
+    tar -xzf wheelhouse.tar.gz -C wheelhouse
+else
+    python3 -m pip wheel -r requirements.txt -w wheelhouse >> logs.txt 2>&1 \
+        && tar -czf wheelhouse.tar.gz -C wheelhouse . \
+        && gsutil cp wheelhouse.tar.gz ${WHEELHOUSE}.${INSTANCE_NAME}.tmp \
+        && gsutil mv ${WHEELHOUSE}.${INSTANCE_NAME}.tmp ${WHEELHOUSE}
+fi
+
+python3 -m pip install --no-index --find-links wheelhouse -r requirements.txt >> logs.txt 2>&1
 python3 ${ENTRYPOINT} >> logs.txt 2>&1
-gsutil cp logs.txt gs://${BUCKET_NAME}/${PACKAGE_NAME}-logs.txt
+touch logs-done
+wait ${SHIPPER}
+gsutil cp logs.txt gs://${BUCKET_NAME}/${PACKAGE_NAME}-logs${BOKCHOI_INSTANCE_LABEL:+-${BOKCHOI_INSTANCE_LABEL}}.txt
 gcloud compute instances delete ${INSTANCE_NAME} --zone ${ZONE}
@@ -3,10 +3,16 @@ Can be used to run Bokchoi on the Google Cloud using Google Compute Engines
 
 """
 
+from concurrent import futures
+import hashlib
+import json
 import os
-import sys
+import re
+import threading
 import time
 import bokchoi.utils
+from bokchoi.cache import PackageCache
+from bokchoi.gcp.composite import CompositeWriter
 
 import googleapiclient.discovery
 import googleapiclient.errors
@@ -15,6 +21,35 @@ from google.auth import exceptions as auth_except, default
 from google.oauth2 import service_account
 from google.cloud import storage, exceptions
 
+IMAGE_FAMILY = 'ubuntu-1804-lts'
+
+# Requests sent in a single batch HTTP request
+BATCH_SIZE = 100
+
+# Labels of instances, selecting those of a project or of a single run
+PROJECT_LABEL = 'bokchoi_project'
+RUN_LABEL = 'bokchoi_run'
+
+# Retries of API calls failing with a server error or rate limit, with exponential backoff between them
+NUM_RETRIES = 5
+
+# Seconds between checks whether the job's instances still exist, growing while the job keeps running
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 30
+
+# Instances delete themselves once the job is done. Deleting stops them first; preemption stops them as well
+FINISHED_STATUSES = ('STOPPING', 'STOPPED', 'SUSPENDING', 'SUSPENDED', 'TERMINATED')
+
+# Seconds between polls for new log chunks, growing while the job is quiet
+MIN_LOG_POLL_INTERVAL = 0.5
+MAX_LOG_POLL_INTERVAL = 10
+
+# Object written after the last log chunk of a run
+LOG_DONE = 'done'
+
+# Object next to the log chunks of a run holding the number of instances it started
+LOG_INSTANCES = 'instances'
+
 
 class GCP(object):
     """Run Bokchoi on the Google Cloud using Google Compute Engines"""
@@ -22,11 +57,32 @@ class GCP(object):
         self.project_name = bokchoi_project_name
         self.entry_point = settings['EntryPoint']
         self.requirements = settings.get('Requirements', [])
+        self.exclude = settings.get('Exclude')
         self.wait_for_execution = settings.get("WaitForExecution", False)
+        self.upload_options = bokchoi.utils.upload_options(settings)
+        self.package_name = '{}-{}.zip'.format(self.project_name, 'package')
+        # Instances, templates and labels only take lowercase letters, digits and dashes
+        self.resource_name = re.sub('[^a-z0-9-]', '-', self.project_name.lower())[:40].strip('-')
+        # Log chunks of every run are stored under the run id, e.g. 'bokchoi-1528100000/000003'
+        self.log_prefix = self.package_name + '-logs/'
         self.gcp = self.retrieve_gcp_settings(settings)
-        self.credentials = self.authorize_client()
-        self.compute = self.get_authorized_compute()
-        self.storage = self.get_authorized_storage()
+
+    @bokchoi.utils.lazy_property
+    def credentials(self):
+        return self.authorize_client()
+
+    @bokchoi.utils.lazy_property
+    def compute(self):
+        return self.get_authorized_compute()
+
+    @bokchoi.utils.lazy_property
+    def storage(self):
+        return self.get_authorized_storage()
+
+    @bokchoi.utils.lazy_property
+    def bucket(self):
+        """Handle of the project bucket. Creating it doesn't make a request, unlike storage.get_bucket"""
+        return self.storage.bucket(self.gcp.get('bucket'))
 
     def authorize_client(self):
         """If the environment variable GOOGLE_APPLICATION_CREDENTIALS or If the Google Cloud SDK is
@@ -82,42 +138,137 @@ class GCP(object):
             'sub_network': gcp.get('SubNetwork', 'regions/{}/subnetworks/default'.format(region)),
             'instance_type': gcp.get('InstanceType', 'n1-standard-1'),
             'preemptible': gcp.get('Preemptible', False),
-            'disk_space': gcp.get('DiskSpaceGb', 25)
+            'disk_space': gcp.get('DiskSpaceGb', 25),
+            'instance_count': gcp.get('InstanceCount', 1),
+            'matrix': gcp.get('Matrix')
         }
 
-    def list_instances(self):
-        """List names of all existing instances"""
-        result = self.compute.instances().list(
+    @property
+    def instance_count(self):
+        """Number of instances in a run: InstanceCount for each point of the parameter matrix"""
+        return self.gcp.get('instance_count') * len(bokchoi.utils.expand_matrix(self.gcp.get('matrix')))
+
+    def execute_batch(self, requests):
+        """Executes API requests in batches, so many requests take a single HTTP round trip per BATCH_SIZE.
+        Requests failing with a server error or rate limit are retried with exponential backoff.
+        :arg requests: googleapiclient requests
+        :return: list with the response of each request, or the HttpError it failed with
+        """
+        results = [None] * len(requests)
+        pending = list(range(len(requests)))
+
+        for attempt in range(NUM_RETRIES + 1):
+            if attempt:
+                time.sleep(2 ** attempt)
+
+            def callback(request_id, response, exception):
+                results[int(request_id)] = exception if exception is not None else response
+
+            for start in range(0, len(pending), BATCH_SIZE):
+                batch = self.compute.new_batch_http_request(callback=callback)
+                for index in pending[start:start + BATCH_SIZE]:
+                    batch.add(requests[index], request_id=str(index))
+                batch.execute()
+
+            pending = [index for index in pending if isinstance(results[index], googleapiclient.errors.HttpError)
+                       and (results[index].resp.status >= 500 or results[index].resp.status == 429)]
+            if not pending:
+                break
+
+        return results
+
+    def describe_instances(self, filter=None):
+        """List all existing instances
+        :arg filter: only list instances matching this filter expression, e.g. 'labels.bokchoi_run = bokchoi-1'
+        :return: list of instance resources
+        """
+        instances = []
+        request = self.compute.instances().list(
             project=self.gcp.get('project'),
-            zone=self.gcp.get('zone')).execute()
-        instances = [x['name'] for x in result['items']]
+            zone=self.gcp.get('zone'),
+            filter=filter)
+        while request is not None:
+            result = request.execute(num_retries=NUM_RETRIES)
+            instances += result.get('items', [])
+            request = self.compute.instances().list_next(previous_request=request, previous_response=result)
         return instances
 
-    def define_instance_config(self):
+    def list_instances(self, filter=None):
+        """List names of all existing instances
+        :arg filter: only list instances matching this filter expression
         """
-        Set up a compute engine configuration based on the user's input
-        :return: Defined Compute Engine configuration
+        return [instance['name'] for instance in self.describe_instances(filter)]
+
+    def watch_instances(self, run_id, names, on_finished):
+        """Checks in the background whether the instances of a run have finished. A single call looks up every
+        instance of the run by its label, backing off while they keep running.
+        :arg run_id: id of the run
+        :arg names: names of the instances
+        :arg on_finished: called with a dict of the status each instance was last seen in, None once it's deleted
+        :return: the watching thread
         """
-        image_response = self.compute.images().getFromFamily(
-            project='ubuntu-os-cloud', family='ubuntu-1804-lts').execute()
-
-        machine_type = "zones/{}/machineTypes/{}".format(
-            self.gcp.get('zone'), self.gcp.get('instance_type'))
-
+        def watch():
+            delay = MIN_POLL_INTERVAL
+            while True:
+                try:
+                    instances = self.describe_instances('labels.{} = {}'.format(RUN_LABEL, run_id))
+                except googleapiclient.errors.HttpError as e:
+                    print('Could not look up instances of {}: {}'.format(run_id, e))
+                    on_finished({name: 'UNKNOWN' for name in names})
+                    return
+
+                statuses = {instance['name']: instance['status'] for instance in instances}
+                if all(statuses.get(name) in FINISHED_STATUSES + (None,) for name in names):
+                    on_finished({name: statuses.get(name) for name in names})
+                    return
+
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        return thread
+
+    def metadata_items(self):
+        """Metadata shared by all instances of the project"""
         gcp_script = os.path.join(os.path.dirname(__file__), 'gcp-startup-script.sh')
         with open(gcp_script, 'r') as script:
             startup_script = script.read()
 
-        config = {
-            'name': self.project_name,
-            'machineType': machine_type,
+        return [{
+            'key': 'startup-script',
+            'value': startup_script
+        }, {
+            'key': 'bucket_name',
+            'value': self.gcp.get('bucket')
+        }, {
+            'key': 'package_name',
+            'value': self.package_name
+        }, {
+            'key': 'wheelhouse',
+            'value': bokchoi.utils.wheelhouse_key(self.requirements_hash())
+        }, {
+            'key': 'entry_point',
+            'value': self.entry_point
+        }, {
+            'key': 'zone',
+            'value': self.gcp.get('zone')
+        }]
+
+    def define_instance_properties(self):
+        """
+        Set up the properties of the project's instance template based on the user's input
+        :return: Defined instance properties
+        """
+        return {
+            'machineType': self.gcp.get('instance_type'),
 
             'disks': [
                 {
                     'boot': True,
                     'autoDelete': True,
                     'initializeParams': {
-                        'sourceImage': image_response['selfLink'],
+                        'sourceImage': 'projects/ubuntu-os-cloud/global/images/family/' + IMAGE_FAMILY,
                         'diskSizeGb': self.gcp.get('disk_space')
                     }
                 }
@@ -143,76 +294,161 @@ class GCP(object):
                 ]
             }],
 
+            'labels': {PROJECT_LABEL: self.resource_name},
+
             'metadata': {
-                'items': [{
-                    'key': 'startup-script',
-                    'value': startup_script
-                }, {
-                    'key': 'bucket_name',
-                    'value': self.gcp.get('bucket')
-                }, {
-                    'key': 'package_name',
-                    'value': '{}-{}.zip'.format(self.project_name, 'package')
-                }, {
-                    'key': 'entry_point',
-                    'value': self.entry_point
-                }, {
-                    'key': 'instance_name',
-                    'value': self.project_name
-                }, {
-                    'key': 'zone',
-                    'value': self.gcp.get('zone')
-                }]
+                'items': self.metadata_items()
             }
         }
 
-        return config
+    def ensure_instance_template(self):
+        """Get the instance template for the current settings, creating it if it doesn't exist yet. Templates are
+        named after a hash of their properties, so they're reused by every run until the settings change.
+        :return: url of the instance template
+        """
+        properties = self.define_instance_properties()
+        digest = hashlib.sha256(json.dumps(properties, sort_keys=True).encode()).hexdigest()
+        name = '{}-{}'.format(self.resource_name, digest[:12])
 
-    def create_instance(self):
-        """Create a new compute engine"""
-        print('Creating instance')
         try:
-            return self.compute.instances().insert(
+            return self.compute.instanceTemplates().get(
                 project=self.gcp.get('project'),
-                zone=self.gcp.get('zone'),
-                body=self.define_instance_config()).execute()
+                instanceTemplate=name).execute(num_retries=NUM_RETRIES)['selfLink']
         except googleapiclient.errors.HttpError as e:
-            if 'already exists' in str(e):
-                print('instance with name {} already exists. exit(1)'.format(self.project_name))
-                sys.exit(1)
+            if e.resp.status != 404:
+                raise e
+
+        print('Creating instance template ' + name)
+        operation = self.compute.instanceTemplates().insert(
+            project=self.gcp.get('project'),
+            body={'name': name, 'properties': properties}).execute(num_retries=NUM_RETRIES)
+        return self.wait_for_operation(operation)['targetLink']
+
+    def define_instance_config(self, name, index, run_id):
+        """
+        Set up the configuration of a single instance of a run, on top of the instance template
+        :arg name: name of the instance
+        :arg index: index of the instance within the run
+        :arg run_id: id of the run, log chunks are uploaded under it
+        :return: Defined Compute Engine configuration
+        """
+        points = bokchoi.utils.expand_matrix(self.gcp.get('matrix'))
+
+        # Metadata of the instance replaces that of the template, so the shared items are repeated
+        return {
+            'name': name,
+            'labels': {PROJECT_LABEL: self.resource_name, RUN_LABEL: run_id},
+            'metadata': {
+                'items': self.metadata_items() + [{
+                    'key': 'instance_name',
+                    'value': name
+                }, {
+                    'key': 'shard_environment',
+                    'value': bokchoi.utils.shard_environment(index, self.gcp.get('instance_count'), points, run_id)
+                }]
+            }
+        }
+
+    def create_instances(self, run_id):
+        """Create the compute engines of a run from the instance template, in batches
+        :arg run_id: id of the run, part of the instance names
+        :return: dict of create operations by instance name
+        """
+        template = self.ensure_instance_template()
+        names = ['{}-{}-{}'.format(self.resource_name, run_id.rpartition('-')[2], index)
+                 for index in range(self.instance_count)]
+
+        print('Creating {} instance(s)'.format(len(names)))
+        requests = [self.compute.instances().insert(
+            project=self.gcp.get('project'),
+            zone=self.gcp.get('zone'),
+            sourceInstanceTemplate=template,
+            body=self.define_instance_config(name, index, run_id)) for index, name in enumerate(names)]
+
+        operations = {}
+        for name, result in zip(names, self.execute_batch(requests)):
+            if isinstance(result, googleapiclient.errors.HttpError):
+                print('Could not create instance {}: {}'.format(name, result))
             else:
-                print(e)
-                sys.exit(1)
+                operations[name] = result
+        return operations
 
-    def delete_instance(self):
-        """Remove the created compute engine"""
-        print('Deleting instance')
-        return self.compute.instances().delete(
+    def delete_instances(self, names):
+        """Remove compute engines, in batches
+        :arg names: names of the instances
+        """
+        print('Deleting {} instance(s)'.format(len(names)))
+        requests = [self.compute.instances().delete(
             project=self.gcp.get('project'),
             zone=self.gcp.get('zone'),
-            instance=self.project_name).execute()
+            instance=name) for name in names]
+
+        for name, result in zip(names, self.execute_batch(requests)):
+            if isinstance(result, googleapiclient.errors.HttpError) and result.resp.status != 404:
+                print('Could not delete instance {}: {}'.format(name, result))
+
+    def delete_instance_templates(self):
+        """Remove the instance templates of the project"""
+        templates = []
+        request = self.compute.instanceTemplates().list(project=self.gcp.get('project'))
+        while request is not None:
+            result = request.execute(num_retries=NUM_RETRIES)
+            templates += [template['name'] for template in result.get('items', [])
+                          if template['properties'].get('labels', {}).get(PROJECT_LABEL) == self.resource_name]
+            request = self.compute.instanceTemplates().list_next(previous_request=request, previous_response=result)
+
+        print('Deleting {} instance template(s)'.format(len(templates)))
+        self.execute_batch([self.compute.instanceTemplates().delete(
+            project=self.gcp.get('project'),
+            instanceTemplate=name) for name in templates])
 
-    def wait_for_operation(self, operation):
-        """Method which polls the status of the operations and returns when the
-        operation is completed.
-        :arg operation: a gcp api operation
+    def wait_request(self, operation):
+        """Request waiting for a zonal operation, or a global one such as creating an instance template"""
+        if 'zone' in operation:
+            return self.compute.zoneOperations().wait(
+                project=self.gcp.get('project'),
+                zone=self.gcp.get('zone'),
+                operation=operation['name'])
+        return self.compute.globalOperations().wait(
+            project=self.gcp.get('project'),
+            operation=operation['name'])
+
+    def wait_for_operations(self, operations):
+        """Waits until the operations are completed. Operations().wait blocks on the server until the operation
+        is done or about two minutes have passed, and the waits are sent in batches, so this takes a single round trip
+        for most operations.
+        :arg operations: gcp api operations
+        :return: the completed operations, failed ones have an 'error'
         """
-        if operation is None:
-            return
+        operations = list(operations)
+        if not operations:
+            return operations
 
         print('Waiting for operation to finish...')
         while True:
-            result = self.compute.zoneOperations().get(
-                project=self.gcp.get('project'),
-                zone=self.gcp.get('zone'),
-                operation=operation['name']).execute()
+            pending = [index for index, operation in enumerate(operations) if operation['status'] != 'DONE']
+            if not pending:
+                break
+            results = self.execute_batch([self.wait_request(operations[index]) for index in pending])
+            for index, result in zip(pending, results):
+                if isinstance(result, googleapiclient.errors.HttpError):
+                    raise result
+                operations[index] = result
 
-            if result['status'] == 'DONE':
-                if 'error' in result:
-                    raise Exception(result['error'])
-                return result
+        return operations
 
-            time.sleep(3)
+    def wait_for_operation(self, operation):
+        """Waits until the operation is completed
+        :arg operation: a gcp api operation
+        :return: the completed operation
+        """
+        if operation is None:
+            return
+
+        operation = self.wait_for_operations([operation])[0]
+        if 'error' in operation:
+            raise Exception(operation['error'])
+        return operation
 
     def create_bucket(self):
         """Create a new storage bucket which will be used for the defined job"""
@@ -230,29 +466,39 @@ class GCP(object):
         """Delete the created bucket"""
         print('Deleting bucket')
         try:
-            bucket = self.storage.get_bucket(self.gcp.get('bucket'))
-            bucket.delete(force=True)
+            self.bucket.delete(force=True)
         except exceptions.NotFound as e:
             print('bucket does not exist, skipping deletion')
 
-    def upload_blob(self, file_name, file_object):
+    def upload_blob(self, file_name, file_object, fingerprint=None):
         """Upload file to Google Storage
         :arg file_name: target filename in Google storage
         :arg file_object: zip file object which will be uploaded
+        :arg fingerprint: fingerprint stored in the blob's metadata
         :return: public url of the Google Storage resource
         """
-        bucket = self.storage.get_bucket(self.gcp.get('bucket'))
-        blob = bucket.blob(file_name)
+        blob = self.bucket.blob(file_name)
+        if fingerprint:
+            blob.metadata = {'fingerprint': fingerprint}
         blob.upload_from_file(file_object)
         return blob.public_url
 
+    def get_blob_fingerprint(self, file_name):
+        """Get fingerprint of previously uploaded file
+        :arg file_name: filename in Google storage
+        :return: fingerprint or None if the file or its fingerprint doesn't exist
+        """
+        blob = self.bucket.get_blob(file_name)
+        if blob is None or not blob.metadata:
+            return None
+        return blob.metadata.get('fingerprint')
+
     def download_blob(self, file_name):
         """Download file from Google Storage
                 :arg file_name: target filename in Google storage
                 :return: fileobject as string
                 """
-        bucket = self.storage.get_bucket(self.gcp.get('bucket'))
-        blob = bucket.blob(file_name)
+        blob = self.bucket.blob(file_name)
         filestring = blob.download_as_string().decode('utf-8')
         return filestring
 
@@ -260,43 +506,84 @@ class GCP(object):
         """Deploy package to GCP/Google Storage"""
         print('Uploading package to Google Storage bucket')
         self.create_bucket()
-        package, fingerprint = bokchoi.utils.zip_package(path, self.requirements)
-        self.upload_blob('{}-{}.zip'.format(self.project_name, 'package'), package)
+
+        cache = PackageCache()
+        files, fingerprint = bokchoi.utils.package_manifest(path, self.requirements, cache, self.exclude)
+
+        if self.get_blob_fingerprint(self.package_name) == fingerprint:
+            print('Local package matches deployed. Not uploading.')
+            return 'Deployed!'
+
+        # Parts are uploaded while the package is being written and composed into one blob at the end
+        writer = CompositeWriter(self.bucket, self.package_name, fingerprint, **self.upload_options)
+        bokchoi.utils.write_package(writer, files, self.requirements, cache)
+        writer.close()
         return 'Deployed!'
 
+    def requirements_hash(self):
+        """Hash of requirements and the image family they are installed on"""
+        return bokchoi.utils.requirements_hash(self.requirements, IMAGE_FAMILY)
+
     def undeploy(self, dryrun=False):
         """Undeploy and delete all created resources"""
         print('Deleting resources which are created on GCP')
+        self.stop(dryrun)
+        if dryrun:
+            return 'Dryrun!'
+        self.delete_instance_templates()
         self.delete_bucket()
         return 'Undeployed!'
 
-    def run(self):
-        """Run the uploaded package"""
-        create_instance_op = self.create_instance()
-        self.wait_for_operation(create_instance_op)
-        print('Running application')
+    def run(self, wait=False):
+        """ Run the uploaded package on InstanceCount instances per point of the parameter matrix. Creating the
+        instances is always awaited.
+        :param wait:                Unused, instance creation is always awaited
+        """
+        run_id = 'bokchoi-{}'.format(int(time.time()))
+        operations = self.create_instances(run_id)
+
+        names = []
+        for name, operation in zip(operations, self.wait_for_operations(operations.values())):
+            if 'error' in operation:
+                print('Could not create instance {}: {}'.format(name, operation['error']))
+            else:
+                names.append(name)
+
+        if not names:
+            return 'No instances were created'
+
+        # Logs waits for as many instances as were created, not as the settings ask for
+        self.bucket.blob('{}{}/{}'.format(self.log_prefix, run_id, LOG_INSTANCES)).upload_from_string(str(len(names)))
+
+        print('Running application on {} instance(s): {}'.format(len(names), ', '.join(names)))
         if not self.wait_for_execution:
             return "Not awaiting execution, finishing now"
-        sec = 0
-        while True:
-            if self.project_name in self.list_instances():
-                time.sleep(10)
-                sec += 10
-                if sec % 300 == 0:
-                    print("minute {}: instance still running".format(sec / 60))
-            else:
-                logs = self.download_blob('{}-{}.zip-logs.txt'.format(self.project_name, 'package'))
-                print("""Instance no longer running, logs are as follows:\n\n-------------------------------------
-                --------------------------------------------""")
-                for l in logs.split('\n'):
-                    print(l)
-                print("---------------------------------------------------------------------------------")
-                break
 
-        return 'Script has finished'
+        finished = futures.Future()
+        self.watch_instances(run_id, names, finished.set_result)
+
+        print('Reading logs from: ' + run_id)
+        if self.follow_logs(run_id, stop=finished.done, instance_count=len(names)):
+            return 'Script has finished'
+
+        # Instances deleting themselves pass through STOPPING, preempted instances end up TERMINATED
+        for name, status in sorted(finished.result().items()):
+            if status not in (None, 'STOPPING'):
+                print('Instance {} is {}, it may have been preempted'.format(name, status))
+        return 'Instances stopped before the job finished'
 
     def stop(self, dryrun=False):
-        return 'Stop not yet implemented. Please stop VM manually'
+        """Delete all instances of the project"""
+        names = self.list_instances('labels.{} = {}'.format(PROJECT_LABEL, self.resource_name))
+
+        if not names:
+            return 'No instances to stop'
+        if dryrun:
+            print('Would delete instance(s): ' + ', '.join(names))
+            return 'Dryrun!'
+
+        self.delete_instances(names)
+        return 'Stopped!'
 
     def connect(self, dryrun, *args, **kwargs):
         print('Connect not yet implemented')
@@ -304,5 +591,107 @@ class GCP(object):
     def status(self):
         print('Status not yet implemented')
 
-    def logs(self):
-        print('Logs not yet implemented')
+    def latest_run_id(self):
+        """Id of the latest run that uploaded logs. Run ids contain the time the run started, so they sort in order
+        :return: run id, or None if there are no logs
+        """
+        blobs = self.bucket.list_blobs(prefix=self.log_prefix, delimiter='/')
+        # Prefixes are only known once the listing has been read
+        for _ in blobs:
+            pass
+        run_prefixes = sorted(blobs.prefixes)
+        return run_prefixes[-1][len(self.log_prefix):-1] if run_prefixes else None
+
+    def logs(self, follow=True, since=None, grep=None, tail=None):
+        """Follow logs of latest run
+        :arg follow: keep polling for new chunks until the run has finished
+        :arg since: only show chunks uploaded after this time, e.g. 10m or an ISO 8601 timestamp
+        :arg grep: only show lines containing this term
+        :arg tail: start with the last this many lines in stead of the whole run
+        """
+        run_id = self.latest_run_id()
+        if run_id is None:
+            print('No logs found. Try \'bokchoi run\' to create some logs.')
+            return
+
+        print('Reading logs from: ' + run_id)
+        self.follow_logs(run_id, follow, since, grep, tail)
+
+    def follow_logs(self, run_id, follow=True, since=None, grep=None, tail=None, stop=None, instance_count=None):
+        """Prints log chunks of a run as its instances upload them. Only chunks after the last one read are listed,
+        and lines split over two chunks are printed once complete.
+        :arg run_id: id of the run
+        :arg follow: keep polling for new chunks until every instance of the run has finished
+        :arg since: only show chunks uploaded after this time, e.g. 10m or an ISO 8601 timestamp
+        :arg grep: only show lines containing this term
+        :arg tail: start with the last this many lines
+        :arg stop: function returning True once the run can't log anything anymore, e.g. because its instances are
+                   gone. Chunks uploaded until then are still printed
+        :arg instance_count: number of instances of the run. Read from the run's logs if not given, runs that didn't
+                             store it are expected to have as many instances as the settings ask for
+        :return: True if the run finished, False if following stopped before that
+        """
+        prefix = '{}{}/'.format(self.log_prefix, run_id)
+        start_time = bokchoi.utils.parse_since(since) / 1000 if since else None
+
+        if instance_count is None:
+            blob = self.bucket.get_blob(prefix + LOG_INSTANCES)
+            instance_count = int(blob.download_as_bytes()) if blob is not None else self.instance_count
+
+        # Instances of runs with more than one instance log under their label, e.g. 'bokchoi-1528100000/3/000003'.
+        # Last chunk read and incomplete last line by instance label
+        last_chunks = {}
+        remainders = {}
+        done = set()
+        first = True
+        delay = MIN_LOG_POLL_INTERVAL
+
+        while True:
+            # Checked before listing, so chunks uploaded right before the instances went away are still read
+            stopping = stop is not None and stop()
+
+            # Chunks of instances that are done aren't listed again, unless an instance hasn't logged anything yet
+            pending = [last_chunks[label] for label in last_chunks if label not in done]
+            start_offset = min(pending) if pending and len(last_chunks) >= instance_count else prefix
+
+            data = {}
+            for blob in self.bucket.list_blobs(prefix=prefix, start_offset=start_offset):
+                label, _, chunk = blob.name[len(prefix):].rpartition('/')
+                if chunk == LOG_INSTANCES:
+                    continue
+                if chunk == LOG_DONE:
+                    done.add(label)
+                elif blob.name > last_chunks.get(label, ''):
+                    last_chunks[label] = blob.name
+                    if start_time is None or blob.updated.timestamp() >= start_time:
+                        data[label] = data.get(label, b'') + blob.download_as_bytes()
+
+            finished = len(done) >= instance_count
+            final = finished or stopping or not follow
+
+            lines = []
+            for label in sorted(set(data) | set(remainders), key=lambda label: (len(label), label)):
+                label_lines = (remainders.pop(label, b'') + data.get(label, b'')).split(b'\n')
+                remainder = label_lines.pop()
+                if remainder and (final or label in done):
+                    label_lines.append(remainder)
+                elif remainder:
+                    remainders[label] = remainder
+
+                template = '[app#{}]: {{}}'.format(label) if label else '{}'
+                lines += [template.format(line.decode('utf-8', 'replace')) for line in label_lines]
+
+            if grep:
+                lines = [line for line in lines if grep in line]
+            if first and tail:
+                lines = lines[-tail:]
+            first = False
+
+            for line in lines:
+                print(line)
+
+            if final:
+                return finished
+
+            delay = MIN_LOG_POLL_INTERVAL if data else min(delay * 2, MAX_LOG_POLL_INTERVAL)
+            time.sleep(delay)
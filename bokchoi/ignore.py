@@ -0,0 +1,119 @@
+"""
+Exclusion rules for deployment packages. Rules follow .gitignore semantics and are read from the project's
+.bokchoiignore file and the Exclude setting.
+"""
+
+import os
+import re
+
+IGNORE_FILE = '.bokchoiignore'
+
+DEFAULT_EXCLUDE = ['.git/', '__pycache__/', '.ipynb_checkpoints/', '.bokchoi/']
+
+
+class IgnoreRules:
+    """Matches paths relative to the project root against gitignore-style patterns. The last matching pattern
+    decides whether a path is excluded. As with git, a file can't be re-included once its directory is excluded,
+    which allows excluded directories to be pruned from the walk entirely."""
+
+    def __init__(self, patterns=()):
+        self.rules = [rule for rule in map(self._compile, patterns) if rule]
+
+    @classmethod
+    def for_project(cls, path, exclude=None):
+        """ Builds rules from the defaults, the project's .bokchoiignore file and the Exclude setting
+        :param path:                Path to project directory
+        :param exclude:             List of patterns from settings
+        :return:                    IgnoreRules
+        """
+        patterns = list(DEFAULT_EXCLUDE)
+
+        try:
+            with open(os.path.join(path, IGNORE_FILE), 'r') as ignore_file:
+                patterns += ignore_file.read().splitlines()
+        except FileNotFoundError:
+            pass
+
+        return cls(patterns + list(exclude or []))
+
+    def excluded(self, rel_path, is_dir=False):
+        """ Checks whether path is excluded
+        :param rel_path:            Path relative to project root, using / as separator
+        :param is_dir:              Whether path is a directory
+        :return:                    True if path should be left out of the package
+        """
+        excluded = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                excluded = not negate
+        return excluded
+
+    @staticmethod
+    def _compile(pattern):
+        """Returns tuple of (regex, negate, dir_only) for pattern, or None for blank lines and comments"""
+        pattern = pattern.rstrip()
+
+        if not pattern or pattern.startswith('#'):
+            return None
+
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\'):
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+
+        # Patterns containing a slash are relative to the project root, others match at any depth
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        regex = translate(pattern)
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+
+        return re.compile('^' + regex + '$'), negate, dir_only
+
+
+def translate(pattern):
+    """ Translates gitignore glob to regular expression
+    :param pattern:                 Glob pattern
+    :return:                        Regular expression string
+    """
+    regex = ''
+    i, n = 0, len(pattern)
+
+    while i < n:
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == n:
+            regex += '/.*'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < n:
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+
+    return regex
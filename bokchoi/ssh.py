@@ -4,54 +4,504 @@ Module contains functions related to SSH.
 Most of this script is adapted from:
 https://github.com/paramiko/paramiko/blob/master/demos/forward.py
 """
+from functools import partial
+import json
 import os
-import select
-import socketserver
+import selectors
+import signal
+import socket
+import sys
+import time
 
 from paramiko import RSAKey, SSHClient, AutoAddPolicy
-from paramiko.ssh_exception import SSHException
+from paramiko.ssh_exception import ChannelException, SSHException
 
 from bokchoi import utils
 
+# Bytes read from a socket or channel at once
+BUFFER_SIZE = 256 * 1024
+# Reading from one side pauses while this much is waiting to be written to the other
+MAX_PENDING = 4 * 1024 * 1024
+# Flow control window of channels, large enough to keep a long fat network busy
+WINDOW_SIZE = 16 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+CHANNEL_OPEN_TIMEOUT = 10
 
-class ForwardServer(socketserver.ThreadingTCPServer):
-    daemon_threads = True
-    allow_reuse_address = True
+# Seconds to wait for a host while reconnecting, and how long to keep trying before giving up
+CONNECT_TIMEOUT = 5
+RECONNECT_TIMEOUT = 300
+# Keepalives keep idle connections through NAT and let dead connections be noticed
+KEEPALIVE_INTERVAL = 15
+# Wall clock running ahead of the monotonic clock by this many seconds means the machine slept
+SLEEP_THRESHOLD = 5
 
+# Channels can't be polled for writability, the selector wakes up this often while data is waiting for them
+CHANNEL_POLL_INTERVAL = 0.005
 
-class Handler(socketserver.BaseRequestHandler):
 
-    ssh_transport = None
-    host_port = None
-    remote_port = None
+class Endpoint:
+    """One side of a forwarded connection: a socket or a channel, and the data waiting to be written to it"""
 
-    def __init__(self, request, client_address, server):
-        super(Handler, self).__init__(request, client_address, server)
+    def __init__(self, conn, is_channel, label=''):
+        self.conn = conn
+        self.is_channel = is_channel
+        self.label = label
+        self.opened = time.time()
+        self.received = 0
+        self.buffer = bytearray()
+        self.offset = 0
+        self.eof = False
+        self.write_closed = False
+        self.registered = 0
 
-    def handle(self):
+        conn.setblocking(False)
 
-        channel = self.ssh_transport.open_channel('direct-tcpip',
-                                                  ('localhost', self.remote_port),
-                                                  ('localhost', self.host_port))
-        if not channel:
-            print('Incoming request was rejected')
+    def recv(self):
+        """Returns available data, b'' at end of stream or None if there is none yet"""
+        try:
+            data = self.conn.recv(BUFFER_SIZE)
+        except (BlockingIOError, socket.timeout):
+            return None
+        except OSError:
+            # Reset connections and channels closed by the other side end the stream
+            data = b''
+        self.received += len(data)
+        return data
+
+    @property
+    def pending(self):
+        """Number of bytes waiting to be written"""
+        return len(self.buffer) - self.offset
+
+    def write(self, data):
+        """Queues data and writes as much of it as the socket or channel accepts"""
+        self.buffer += data
+        self.flush()
+
+    def flush(self):
+        """Writes as much pending data as the socket or channel accepts. Written data is only dropped from the buffer
+        once it's at least half of it, so partial writes don't move the rest of the buffer every time."""
+        while self.pending:
+            try:
+                sent = self.conn.send(self.buffer[self.offset:self.offset + BUFFER_SIZE])
+            except (BlockingIOError, socket.timeout):
+                break
+            except OSError:
+                # Nobody is left to read the rest, e.g. paramiko raises 'Socket is closed' for closed channels
+                self.buffer, self.offset, self.write_closed = bytearray(), 0, True
+                return
+            if not sent:
+                break
+            self.offset += sent
+
+        if self.offset and self.offset * 2 >= len(self.buffer):
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+    def shutdown_write(self):
+        self.write_closed = True
+        try:
+            if self.is_channel:
+                self.conn.shutdown_write()
+            else:
+                self.conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class Forwarder:
+    """Forwards several local ports to remote ports over a single SSH transport.
+
+    All listening sockets, connections and channels are multiplexed by a selector on one thread. Data is read in
+    large blocks and kept in per-direction buffers until the other side accepts it, so partial writes don't lose
+    data and a slow side only pauses reading from its peer."""
+
+    def __init__(self, transport, forwards=()):
+        """
+        :param transport:           Authenticated paramiko Transport
+        :param forwards:            List of (local port, remote port) pairs
+        """
+        self.transport = transport
+        self.selector = selectors.DefaultSelector()
+        self.peers = {}
+        self.running = False
+
+        # Bytes relayed by connections that have been closed, by label
+        self.closed_totals = {}
+
+        self.listeners = {}
+        for local_port, remote_port in forwards:
+            self.add_forward(local_port, remote_port)
+
+    @property
+    def ports(self):
+        """Local ports being forwarded, useful when binding to port 0"""
+        return [listener.getsockname()[1] for listener in self.listeners]
+
+    def add_forward(self, local_port, remote_port):
+        """ Starts forwarding local port
+        :param local_port:          Local port, 0 binds to any free port
+        :param remote_port:         Remote port
+        :return:                    Local port bound to
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('localhost', local_port))
+        listener.listen(64)
+        self.add_listener(listener, remote_port)
+        return listener.getsockname()[1]
+
+    def add_listener(self, listener, remote_port):
+        """Forwards connections accepted by listening socket to remote port"""
+        listener.setblocking(False)
+        self.listeners[listener] = remote_port
+        self.selector.register(listener, selectors.EVENT_READ, partial(self._accept, listener, remote_port))
+
+    def serve_forever(self):
+        """Forwards connections until shutdown is called or the transport closes"""
+        self.running = True
+
+        while self.running and self.transport.is_active():
+            self.poll()
+
+        self.close()
+
+    def poll(self):
+        """Handles events that are ready, waiting for them at most a second"""
+        waiting = any(endpoint.is_channel and endpoint.pending for endpoint in self.peers)
+
+        for key, mask in self.selector.select(CHANNEL_POLL_INTERVAL if waiting else 1):
+            if not isinstance(key.data, Endpoint):
+                key.data()
+            elif mask & selectors.EVENT_READ:
+                self._read(key.data)
+
+        # Writing frees up buffer space, which may let the peer read again
+        for endpoint in list(self.peers):
+            if endpoint in self.peers and endpoint.pending:
+                peer = self.peers[endpoint]
+                endpoint.flush()
+                self._update(endpoint)
+                self._update(peer)
+
+    def shutdown(self):
+        self.running = False
+
+    def close(self):
+        """Closes listening sockets and all forwarded connections"""
+        self.close_connections()
+        for listener in self.listeners:
+            self.selector.unregister(listener)
+            listener.close()
+        self.listeners = {}
+        self.selector.close()
+
+    def close_connections(self):
+        for endpoint in list(self.peers):
+            if endpoint in self.peers:
+                self._close(endpoint)
+
+    def open_channel(self, remote_port):
+        return self.transport.open_channel('direct-tcpip'
+                                           , ('localhost', remote_port)
+                                           , ('localhost', 0)
+                                           , window_size=WINDOW_SIZE
+                                           , max_packet_size=MAX_PACKET_SIZE
+                                           , timeout=CHANNEL_OPEN_TIMEOUT)
+
+    def relay(self, sock, channel, label):
+        """ Relays data between socket and channel until both sides are done
+        :param sock:                Connected socket
+        :param channel:             Open channel
+        :param label:               Shown in stats, e.g. 'localhost:8888 -> 8888'
+        """
+        local, remote = Endpoint(sock, False, label), Endpoint(channel, True, label)
+        self.peers[local], self.peers[remote] = remote, local
+        self._update(local)
+        self._update(remote)
+
+    def stats(self):
+        """ Bytes relayed by open connections and, per label, by closed connections
+        :return:                    Dict
+        """
+        now = time.time()
+        connections = [{'label': endpoint.label,
+                        'sent': endpoint.received,
+                        'received': peer.received,
+                        'pending': endpoint.pending + peer.pending,
+                        'seconds': round(now - endpoint.opened, 1)}
+                       for endpoint, peer in self.peers.items() if not endpoint.is_channel]
+        return {'connections': connections, 'closed': self.closed_totals}
+
+    def _accept(self, listener, remote_port):
+        try:
+            sock, _ = listener.accept()
+        except BlockingIOError:
+            return
+
+        try:
+            channel = self.open_channel(remote_port)
+        except (SSHException, OSError) as e:
+            print('Incoming request was rejected: {}'.format(e))
+            sock.close()
+            return
+
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.relay(sock, channel, 'localhost:{} -> {}'.format(listener.getsockname()[1], remote_port))
+
+    def _read(self, endpoint):
+        peer = self.peers.get(endpoint)
+        if peer is None:
+            return
+
+        data = endpoint.recv()
+        if data is None:
+            return
+
+        if data:
+            peer.write(data)
+        else:
+            endpoint.eof = True
+
+        self._update(endpoint)
+        self._update(peer)
+
+    def _update(self, endpoint):
+        """Closes write side once the peer is done and everything has been written, closes the connection once
+        both directions are done, otherwise (re)registers the events endpoint is waiting for"""
+        if endpoint not in self.peers:
+            return
+        peer = self.peers[endpoint]
+
+        if peer.eof and not endpoint.pending and not endpoint.write_closed:
+            endpoint.shutdown_write()
+
+        if endpoint.write_closed and peer.write_closed:
+            self._close(endpoint)
             return
 
+        events = 0
+        if not endpoint.eof and peer.pending < MAX_PENDING:
+            events |= selectors.EVENT_READ
+        if endpoint.pending and not endpoint.is_channel:
+            events |= selectors.EVENT_WRITE
+
+        if events == endpoint.registered:
+            return
+        if not events:
+            self.selector.unregister(endpoint.conn)
+        elif not endpoint.registered:
+            self.selector.register(endpoint.conn, events, endpoint)
+        else:
+            self.selector.modify(endpoint.conn, events, endpoint)
+        endpoint.registered = events
+
+    def _close(self, endpoint):
+        peer = self.peers.pop(endpoint)
+        self.peers.pop(peer, None)
+
+        local, channel = (peer, endpoint) if endpoint.is_channel else (endpoint, peer)
+        totals = self.closed_totals.setdefault(local.label, {'connections': 0, 'sent': 0, 'received': 0})
+        totals['connections'] += 1
+        totals['sent'] += local.received
+        totals['received'] += channel.received
+
+        for side in (endpoint, peer):
+            if side.registered:
+                self.selector.unregister(side.conn)
+                side.registered = 0
+            side.conn.close()
+
+
+class ControlDaemon(Forwarder):
+    """Keeps an SSH transport to one host open in the background and attaches channels to it on request.
+
+    Requests arrive on a unix socket, see bokchoi.control. Ports forwarded for earlier requests stay bound for the
+    lifetime of the daemon. When the transport drops, or the machine wakes up from sleep, the daemon reconnects
+    right away; open connections are closed, but listening ports are kept so tunnels work again as soon as the
+    new transport is up."""
+
+    def __init__(self, transport, connect, path, host):
+        """
+        :param transport:           Authenticated paramiko Transport
+        :param connect:             Function opening a new connection, returning its Transport
+        :param path:                Control socket path
+        :param host:                Host connected to, shown in stats
+        """
+        super().__init__(transport)
+        self.connect = connect
+        self.path = path
+        self.host = host
+        self.connected_since = time.time()
+        self.reconnects = 0
+        self.clocks = (time.time(), time.monotonic())
+
+        transport.set_keepalive(KEEPALIVE_INTERVAL)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.control.bind(path)
+        os.chmod(path, 0o600)
+        self.control.listen(16)
+        self.control.setblocking(False)
+        self.selector.register(self.control, selectors.EVENT_READ, self._accept_request)
+
+    def serve_forever(self):
+        """Handles requests and forwards connections until stopped or reconnecting fails"""
+        self.running = True
+        try:
+            while self.running:
+                self.check_transport()
+                self.poll()
+        finally:
+            self.selector.unregister(self.control)
+            self.control.close()
+            os.unlink(self.path)
+            self.close()
+
+    def check_transport(self):
+        """Reconnects if the transport dropped or the machine slept, in which case the transport is most likely
+        dead even if it hasn't noticed yet"""
+        wall, monotonic = time.time(), time.monotonic()
+        slept = (wall - self.clocks[0]) - (monotonic - self.clocks[1]) > SLEEP_THRESHOLD
+        self.clocks = (wall, monotonic)
+
+        if slept or not self.transport.is_active():
+            self.reconnect()
+
+    def reconnect(self):
+        """Replaces the transport, retrying quickly at first and backing off to a few seconds"""
+        print('Reconnecting to {}'.format(self.host))
+        self.close_connections()
+        self.transport.close()
+
+        delay = 0.1
+        deadline = time.time() + RECONNECT_TIMEOUT
         while True:
-            r, _, _ = select.select([self.request, channel], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if not data:
-                    break
-                channel.send(data)
-            if channel in r:
-                data = channel.recv(1024)
+            try:
+                self.transport = self.connect()
+                break
+            except (SSHException, OSError) as e:
+                if time.time() > deadline:
+                    self.shutdown()
+                    raise ConnectionError('Could not reconnect to {}: {}'.format(self.host, e))
+                time.sleep(delay)
+                delay = min(delay * 2, CONNECT_TIMEOUT)
+
+        self.transport.set_keepalive(KEEPALIVE_INTERVAL)
+        self.connected_since = time.time()
+        self.reconnects += 1
+        self.clocks = (time.time(), time.monotonic())
+        print('Reconnected to {}'.format(self.host))
+
+    def open_channel(self, remote_port):
+        try:
+            return super().open_channel(remote_port)
+        except ChannelException:
+            # Nothing listens on the remote port, the connection itself is fine
+            raise
+        except (SSHException, OSError):
+            if self.transport.is_active():
+                raise
+            self.reconnect()
+            return super().open_channel(remote_port)
+
+    def open_session(self, command):
+        """ Runs command on host
+        :param command:             Shell command
+        :return:                    Channel with the combined output of command
+        """
+        try:
+            session = self.transport.open_session(window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE
+                                                  , timeout=CHANNEL_OPEN_TIMEOUT)
+        except ChannelException:
+            raise
+        except (SSHException, OSError):
+            if self.transport.is_active():
+                raise
+            self.reconnect()
+            session = self.transport.open_session(window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE
+                                                  , timeout=CHANNEL_OPEN_TIMEOUT)
+        session.set_combine_stderr(True)
+        session.exec_command(command)
+        return session
+
+    def handle(self, message, conn):
+        """ Handles request
+        :param message:             Request dict
+        :param conn:                Connection request came in on, relayed to a channel for 'channel' and 'exec'
+        :return:                    Reply dict
+        """
+        op = message.get('op')
+
+        if op == 'ping':
+            return {}
+
+        if op == 'forward':
+            forwarded = {(listener.getsockname()[1], remote_port) for listener, remote_port in self.listeners.items()}
+            for local_port, remote_port in message['forwards']:
+                if (local_port, remote_port) not in forwarded:
+                    forwarded.add((self.add_forward(local_port, remote_port), remote_port))
+            return {'forwards': sorted(forwarded)}
+
+        if op == 'stats':
+            stats = self.stats()
+            stats.update({'host': self.host,
+                          'connected_since': self.connected_since,
+                          'reconnects': self.reconnects,
+                          'forwards': sorted((listener.getsockname()[1], remote_port)
+                                             for listener, remote_port in self.listeners.items())})
+            return stats
+
+        if op == 'channel':
+            self.relay(conn, self.open_channel(message['port']), 'channel -> {}'.format(message['port']))
+            return {}
+
+        if op == 'exec':
+            self.relay(conn, self.open_session(message['command']), 'exec: {}'.format(message['command'])[:32])
+            return {}
+
+        if op == 'stop':
+            self.shutdown()
+            return {}
+
+        return {'error': 'Unknown request: {}'.format(op)}
+
+    def _accept_request(self):
+        try:
+            conn, _ = self.control.accept()
+        except BlockingIOError:
+            return
+
+        # Requests are a single short line, sent right after connecting
+        conn.settimeout(CHANNEL_OPEN_TIMEOUT)
+        relayed = False
+        try:
+            line = bytearray()
+            while not line.endswith(b'\n'):
+                data = conn.recv(1)
                 if not data:
-                    break
-                self.request.send(data)
+                    raise ConnectionError('Connection closed before request was complete')
+                line += data
+
+            try:
+                reply = self.handle(json.loads(line.decode()), conn)
+            except (SSHException, OSError, KeyError, ValueError) as e:
+                reply = {'error': '{}: {}'.format(type(e).__name__, e)}
 
-        channel.close()
-        self.request.close()
+            relayed = 'error' not in reply and conn in (endpoint.conn for endpoint in self.peers)
+            conn.setblocking(True)
+            conn.sendall(json.dumps(reply).encode() + b'\n')
+        except OSError as e:
+            print('Request failed: {}'.format(e))
+        finally:
+            if relayed:
+                conn.setblocking(False)
+            else:
+                conn.close()
 
 
 class SSH(object):
@@ -63,38 +513,42 @@ class SSH(object):
 
         self.public_key, self.key_file_path = self._maybe_generate_keys(private_key_name)
 
-    def forward(self, local_port, remote_host, remote_po, user_name):
+    def forward(self, forwards, remote_host, user_name):
         """ Sets up port forwarding to remote host
-        :param local_port:              Local port to forward to
+        :param forwards:                List of (local port, remote port) pairs
         :param remote_host:             Remote host
-        :param remote_port:             Remote port
         :param user_name:               User to use in ssh connection
         :return:                        -
         """
 
-        print('Connecting to ssh host {}:{} ...'.format(remote_host, remote_po))
-
-        utils.retry(self.client.connect
-                    , SSHException
-                    , hostname=remote_host
-                    , port=22
-                    , username=user_name
-                    , key_filename=self.key_file_path)
+        print('Connecting to ssh host {} ...'.format(remote_host))
 
-        class SubHandler(Handler):
-            ssh_transport = self.client.get_transport()
-            host_port = local_port
-            remote_port = remote_po
+        transport = utils.retry(self.connect, SSHException, remote_host=remote_host, user_name=user_name)
+        forwarder = Forwarder(transport, forwards)
 
-        server = ForwardServer(('localhost', local_port), SubHandler)
+        for local_port, remote_port in forwards:
+            print('Forwarding localhost:{} to {}:{}'.format(local_port, remote_host, remote_port))
 
         try:
-            server.serve_forever()
+            forwarder.serve_forever()
         except KeyboardInterrupt:
-            server.shutdown()
-            server.server_close()
+            forwarder.close()
             print('Connection closed')
 
+    def connect(self, remote_host, user_name, timeout=None):
+        """ Opens SSH connection to remote host
+        :param remote_host:             Remote host
+        :param user_name:               User to use in ssh connection
+        :param timeout:                 Seconds to wait for the TCP connection
+        :return:                        Authenticated paramiko Transport
+        """
+        self.client.connect(hostname=remote_host
+                            , port=22
+                            , username=user_name
+                            , key_filename=self.key_file_path
+                            , timeout=timeout)
+        return self.client.get_transport()
+
     def _maybe_generate_keys(self, private_key_name):
         """Get private and public keys. Create if not exists.
         :return:                    Public key
@@ -112,3 +566,20 @@ class SSH(object):
             priv.write_private_key_file(key_file_path)
         pub = priv.get_base64()
         return pub, key_file_path
+
+
+def main(path, remote_host, user_name, private_key_name):
+    """Runs control daemon, started by bokchoi.control.start_daemon"""
+    ssh = SSH(private_key_name)
+    transport = utils.retry(ssh.connect, (SSHException, OSError), remote_host=remote_host, user_name=user_name
+                            , timeout=CONNECT_TIMEOUT)
+    daemon = ControlDaemon(transport, partial(ssh.connect, remote_host, user_name, CONNECT_TIMEOUT), path
+                           , remote_host)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.shutdown())
+    print('Connected to {}, listening on {}'.format(remote_host, path))
+    daemon.serve_forever()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+Manifest of the cloud resources created for a project. Lets commands address resources by their identifiers
+instead of scanning the whole account for them.
+"""
+
+import json
+import os
+
+STATE_FILE = os.path.join('.bokchoi', 'state.json')
+
+
+class State:
+    """Identifiers of resources created by deploy and run, grouped by kind, stored in .bokchoi/state.json in the
+    project directory.
+
+    The state file is created by deploy. Projects deployed before it existed, or from another machine without a
+    mirror, have no state; get returns None for them and callers fall back to looking resources up. Optionally
+    the state is mirrored to an object store, so it can be shared between machines.
+    """
+
+    def __init__(self, project_path, mirror=None):
+
+        self.path = os.path.join(project_path, STATE_FILE)
+        self.mirror = mirror
+        self.resources = {}
+        self.exists = False
+
+        try:
+            with open(self.path, 'r') as state_file:
+                text = state_file.read()
+        except FileNotFoundError:
+            text = mirror.read() if mirror else None
+
+        if text:
+            self.resources = json.loads(text)
+            self.exists = True
+
+    def get(self, kind):
+        """ Returns identifiers of resources of kind
+        :param kind:                Resource kind, e.g. 'policies'
+        :return:                    List of identifiers, or None if the project has no state
+        """
+        if not self.exists:
+            return None
+        return list(self.resources.get(kind, []))
+
+    def add(self, kind, *identifiers):
+        identifiers_of_kind = self.resources.setdefault(kind, [])
+        for identifier in identifiers:
+            if identifier not in identifiers_of_kind:
+                identifiers_of_kind.append(identifier)
+
+    def discard(self, kind, *identifiers):
+        self.resources[kind] = [identifier for identifier in self.resources.get(kind, [])
+                                if identifier not in identifiers]
+
+    def delete(self):
+        """Removes state file once all resources have been deleted. The mirror goes with the bucket it's in."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.resources = {}
+        self.exists = False
+
+    def save(self, create=False):
+        """ Writes state file and mirror. Only deploy creates the state file; a partial state would hide resources
+        created before the project had one.
+        :param create:              Create state file if it doesn't exist yet
+        """
+        if not (self.exists or create):
+            return
+
+        text = json.dumps(self.resources, indent=4, sort_keys=True)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as state_file:
+            state_file.write(text)
+        self.exists = True
+
+        if self.mirror:
+            self.mirror.write(text)
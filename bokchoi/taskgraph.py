@@ -0,0 +1,67 @@
+"""
+Runs interdependent tasks concurrently
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskGraph:
+    """Graph of named tasks. Tasks run on a thread pool as soon as all tasks they depend on have finished.
+    When a task fails, tasks depending on it are skipped, other tasks still run."""
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def add(self, name, func, *dependencies, **kwargs):
+        """ Adds task to graph. Dependencies have to be added before the tasks depending on them, which keeps the
+        graph free of cycles.
+        :param name:                Unique name of task
+        :param func:                Function to call
+        :param dependencies:        Names of tasks that have to finish first
+        :param kwargs:              Parameters to pass to function
+        :return:                    Name of task
+        """
+        if name in self.tasks:
+            raise ValueError('Task already exists: ' + name)
+
+        unknown = set(dependencies) - set(self.tasks)
+        if unknown:
+            raise ValueError('Unknown dependencies of {}: {}'.format(name, ', '.join(sorted(unknown))))
+
+        self.tasks[name] = (func, kwargs, set(dependencies))
+        return name
+
+    def run(self):
+        """ Runs all tasks
+        :return:                    Dict mapping names of failed tasks to their exceptions
+        """
+        done = set()
+        failed = {}
+        pending = dict(self.tasks)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+
+                for name, (func, kwargs, dependencies) in list(pending.items()):
+                    if dependencies & set(failed):
+                        failed[name] = RuntimeError('Skipped because a dependency failed')
+                        del pending[name]
+                    elif dependencies <= done:
+                        running[executor.submit(func, **kwargs)] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is None:
+                        done.add(name)
+                    else:
+                        failed[name] = future.exception()
+
+        return failed
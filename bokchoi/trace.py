@@ -0,0 +1,165 @@
+"""
+Timing of the phases of deploys and runs. Spans recorded by the client are appended to a trace file in the project
+directory, spans recorded on instances are logged to the run's log stream.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+TRACE_FILE = os.path.join('.bokchoi', 'trace.jsonl')
+
+# Prefix of the log messages instances write spans to, e.g. '[trace#3]: app 1528100000.12 1528100042.57'
+INSTANCE_STAGE = 'trace'
+
+
+class Tracer:
+    """Records spans of a single deploy or run. Spans share the trace id; for runs it's the name of the log stream,
+    which instances receive as BOKCHOI_RUN_ID."""
+
+    def __init__(self, trace_id, path=None):
+        """
+        :param trace_id:            Id correlating spans of a deploy or run
+        :param path:                Trace file spans are appended to on save. Spans are only kept in memory if not
+                                    given
+        """
+        self.trace_id = trace_id
+        self.path = path
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        """ Times the body of the with statement. The span is recorded even if the body raises.
+        :param name:                Name of phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append(make_span(self.trace_id, name, start, time.time()))
+
+    def save(self):
+        """Appends recorded spans to trace file"""
+        if not self.path or not self.spans:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a') as trace_file:
+            for span in self.spans:
+                trace_file.write(json.dumps(span, sort_keys=True) + '\n')
+        self.spans = []
+
+
+def make_span(trace_id, name, start, end, source='client'):
+    """ Returns span as stored in trace file
+    :param trace_id:                Id of deploy or run
+    :param name:                    Name of phase
+    :param start:                   Start time, seconds since epoch
+    :param end:                     End time, seconds since epoch
+    :param source:                  'client', or 'instance' followed by the label of the instance
+    :return:                        Dict
+    """
+    return {'trace_id': trace_id, 'name': name, 'start': start, 'end': end, 'source': source}
+
+
+def load(path):
+    """ Reads spans from trace file. Lines that can't be parsed, e.g. of an interrupted write, are skipped.
+    :param path:                    Path to trace file
+    :return:                        List of spans, in the order they were saved
+    """
+    spans = []
+    try:
+        with open(path, 'r') as trace_file:
+            for line in trace_file:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return spans
+
+
+def parse_instance_span(trace_id, message):
+    """ Parses span logged by an instance
+    :param trace_id:                Id of run whose log stream message was read from
+    :param message:                 Log message, e.g. '[trace#3]: app 1528100000.12 1528100042.57'
+    :return:                        Span, or None if message isn't a span
+    """
+    stage, _, text = message.partition(']: ')
+    stage_name, _, label = stage.lstrip('[').partition('#')
+    if stage_name != INSTANCE_STAGE:
+        return None
+
+    try:
+        name, start, end = text.split()
+        return make_span(trace_id, name, float(start), float(end), 'instance#' + label if label else 'instance')
+    except ValueError:
+        return None
+
+
+def recent_trace_ids(spans, last):
+    """Ids of the last traces in spans, oldest first"""
+    first_start = {}
+    for span in spans:
+        first_start[span['trace_id']] = min(span['start'], first_start.get(span['trace_id'], span['start']))
+    return sorted(first_start, key=first_start.get)[-last:]
+
+
+def phase_durations(spans, trace_ids):
+    """ Duration of every phase of every trace. Phases run on several instances take as long as the slowest
+    instance.
+    :param spans:                   Spans
+    :param trace_ids:               Ids of traces to include
+    :return:                        List of (phase, {trace_id: seconds}), client phases first, in order of start
+    """
+    durations = {}
+    order = {}
+
+    for span in sorted(spans, key=lambda span: (span['source'] != 'client', span['start'])):
+        if span['trace_id'] not in trace_ids:
+            continue
+        phase = span['name'] if span['source'] == 'client' else 'instance:' + span['name']
+        order.setdefault(phase, len(order))
+        by_trace = durations.setdefault(phase, {})
+        by_trace[span['trace_id']] = max(span['end'] - span['start'], by_trace.get(span['trace_id'], 0))
+
+    return [(phase, durations[phase]) for phase in sorted(order, key=order.get)]
+
+
+def format_table(spans, trace_ids):
+    """ Formats phase durations as a table with a row per phase and a column per trace
+    :param spans:                   Spans
+    :param trace_ids:               Ids of traces to include, in column order
+    :return:                        Table
+    """
+    width = max([len(trace_id) for trace_id in trace_ids] + [9])
+    rows = phase_durations(spans, trace_ids)
+    phase_width = max([len(phase) for phase, _ in rows] + [5])
+
+    lines = ['{:<{}}  '.format('phase', phase_width) + '  '.join('{:>{}}'.format(trace_id, width)
+                                                                 for trace_id in trace_ids)]
+    for phase, by_trace in rows:
+        cells = ['{:>{}.2f}'.format(by_trace[trace_id], width) if trace_id in by_trace else ' ' * (width - 1) + '-'
+                 for trace_id in trace_ids]
+        lines.append('{:<{}}  '.format(phase, phase_width) + '  '.join(cells))
+
+    return '\n'.join(lines)
+
+
+def export_chrome_trace(spans, path):
+    """ Writes spans in the Trace Event Format read by chrome://tracing and Perfetto. Every trace is shown as a
+    process, with a thread per source.
+    :param spans:                   Spans
+    :param path:                    File to write to
+    """
+    events = [{'name': span['name'],
+               'ph': 'X',
+               'ts': int(span['start'] * 1e6),
+               'dur': int((span['end'] - span['start']) * 1e6),
+               'pid': span['trace_id'],
+               'tid': span['source']} for span in spans]
+
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
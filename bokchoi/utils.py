@@ -1,12 +1,22 @@
 
+from datetime import datetime
 import hashlib
-from time import sleep
+from itertools import product
+import json
+import struct
+from time import localtime, sleep, time
 import urllib
-from io import BytesIO
 import os
+import re
+from shlex import quote
 import zipfile
+import zlib
 
-from bokchoi.aws import cloudwatch_logger
+from bokchoi.cache import compress
+from bokchoi.ignore import IgnoreRules
+
+# Located by path, so importing utils doesn't pull in the AWS backend
+CLOUDWATCH_LOGGER = os.path.join(os.path.dirname(__file__), 'aws', 'cloudwatch_logger.py')
 
 
 def retry(func, exc, **kwargs):
@@ -26,40 +36,305 @@ def retry(func, exc, **kwargs):
     raise TimeoutError()
 
 
+def lazy_property(func):
+    """ Decorator; turns method into a property which is computed on first access and then stored on the instance
+    :param func:                    Method computing the value
+    :return:                        Property
+    """
+    attribute = '_lazy_' + func.__name__
+
+    def getter(self):
+        if not hasattr(self, attribute):
+            setattr(self, attribute, func(self))
+        return getattr(self, attribute)
+
+    getter.__doc__ = func.__doc__
+    return property(getter)
+
+
+def upload_options(config):
+    """ Returns package upload options from settings. UploadPartSize is given in MB
+    :param config:                  Project config
+    :return:                        Keyword arguments for common.upload_to_s3
+    """
+    return {'part_size': int(config.get('UploadPartSize', 8)) * 1024 * 1024,
+            'concurrency': int(config.get('UploadConcurrency', 4))}
+
+
 def create_project_id(project_name, vendor_specific_id):
     """Creates project id by hashing vendor specific id and project name"""
     unique_id = hashlib.sha1((vendor_specific_id + project_name).encode()).hexdigest()
     return '-'.join(('bokchoi', project_name, unique_id[:12]))
 
 
+def parse_project_id(project_id):
+    """ Returns project name part of project id, e.g. of a bucket found in the account
+    :param project_id:              Project id as created by create_project_id
+    :return:                        Project name, or None if project_id isn't a project id
+    """
+    match = re.fullmatch(r'bokchoi-(.+)-[0-9a-f]{12}', project_id)
+    return match.group(1) if match else None
+
+
+def requirements_hash(requirements, *platform):
+    """ Hashes requirements together with anything identifying the platform they're installed on, so a wheelhouse
+    built for one image isn't reused on another
+    :param requirements:            List of python requirements
+    :param platform:                Strings identifying the target platform, e.g. image id
+    :return:                        Hex digest
+    """
+    digest = hashlib.sha256('\n'.join(requirements or '').encode())
+    for part in platform:
+        digest.update(('\0' + str(part)).encode())
+    return digest.hexdigest()[:16]
+
+
+def wheelhouse_key(req_hash):
+    """Returns key under which the wheelhouse for a requirements hash is stored in the project bucket"""
+    return 'wheelhouse/{}.tar.gz'.format(req_hash)
+
+
+def expand_matrix(matrix):
+    """ Expands parameter matrix into all combinations of its values
+    :param matrix:                  Dict mapping parameter names to lists of values
+    :return:                        List of dicts with one value per parameter. A single empty dict without matrix
+    """
+    names = sorted(matrix or {})
+    return [dict(zip(names, values)) for values in product(*[matrix[name] for name in names])]
+
+
+def shard_environment(index, shard_count, points, run_id=''):
+    """ Returns environment of a single instance of a run, as shell exports. Instances are spread over matrix
+    points first, each point's instances share its input through the shard index.
+    :param index:                   Index of instance within run
+    :param shard_count:             Number of instances per matrix point
+    :param points:                  Expanded parameter matrix
+    :param run_id:                  Identifies the run, so reused instances don't run it twice
+    :return:                        Shell script exporting the environment
+    """
+    environment = {'BOKCHOI_RUN_ID': run_id
+                   , 'BOKCHOI_SHARD_INDEX': index % shard_count
+                   , 'BOKCHOI_SHARD_COUNT': shard_count
+                   , 'BOKCHOI_PARAMS': json.dumps(points[index // shard_count], sort_keys=True)
+                   # Tells apart the log messages of instances in the same run. Always set, so a reused instance
+                   # doesn't keep the label of its previous run.
+                   , 'BOKCHOI_INSTANCE_LABEL': index if shard_count * len(points) > 1 else ''}
+
+    return ''.join('export {}={}\n'.format(name, quote(str(value))) for name, value in sorted(environment.items()))
+
+
+def parse_since(since):
+    """ Parses relative time such as 30s, 10m, 2h or 1d, or an ISO 8601 timestamp
+    :param since:                   Time specification
+    :return:                        Milliseconds since epoch
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+    if since[-1:] in units and since[:-1].isdigit():
+        return int(1000 * (time() - int(since[:-1]) * units[since[-1]]))
+
+    try:
+        return int(1000 * datetime.fromisoformat(since).timestamp())
+    except ValueError:
+        raise ValueError('Could not parse time \'{}\'. Use e.g. 10m, 2h or 2018-06-01T12:00'.format(since))
+
+
 def get_my_ip():
     with urllib.request.urlopen('https://api.ipify.org/') as response:
         return response.read().decode('utf8')
 
 
-def zip_package(path, requirements=None):
-    """ Creates deployment package by zipping the project directory. Writes requirements to requirements.txt
-    if specified in settings
+def package_manifest(path, requirements=None, cache=None, exclude=None):
+    """ Collects the files that make up the deployment package and fingerprints them without compressing
+    anything. Files that haven't changed since the last deploy are only stat'ed. Paths matching the project's
+    exclusion rules are left out; excluded directories aren't walked at all.
     :param path:                    Path to project directory
     :param requirements:            List of python requirements
-    :return:                        Zip file
+    :param cache:                   PackageCache to use
+    :param exclude:                 List of gitignore-style patterns to exclude, in addition to .bokchoiignore
+    :return:                        List of (file name, archive name) tuples and package fingerprint
     """
-    file_object = BytesIO()
+    rules = IgnoreRules.for_project(path, exclude)
 
     rootlen = len(path) + 1
 
-    with zipfile.ZipFile(file_object, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for base, _, files in os.walk(path):
-            for file_name in files:
-                fn = os.path.join(base, file_name)
-                zip_file.write(fn, fn[rootlen:])
+    files = []
+    for base, dir_names, file_names in os.walk(path):
+        rel_base = base[rootlen:].replace(os.sep, '/')
+        rel_base = rel_base + '/' if rel_base else ''
+
+        dir_names[:] = [dir_name for dir_name in dir_names if not rules.excluded(rel_base + dir_name, True)]
+
+        for file_name in file_names:
+            if rules.excluded(rel_base + file_name):
+                continue
+            fn = os.path.join(base, file_name)
+            files.append((fn, fn[rootlen:]))
+
+    files.append((CLOUDWATCH_LOGGER, 'cloudwatch_logger.py'))
+
+    digest = hashlib.sha256()
+    for fn, arcname in files:
+        digest.update('{}\0{}\n'.format(arcname, cache.content_hash(fn)).encode())
+    digest.update('\n'.join(requirements or '').encode())
+
+    cache.save()
+
+    return files, digest.hexdigest()
+
+
+def write_package(file_object, files, requirements, cache):
+    """ Writes deployment package to file object one entry at a time. Compressed data is taken from the package
+    cache. The file object doesn't need to be seekable, so the package can be streamed
+    :param file_object:             File object to write zip archive to
+    :param files:                   Files returned by package_manifest
+    :param requirements:            List of python requirements
+    :param cache:                   PackageCache to use
+    :return:                        List of ZipInfo objects of written entries
+    """
+    zip_file = DeflatedZipWriter(file_object)
+
+    for file_name, arcname in files:
+
+        crc, size, content_hash = cache.lookup(file_name)
+
+        zinfo = zipfile.ZipInfo.from_file(file_name, arcname)
+        zinfo.CRC = crc
+        zinfo.file_size = size
+
+        zip_file.write(zinfo, cache.read(content_hash))
+
+    raw = '\n'.join(requirements or '').encode()
+    zinfo = zipfile.ZipInfo('requirements.txt', localtime(time())[:6])
+    zinfo.external_attr = 0o600 << 16
+    zinfo.CRC = zlib.crc32(raw) & 0xffffffff
+    zinfo.file_size = len(raw)
+    zip_file.write(zinfo, compress(raw))
+
+    zip_file.close()
+
+    cache.save()
+
+    return zip_file.infos
+
+
+def package_report(infos, package_size, top=20):
+    """ Summarises package contents by size
+    :param infos:                   ZipInfo objects returned by write_package
+    :param package_size:            Size of the written package in bytes
+    :param top:                     Number of largest files and directories to list
+    :return:                        Report
+    """
+    directories = {}
+    for info in infos:
+        directory = info.filename.split('/')[0] + '/' if '/' in info.filename else '.'
+        compressed, uncompressed = directories.get(directory, (0, 0))
+        directories[directory] = (compressed + info.compress_size, uncompressed + info.file_size)
+
+    lines = ['Largest files:']
+    for info in sorted(infos, key=lambda info: info.compress_size, reverse=True)[:top]:
+        lines.append('\t{:>12}  {:>12}  {}'.format(format_size(info.compress_size),
+                                                   format_size(info.file_size),
+                                                   info.filename))
+
+    lines.append('Largest top-level directories:')
+    for directory, (compressed, uncompressed) in sorted(directories.items(),
+                                                        key=lambda item: item[1][0], reverse=True)[:top]:
+        lines.append('\t{:>12}  {:>12}  {}'.format(format_size(compressed), format_size(uncompressed), directory))
+
+    lines.append('Files: {}'.format(len(infos)))
+    lines.append('Total uncompressed: ' + format_size(sum(info.file_size for info in infos)))
+    lines.append('Total compressed: ' + format_size(package_size))
+
+    return '\n'.join(lines)
+
+
+def format_size(size):
+    """Formats number of bytes for humans"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+
+
+class ByteCounter:
+    """File object which discards everything written to it, keeping count of the number of bytes"""
+
+    def __init__(self):
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+
+class DeflatedZipWriter:
+    """ Writes zip archives of already deflated entries. zipfile has no public API to add precompressed entries, so
+    the records are written here. The file object doesn't need to be seekable, as CRC and sizes are known up front.
+    Archives needing ZIP64 aren't supported.
+    """
+
+    LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+    CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+    END_RECORD = struct.Struct('<4s4H2LH')
+
+    def __init__(self, file_object):
+        self.file_object = file_object
+        self.offset = 0
+        self.infos = []
+
+    def _write(self, data):
+        self.file_object.write(data)
+        self.offset += len(data)
+
+    def _header_fields(self, zinfo):
+        """Fields shared by local and central headers, from flags to extra field length"""
+        year, month, day, hours, minutes, seconds = zinfo.date_time
+        dos_time = hours << 11 | minutes << 5 | seconds // 2
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        filename = zinfo.filename.encode('utf-8')
+        # Bit 11 marks UTF-8 names
+        flags = 0 if filename.isascii() else 0x800
+        return (flags, zipfile.ZIP_DEFLATED, dos_time, dos_date, zinfo.CRC, zinfo.compress_size, zinfo.file_size
+                , len(filename), 0), filename
+
+    def write(self, zinfo, data):
+        """ Writes entry
+        :param zinfo:               ZipInfo with CRC and file size set
+        :param data:                Deflated data
+        """
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.compress_size = len(data)
+        zinfo.header_offset = self.offset
+
+        if max(self.offset, zinfo.file_size, zinfo.compress_size) > 0xffffffff or len(self.infos) >= 0xffff:
+            raise ValueError('Package is too large for a zip archive without ZIP64: ' + zinfo.filename)
+
+        fields, filename = self._header_fields(zinfo)
+        self._write(self.LOCAL_HEADER.pack(b'PK\x03\x04', 20, 0, *fields) + filename)
+        self._write(data)
 
-        zip_file.write(cloudwatch_logger.__file__, 'cloudwatch_logger.py')
+        self.infos.append(zinfo)
 
-        zip_file.writestr('requirements.txt', '\n'.join(requirements or ''))
+    def close(self):
+        """Writes central directory"""
+        start = self.offset
 
-        fingerprint = '|'.join([str(elem.CRC) for elem in zip_file.infolist()])
+        for zinfo in self.infos:
+            fields, filename = self._header_fields(zinfo)
+            # Made on Unix, so external attributes hold the file mode
+            self._write(self.CENTRAL_HEADER.pack(b'PK\x01\x02', 20, 3, 20, 0, *fields, 0, 0, 0
+                                                 , zinfo.external_attr, zinfo.header_offset) + filename)
 
-    file_object.seek(0)
+        self._write(self.END_RECORD.pack(b'PK\x05\x06', 0, 0, len(self.infos), len(self.infos)
+                                         , self.offset - start, start, 0))
 
-    return file_object, fingerprint
+        if hasattr(self.file_object, 'flush'):
+            self.file_object.flush()
@@ -15,7 +15,7 @@ setup(
     packages=['bokchoi', 'bokchoi.aws', 'bokchoi.gcp'],
     package_dir={'bokchoi.aws': 'bokchoi/aws',
                  'bokchoi.gcp': 'bokchoi/gcp'},
-    package_data={'bokchoi.aws': ['ec2-startup-script.sh'],
+    package_data={'bokchoi.aws': ['ec2-startup-script.sh', 'ec2-bake-script.sh'],
                   'bokchoi.gcp': ['gcp-startup-script.sh']},
     install_requires=[
         'Click',
@@ -31,9 +31,15 @@ setup(
     author_email='timnooren@gmail.com',
     long_description=README,
     license='MIT',
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'bokchoi=bokchoi.cli:cli'
+        ],
+        'bokchoi.backends': [
+            'EC2=bokchoi.aws.ec2:EC2',
+            'EMR=bokchoi.aws.emr:EMR',
+            'GCP=bokchoi.gcp.gcp:GCP'
         ]
     },
     classifiers=[
@@ -43,6 +49,7 @@ setup(
         'Operating System :: OS Independent',
         'Natural Language :: English',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
     ],
 )